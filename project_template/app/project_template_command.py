@@ -5,8 +5,8 @@ import subprocess
 import argparse
 
 from project_template.scan import print_dirs_and_files
-from project_template.database import add_template, update_template, delete_template, get_template, list_template_names, generate_template
-from project_template.instantiation import instantiate_project
+from project_template.database import add_template, add_templates, update_template, update_templates, delete_template, open_template, list_templates, list_template_versions, generate_template
+from project_template.instantiation import instantiate_project, instantiate_projects, instantiate_archive, sync_project
 from project_template.constants import EDITOR, DEFAULT_TEMPLATE_DIR
 from project_template.util import save_read_json
 
@@ -50,6 +50,58 @@ def get_values(init_message):
     return values, has_none
 
 
+def read_manifest(manifest_file):
+    """
+    @brief      读取批量添加或更新模板的清单文件
+    @details    清单文件为 json 列表，每项包含 name、project_dir，以及可选的 ignore_files、rule_file 和 template_dir，
+                相对路径相对于清单文件所在目录
+
+    @param manifest_file 清单文件路径
+    @return add_templates 和 update_templates 使用的模板列表
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    items = save_read_json(manifest_file)
+    if not isinstance(items, list):
+        raise ValueError(f"Invalid manifest file: {manifest_file}")
+
+    templates = []
+    for item in items:
+        ignore_files = list(item.get("ignore_files", []))
+        rule_file = item.get("rule_file", None)
+        if rule_file is not None:
+            ignore_files += save_read_json(os.path.join(manifest_dir, rule_file)).get("ignore_files", [])
+
+        template = {
+            "name": item["name"],
+            "project_dir": os.path.join(manifest_dir, item["project_dir"]),
+            "ignore_files": ignore_files,
+        }
+        template_dir = item.get("template_dir", None)
+        if template_dir is not None:
+            template["location_dir"] = os.path.join(manifest_dir, template_dir)
+        templates.append(template)
+    return templates
+
+
+def archive_format_of(archive_file):
+    """
+    @brief  根据扩展名确定压缩包格式，无法识别时使用 tar
+
+    @param archive_file 压缩包路径
+    @return instantiate_archive 使用的压缩包格式
+    """
+    extensions = [
+        (".zip", "zip"),
+        (".tar.gz", "gztar"), (".tgz", "gztar"),
+        (".tar.bz2", "bztar"), (".tbz2", "bztar"),
+        (".tar.xz", "xztar"), (".txz", "xztar"),
+    ]
+    for extension, archive_format in extensions:
+        if archive_file.endswith(extension):
+            return archive_format
+    return "tar"
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group(required=True)
@@ -59,12 +111,23 @@ def get_parser():
     group.add_argument("--list", action="store_true", help="list all templates")
     group.add_argument("--generate", action="store_true", help="generate template from project")
     group.add_argument("--instantiate", action="store_true", help="instantiate project from template")
+    group.add_argument("--sync", action="store_true", help="sync project instantiated with --track to the template version")
 
     info_group = parser.add_argument_group("info")
     info_group.add_argument("--name", type=str, default=None, help="template name")
     info_group.add_argument("--project-dir", type=str, default=None, help="project directory for template/ project to be generated by template")
     info_group.add_argument("--template-dir", type=str, default=None, help="path to save template")
     info_group.add_argument("--rule-file", type=str, default=None, help="rule file for generate template")
+    info_group.add_argument("--workers", type=int, default=None, help="number of threads used to read files when scanning template or to write files when instantiating project")
+    info_group.add_argument("--format", type=str, default=None, choices=["json", "pack"], help="format of saved template config")
+    info_group.add_argument("--manifest", type=str, default=None, help="json manifest of templates to add or update in one batch")
+    info_group.add_argument("--archive", type=str, default=None, help="write instantiated project to a tar/zip archive instead of project directory, - for tar to stdout")
+    info_group.add_argument("--jobs", type=str, default=None, help="json list of {project_dir, args} to instantiate in one batch")
+    info_group.add_argument("--processes", action="store_true", help="use a process pool of --workers processes (default: number of CPUs) for --jobs")
+    info_group.add_argument("--version", type=int, default=None, help="template version to list, instantiate or sync, default is the latest")
+    info_group.add_argument("--track", action="store_true", help="write a render manifest into instantiated project so that it can be updated with --sync")
+    info_group.add_argument("--force", action="store_true", help="overwrite files modified after instantiation when syncing project")
+    info_group.add_argument("--args", type=str, default=None, help="json file of {name: value} template arguments to override when syncing project")
     return parser
 
 
@@ -75,7 +138,16 @@ def main():
         return
     
     args = parser.parse_args()
-    if args.add:
+    if (args.add or args.update) and args.manifest is not None:
+        templates = read_manifest(args.manifest)
+        template_dir = DEFAULT_TEMPLATE_DIR if args.template_dir is None else args.template_dir
+        if args.add:
+            names = add_templates(templates, template_dir, args.workers, args.format)
+            print(f"add {len(names)} templates from {args.manifest}")
+        else:
+            names = update_templates(templates, template_dir, args.workers, config_format=args.format)
+            print(f"update {len(names)} templates from {args.manifest}")
+    elif args.add:
         if args.name is None:
             parser._print_message("name is required", file=sys.stderr)
             return
@@ -90,10 +162,10 @@ def main():
             ignore_files = []
 
         if args.template_dir is None:
-            add_template(args.name, args.project_dir, ignore_files=ignore_files)
+            add_template(args.name, args.project_dir, ignore_files=ignore_files, max_workers=args.workers, config_format=args.format)
             print(f"add template {args.name} from {args.project_dir} to {DEFAULT_TEMPLATE_DIR}")
         else:
-            add_template(args.name, args.project_dir, args.template_dir)
+            add_template(args.name, args.project_dir, args.template_dir, ignore_files, args.workers, config_format=args.format)
             print(f"add template {args.name} from {args.project_dir} to {args.template_dir}")
     elif args.update:
         if args.name is None:
@@ -110,10 +182,10 @@ def main():
             ignore_files = []
 
         if args.template_dir is None:
-            update_template(args.name, args.project_dir, ignore_files=ignore_files)
+            update_template(args.name, args.project_dir, ignore_files=ignore_files, max_workers=args.workers, config_format=args.format)
             print(f"update template {args.name} from {args.project_dir} to {DEFAULT_TEMPLATE_DIR}")
         else:
-            update_template(args.name, args.project_dir, args.template_dir)
+            update_template(args.name, args.project_dir, args.template_dir, ignore_files, args.workers, config_format=args.format)
             print(f"update template {args.name} from {args.project_dir} to {args.template_dir}")
     elif args.delete:
         if args.name is None:
@@ -123,41 +195,63 @@ def main():
         print(f"delete template {args.name} from {project_dir}")
     elif args.list:
         if args.name is None:
-            template_names = list_template_names()
-            if len(template_names) == 0:
+            templates = list_templates()
+            if len(templates) == 0:
                 print("No templates found")
                 return
-            longest_name = max(len(name) for name in template_names)
-            for name in template_names:
-                project_dir, config = get_template(name)
-                name = name.ljust(longest_name)
-                print(f"\033[32m{name}\033[0m: \033[33m{project_dir}\033[0m")
+            longest_name = max(len(template.name) for template in templates)
+            for template in templates:
+                name = template.name.ljust(longest_name)
+                print(f"\033[32m{name}\033[0m: \033[33m{template.project_dir}\033[0m")
         else:
-            project_dir, config = get_template(args.name)
+            template = open_template(args.name, args.version)
             print("=" * 80)
-            print(f"PROJECT_DIR: {project_dir}")
+            print(f"PROJECT_DIR: {template.project_dir}")
+            versions = ", ".join(str(version) for version in list_template_versions(args.name))
+            print(f"VERSION: {template.version} (versions: {versions})")
             print("=" * 80)
             print(f"CONFIG_ARGS:")
-            config_args = config["args"]
+            config_args = template.args
             for arg in config_args:
                 print(f"{arg['name']}: {arg['default_value']}")
             print("=" * 80)
             print(f"STRUCTURE:")
-            print_dirs_and_files(config["dirs_and_files"])
+            print_dirs_and_files(template.entries)
     elif args.instantiate:
         if args.name is None:
             parser._print_message("name is required", file=sys.stderr)
             return
-        if args.project_dir is None:
+        if args.jobs is not None:
+            jobs_dir = os.path.dirname(os.path.abspath(args.jobs))
+            jobs = [(os.path.join(jobs_dir, job["project_dir"]), job.get("args", {})) for job in save_read_json(args.jobs)]
+            workers = args.workers
+            if args.processes and workers is None:
+                # --processes 未指定 --workers 时使用与 CPU 核数相同的进程数
+                workers = os.cpu_count()
+            results = instantiate_projects(args.name, jobs, args.version, workers, args.processes, args.track)
+            failed = 0
+            for project_dir, error in results:
+                if error is None:
+                    print(f"instantiate project {project_dir} from template {args.name}")
+                else:
+                    failed += 1
+                    print(f"failed to instantiate project {project_dir}: {error}", file=sys.stderr)
+            if failed > 0:
+                sys.exit(f"{failed} of {len(results)} projects failed")
+            return
+        if args.archive is not None:
+            if args.archive != "-" and os.path.exists(args.archive):
+                parser._print_message(f"{args.archive} already exists", file=sys.stderr)
+                return
+        elif args.project_dir is None:
             parser._print_message("project-dir is required", file=sys.stderr)
             return
-        if os.path.exists(args.project_dir):
+        elif os.path.exists(args.project_dir):
             parser._print_message(f"{args.project_dir} already exists", file=sys.stderr)
             return
         
         required_args = {}
-        project_dir, config = get_template(args.name)
-        for arg in config["args"]:
+        for arg in open_template(args.name, args.version).args:
             name = arg["name"]
             default_value = arg["default_value"]
             required_args[name] = default_value
@@ -185,8 +279,30 @@ def main():
                 else:
                     sys.exit("取消操作")
 
-        instantiate_project(args.name, args.project_dir, required_args)
-        print(f"instantiate project {args.project_dir} from template {args.name}")
+        if args.archive == "-":
+            instantiate_archive(args.name, sys.stdout.buffer, required_args, args.version)
+            sys.stdout.buffer.flush()
+        elif args.archive is not None:
+            with open(args.archive, "wb") as f:
+                instantiate_archive(args.name, f, required_args, args.version, archive_format_of(args.archive))
+            print(f"instantiate project {args.archive} from template {args.name}")
+        else:
+            instantiate_project(args.name, args.project_dir, required_args, args.version, args.workers, args.track)
+            print(f"instantiate project {args.project_dir} from template {args.name}")
+    elif args.sync:
+        if args.project_dir is None:
+            parser._print_message("project-dir is required", file=sys.stderr)
+            return
+        sync_args = save_read_json(args.args) if args.args is not None else None
+        result = sync_project(args.project_dir, sync_args, args.version, args.force, args.workers)
+        for path in result["written"]:
+            print(f"write {path}")
+        for path in result["removed"]:
+            print(f"remove {path}")
+        for path in result["conflicts"]:
+            print(f"skip modified {path}", file=sys.stderr)
+        print(f"sync project {args.project_dir}: {len(result['written'])} written, {len(result['removed'])} removed, "
+              f"{len(result['conflicts'])} skipped, {result['unchanged']} unchanged")
     elif args.generate:
         if args.rule_file is None:
             parser._print_message("rule-file is required", file=sys.stderr)
@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+
+from project_template.constants import BLOB_DIR
+from project_template.util import atomic_write, file_lock, save_write_json, save_read_json
+
+
+__all__ = [
+    "blob_path", "write_blob", "read_blob", "open_blob", "blob_session", "add_blob_refs", "release_blob_refs",
+]
+
+
+# 引用计数快照文件名称，内容为 {"log": 日志文件名称, "refs": {digest: count}}
+BLOB_REFS_FILE = "refs.json"
+
+# 快照之后的引用计数变化追加在日志文件中，每行为 [delta, [digest, ...]]，
+# 日志同时大于快照和 BLOB_REFS_LOG_SIZE 字节时合并为新的快照
+BLOB_REFS_LOG_SIZE = 1 << 16
+
+# 本进程写入后尚未持久化的内容，blob_session 结束时统一 sync 一次
+_UNSYNCED = threading.Event()
+
+# 添加引用的过程加共享锁，回收没有引用的内容时加排他锁
+BLOB_GC_LOCK = "gc"
+
+
+def blob_path(digest, blob_dir=BLOB_DIR):
+    """
+    @brief  获取内容的存放路径
+
+    @param digest   内容的 sha256 哈希
+    @param blob_dir 内容存放目录
+    @return 存放路径，以哈希的前两位作为子目录
+    """
+    return os.path.join(blob_dir, digest[:2], digest[2:])
+
+
+def write_blob(data, blob_dir=BLOB_DIR, digest=None):
+    """
+    @brief      按内容哈希保存内容，相同的内容只保存一份
+    @details    内容写入临时文件后重命名，读取方只会看到完整的内容。内容以哈希命名，写入时不单独 fsync，
+                由 blob_session 结束时统一持久化
+
+    @param data     要保存的字节内容，可以是 bytes 或者 mmap 等支持缓冲区协议的对象
+    @param blob_dir 内容存放目录
+    @param digest   已经计算好的内容 sha256 哈希，None 时计算
+    @return 内容的 sha256 哈希
+    """
+    if digest is None:
+        digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest, blob_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, "wb", sync=False) as f:
+            f.write(data)
+        _UNSYNCED.set()
+    return digest
+
+
+def read_blob(digest, blob_dir=BLOB_DIR):
+    """
+    @brief  读取内容
+
+    @param digest   内容的 sha256 哈希
+    @param blob_dir 内容存放目录
+    @return 字节内容
+    """
+    with open_blob(digest, blob_dir) as f:
+        return f.read()
+
+
+def open_blob(digest, blob_dir=BLOB_DIR):
+    """
+    @brief  以二进制模式打开内容，用于流式读取
+
+    @param digest   内容的 sha256 哈希
+    @param blob_dir 内容存放目录
+    @return 文件对象
+    """
+    try:
+        return open(blob_path(digest, blob_dir), "rb")
+    except FileNotFoundError:
+        raise ValueError(f"Template blob does not exist: {digest}")
+
+
+@contextlib.contextmanager
+def blob_session(blob_dir=BLOB_DIR):
+    """
+    @brief      写入内容并添加引用的过程
+    @details    会话之间互不阻塞，release_blob_refs 会等待所有会话结束后再回收内容，
+                避免已经存在、因此没有重新写入的内容在添加引用之前被回收。
+                会话正常结束时，如果本进程写入了新的内容，调用一次 sync 将其持久化
+
+    @param blob_dir 内容存放目录
+    """
+    os.makedirs(blob_dir, exist_ok=True)
+    with file_lock(os.path.join(blob_dir, BLOB_GC_LOCK), shared=True):
+        yield
+        if _UNSYNCED.is_set():
+            _UNSYNCED.clear()
+            os.sync()
+
+
+def _apply_refs(refs, digests, delta):
+    """
+    @brief  修改引用计数，返回引用计数变为 0 的内容哈希
+    """
+    released = []
+    for digest in digests:
+        count = refs.get(digest, 0) + delta
+        if count > 0:
+            refs[digest] = count
+        else:
+            refs.pop(digest, None)
+            released.append(digest)
+    return released
+
+
+def _read_refs(blob_dir):
+    """
+    @brief  读取引用计数快照并重放日志
+    @return (引用计数, 日志文件路径)，快照为旧的 {digest: count} 格式或者不存在时日志文件路径为 None
+    """
+    snapshot = save_read_json(os.path.join(blob_dir, BLOB_REFS_FILE))
+    if "refs" not in snapshot:
+        return dict(snapshot), None
+
+    refs = snapshot["refs"]
+    log_file = os.path.join(blob_dir, snapshot["log"])
+    with open(log_file, "r") as f:
+        for line in f:
+            try:
+                delta, digests = json.loads(line)
+            except ValueError:
+                # 写入时中断的不完整行
+                continue
+            _apply_refs(refs, digests, delta)
+    return refs, log_file
+
+
+def _update_refs(digests, delta, blob_dir):
+    """
+    @brief      修改引用计数，返回引用计数变为 0 的内容哈希
+    @details    变化只追加到日志文件中，不改写整个快照；日志大于快照时合并为新的快照，并切换到新的日志文件
+    """
+    refs_file = os.path.join(blob_dir, BLOB_REFS_FILE)
+    with file_lock(refs_file):
+        refs, log_file = _read_refs(blob_dir)
+        released = _apply_refs(refs, digests, delta)
+        if log_file is not None and os.path.getsize(log_file) <= max(os.path.getsize(refs_file), BLOB_REFS_LOG_SIZE):
+            line = json.dumps([delta, list(digests)]).encode("utf-8") + b"\n"
+            with open(log_file, "a+b") as f:
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        # 上次写入时中断的不完整行单独占一行，重放时跳过
+                        line = b"\n" + line
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            return released
+
+        # 先创建空的日志文件，再写入指向它的快照，中断时旧的快照和日志仍然有效
+        new_log_file = os.path.join(blob_dir, f"refs.{os.urandom(6).hex()}.log")
+        with atomic_write(new_log_file):
+            pass
+        save_write_json(refs_file, {"log": os.path.basename(new_log_file), "refs": refs})
+        if log_file is not None:
+            os.remove(log_file)
+    return released
+
+
+def add_blob_refs(digests, blob_dir=BLOB_DIR):
+    """
+    @brief  为内容添加引用，需要在 blob_session 中调用
+
+    @param digests  内容哈希列表，同一个哈希出现多次时添加多次引用
+    @param blob_dir 内容存放目录
+    """
+    if digests:
+        _update_refs(digests, 1, blob_dir)
+
+
+def release_blob_refs(digests, blob_dir=BLOB_DIR):
+    """
+    @brief  释放内容的引用，并删除引用计数为 0 的内容，不能在 blob_session 中调用
+
+    @param digests  内容哈希列表，同一个哈希出现多次时释放多次引用
+    @param blob_dir 内容存放目录
+    @return 被删除的内容哈希列表
+    """
+    if not digests:
+        return []
+
+    os.makedirs(blob_dir, exist_ok=True)
+    removed = []
+    with file_lock(os.path.join(blob_dir, BLOB_GC_LOCK)):
+        for digest in _update_refs(digests, -1, blob_dir):
+            path = blob_path(digest, blob_dir)
+            if os.path.exists(path):
+                os.remove(path)
+                removed.append(digest)
+    return removed
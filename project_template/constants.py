@@ -6,12 +6,39 @@ HOME_DIR = os.path.expanduser("~/.project-template")
 # 用于存放 template 的数据库文件
 DATABASE_FILE = os.path.join(HOME_DIR, "templates.json")
 
+# sqlite 模板注册表文件
+REGISTRY_DB_FILE = os.path.join(HOME_DIR, "templates.db")
+
+# 模板注册表后端，json 使用 DATABASE_FILE，sqlite 使用 REGISTRY_DB_FILE
+REGISTRY_BACKEND = os.environ.get('PROJECT_TEMPLATE_REGISTRY', 'json')
+
+# 按内容哈希存放模板文件内容的目录，多个模板中相同的文件只保存一份
+BLOB_DIR = os.path.join(HOME_DIR, "blobs")
+
+# 实例化时写入项目根目录的渲染清单，记录模板名称、版本、参数以及每个条目的渲染摘要，用于模板更新后同步项目
+RENDER_MANIFEST_FILE = ".project-template.json"
+
+# 渲染缓存目录，保存以相同模板内容和参数实例化时渲染出的文件内容
+RENDER_CACHE_DIR = os.path.join(HOME_DIR, "render-cache")
+
+# 渲染缓存占用的磁盘空间上限（字节），超出时淘汰最久未使用的缓存，0 表示不使用渲染缓存
+RENDER_CACHE_SIZE = int(os.environ.get('PROJECT_TEMPLATE_RENDER_CACHE_SIZE', '0'))
+
 # 默认放置 template 的目录
 DEFAULT_TEMPLATE_DIR = os.path.join(HOME_DIR, "templates")
 
+# 模板配置文件格式，json 为单个 json 文件，pack 为每个文件单独压缩、可随机读取的 zip 文件
+CONFIG_FORMAT = os.environ.get('PROJECT_TEMPLATE_CONFIG_FORMAT', 'json')
+
+# 进程内缓存的已解析模板配置数量上限，0 表示不缓存
+CONFIG_CACHE_SIZE = int(os.environ.get('PROJECT_TEMPLATE_CONFIG_CACHE_SIZE', '16'))
+
 # 使用 #{arg} 表示参数，使用 #{arg:default_value} 形式设定默认值，default_value 为默认值
 ARG_REGEX = r"\#\{\w+:[\s]*[\a-zA-Z0-9\_\-\.]+\}|\#\{\w+\}"
 
+# 不小于该大小的文件在扫描时使用内存映射读取
+MMAP_THRESHOLD = 1 << 20
+
 # 模板名称规定
 TEMPLATE_NAME_REGEX = r"^[a-zA-Z_]\w*$"
 
@@ -1,25 +1,31 @@
 import os
 import re
-from project_template.scan import scan_directory, scan_args
-from project_template.constants import DATABASE_FILE, DEFAULT_TEMPLATE_DIR, TEMPLATE_NAME_REGEX
-from project_template.util import save_write_json, save_read_json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from project_template.scan import iter_directory, iter_scan_args, reduce_args, relative_path
+from project_template.constants import DEFAULT_TEMPLATE_DIR, TEMPLATE_NAME_REGEX
+from project_template.registry import get_registry
+from project_template.storage import config_file_path, config_temp_path, commit_config, config_format_of, write_config, read_config, read_config_refs, resolve_config_entry, entry_ref, read_config_meta, read_config_args, read_config_entry, config_blobs, clear_config_cache
+from project_template.storage import history_file_path, append_history, read_history_config, history_versions, history_blobs
+from project_template.blobs import blob_session, add_blob_refs, release_blob_refs
+from project_template.util import compile_replacements
 
 
-__all__ = ["add_template", "delete_template", "update_template", "get_template", "list_template_names"]
+__all__ = [
+    "add_template", "add_templates", "delete_template", "update_template", "update_templates", "get_template", "list_template_names",
+    "TemplateHandle", "open_template", "list_templates", "list_template_versions",
+]
 
 
 
-def add_template(name, project_dir, location_dir=DEFAULT_TEMPLATE_DIR, ignore_files=[]):
+def _check_template(name, project_dir, location_dir):
     """
-    @brief  根据项目模板创建项目
+    @brief  检查模板名称、项目模板路径以及存放位置，存放位置不存在时创建
 
     @param name         项目模板名称
     @param project_dir  项目模板路径
     @param location_dir 项目模板存放位置
-    @param ignore_files 忽略文件列表
     """
-    project_dir = os.path.abspath(project_dir)
-    location_dir = os.path.abspath(location_dir)
     template_pattern = re.compile(TEMPLATE_NAME_REGEX)
     if not template_pattern.match(name):
         raise ValueError(f"Invalid template name: {name}")
@@ -33,30 +39,149 @@ def add_template(name, project_dir, location_dir=DEFAULT_TEMPLATE_DIR, ignore_fi
         os.makedirs(location_dir)
     if not os.path.isdir(location_dir):
         raise ValueError(f"Location directory is not a directory: {location_dir}")
-    
-    if not os.path.exists(DATABASE_FILE):
-        save_write_json(DATABASE_FILE, {})
-
-    database = save_read_json(DATABASE_FILE)
 
-    if name in database:
-        raise ValueError(f"Template already exists: {name}. If you want to update the template, please use update_template function.")
 
-    dirs_and_files = scan_directory(project_dir, ignore_files)
-    args = scan_args(dirs_and_files)
-    config = {
-        "dirs_and_files": dirs_and_files,
-        "args": args,
-    }
-    config_file = os.path.join(location_dir, f"{name}.json")
-    save_write_json(config_file, config)
-
-    database[name] = {
+def _write_template(name, project_dir, location_dir, ignore_files, max_workers, config_format, output_file=None):
+    """
+    @brief  扫描项目模板并写入配置文件，返回模板记录和配置文件引用的内容哈希，不修改注册表
+    @details 指定 output_file 时配置写入 output_file，模板记录中仍然是最终的配置文件路径
+    """
+    # 扫描、参数提取和序列化逐个条目进行，内存占用只取决于单个文件的大小
+    raw_args = []
+    manifest = {}
+    dirs_and_files = iter_directory(project_dir, ignore_files, max_workers, manifest, store_blobs=True)
+    dirs_and_files = iter_scan_args(dirs_and_files, raw_args, manifest)
+    config_file = config_file_path(location_dir, name, config_format)
+    args = []
+    def tail():
+        args.extend(reduce_args(raw_args))
+        return {"args": args, "manifest": manifest}
+    if output_file is None:
+        output_file = config_file
+    with blob_session():
+        entry_count = write_config(output_file, dirs_and_files, tail)
+        blobs = config_blobs(output_file)
+        add_blob_refs(blobs)
+
+    template = {
         "project_dir": project_dir,
         "location": location_dir,
         "config_file": config_file,
+        "args": args,
+        "entry_count": entry_count,
+        "version": 1,
     }
-    save_write_json(DATABASE_FILE, database)
+    return template, blobs
+
+
+def add_template(name, project_dir, location_dir=DEFAULT_TEMPLATE_DIR, ignore_files=[], max_workers=None, config_format=None):
+    """
+    @brief  根据项目模板创建项目
+
+    @param name          项目模板名称
+    @param project_dir   项目模板路径
+    @param location_dir  项目模板存放位置
+    @param ignore_files  忽略文件列表
+    @param max_workers   扫描目录时并发读取文件的线程数，None 表示串行读取
+    @param config_format 配置文件格式，json 或者 pack，None 时使用 CONFIG_FORMAT
+    """
+    project_dir = os.path.abspath(project_dir)
+    location_dir = os.path.abspath(location_dir)
+    _check_template(name, project_dir, location_dir)
+
+    registry = get_registry()
+    if registry.get(name) is not None:
+        raise ValueError(f"Template already exists: {name}. If you want to update the template, please use update_template function.")
+
+    # 配置先写入临时文件，注册成功后再替换配置文件，并发添加同名模板时不会覆盖另一方的配置
+    temp_file = config_temp_path(config_file_path(location_dir, name, config_format))
+    try:
+        template, blobs = _write_template(name, project_dir, location_dir, ignore_files, max_workers, config_format, temp_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    if not registry.add(name, template):
+        os.remove(temp_file)
+        clear_config_cache(temp_file)
+        release_blob_refs(blobs)
+        raise ValueError(f"Template already exists: {name}. If you want to update the template, please use update_template function.")
+    commit_config(temp_file, template["config_file"])
+
+
+def _batch_specs(templates, location_dir):
+    """
+    @brief  规范化批量操作的模板列表，检查名称是否重复
+
+    @param templates    模板列表，每项为 {"name", "project_dir", "ignore_files"(可选), "location_dir"(可选)}
+    @param location_dir 未指定 location_dir 时使用的存放位置
+    @return (name, project_dir, location_dir, ignore_files) 列表
+    """
+    specs = []
+    names = set()
+    for template in templates:
+        name = template["name"]
+        if name in names:
+            raise ValueError(f"Duplicate template name: {name}")
+        names.add(name)
+
+        project_dir = os.path.abspath(template["project_dir"])
+        template_location_dir = os.path.abspath(template.get("location_dir", location_dir))
+        _check_template(name, project_dir, template_location_dir)
+        specs.append((name, project_dir, template_location_dir, template.get("ignore_files", [])))
+    return specs
+
+
+def add_templates(templates, location_dir=DEFAULT_TEMPLATE_DIR, max_workers=None, config_format=None):
+    """
+    @brief      批量添加项目模板
+    @details    多个模板并发扫描，全部写入配置文件后一次性写入注册表。
+                任意一个模板已经存在或者扫描失败时，不添加任何模板
+
+    @param templates     模板列表，每项为 {"name", "project_dir", "ignore_files"(可选), "location_dir"(可选)}
+    @param location_dir  未指定 location_dir 的模板的存放位置
+    @param max_workers   同时扫描的模板数量，None 时使用 ThreadPoolExecutor 的默认值
+    @param config_format 配置文件格式，json 或者 pack，None 时使用 CONFIG_FORMAT
+    @return 添加的模板名称列表
+    """
+    specs = _batch_specs(templates, location_dir)
+    registry = get_registry()
+    existing = [spec[0] for spec in specs if registry.get(spec[0]) is not None]
+    if existing:
+        raise ValueError(f"Template already exists: {', '.join(existing)}. If you want to update the template, please use update_templates function.")
+
+    # 配置先写入临时文件，全部注册成功后再替换配置文件，已经存在的模板的配置不会被覆盖
+    temp_files = [config_temp_path(config_file_path(template_location_dir, name, config_format))
+                  for name, _, template_location_dir, _ in specs]
+    results = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_write_template, name, project_dir, template_location_dir, ignore_files, None, config_format, temp_file)
+                   for (name, project_dir, template_location_dir, ignore_files), temp_file in zip(specs, temp_files)]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BaseException as e:
+                errors.append(e)
+
+    def discard():
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            clear_config_cache(temp_file)
+        release_blob_refs([digest for _, template_blobs in results for digest in template_blobs])
+
+    if errors:
+        discard()
+        raise errors[0]
+
+    existing = registry.add_many([(spec[0], template) for spec, (template, _) in zip(specs, results)])
+    if existing:
+        discard()
+        raise ValueError(f"Template already exists: {', '.join(existing)}. If you want to update the template, please use update_templates function.")
+    for temp_file, (template, _) in zip(temp_files, results):
+        commit_config(temp_file, template["config_file"])
+    return [spec[0] for spec in specs]
 
 
 def delete_template(name):
@@ -65,61 +190,408 @@ def delete_template(name):
 
     @param name 项目模板名称
     """
-    if not os.path.exists(DATABASE_FILE):
-        save_write_json(DATABASE_FILE, {})
-    database = save_read_json(DATABASE_FILE)
-    if name not in database:
+    # 先删除注册表中的记录，删除失败时模板的配置文件保持不变
+    template = get_registry().remove(name)
+    if template is None:
         raise ValueError(f"Template does not exist: {name}")
-    
-    config_file = database[name]["config_file"]
-    config = save_read_json(config_file)
-    os.remove(config_file)
 
-    data = database.pop(name)
-    project_dir = data["project_dir"]
-    save_write_json(DATABASE_FILE, database)
+    config_file = template["config_file"]
+    config = {}
+    blobs = []
+    if os.path.exists(config_file):
+        config = read_config(config_file)
+        blobs = config_blobs(config_file)
+        os.remove(config_file)
+    clear_config_cache(config_file)
+
+    history_file = history_file_path(template["location"], name)
+    if os.path.exists(history_file):
+        blobs.extend(history_blobs(history_file))
+        os.remove(history_file)
+
+    project_dir = template["project_dir"]
+    release_blob_refs(blobs)
 
     return project_dir, config
 
 
-def update_template(name, project_dir, location_dir=DEFAULT_TEMPLATE_DIR, ignore_files=[]):
+def _rewrite_template(name, old_template, project_dir, location_dir, ignore_files, max_workers, incremental, config_format):
+    """
+    @brief      重新扫描项目模板，模板发生变化时将新的配置写入临时文件，不修改注册表、配置文件和历史版本
+    @details    json 格式的旧配置只读取内容哈希，未发生变化的文件复用已保存的内容哈希，按内容哈希比较新旧条目，
+                只有重新读取的文件内容会保存在内存中
+    @return     (新的模板记录, staged)，staged 为写入的临时配置，注册表更新成功后使用 _commit_rewrite 替换配置文件并记录历史版本，
+                更新失败时使用 _discard_rewrite 删除；配置不需要重写时为 None
     """
-    @brief  更新项目模板
+    old_config_file = old_template["config_file"]
+    old_config = read_config_refs(old_config_file)
+
+    previous = {}
+    if incremental and old_template["project_dir"] == project_dir:
+        old_manifest = old_config.get("manifest", {})
+        for dir_or_file in old_config.get("dirs_and_files", []):
+            if dir_or_file["type"] != "file":
+                continue
+            key = relative_path(dir_or_file["root"], dir_or_file["name"])
+            if key not in old_manifest:
+                continue
+            if "arguments" not in dir_or_file or "spans" not in dir_or_file or "args" not in old_manifest[key]:
+                # 旧的模板配置中没有保存参数，复用时需要重新扫描内容
+                dir_or_file = resolve_config_entry(dir_or_file)
+            previous[key] = (dir_or_file, old_manifest[key])
+
+    # 扫描时大文件直接写入内容存储，扫描和添加引用在同一个会话中完成，写入的内容不会在添加引用之前被回收
+    with blob_session():
+        raw_args = []
+        manifest = {}
+        dirs_and_files = iter_directory(project_dir, ignore_files, max_workers, manifest, previous, store_blobs=True)
+        dirs_and_files = list(iter_scan_args(dirs_and_files, raw_args, manifest))
+        config = {
+            "dirs_and_files": dirs_and_files,
+            "args": reduce_args(raw_args),
+            "manifest": manifest,
+        }
+
+        if config_format is None:
+            config_format = config_format_of(old_config_file)
+        config_file = config_file_path(location_dir, name, config_format)
+
+        # 文件内容或者参数发生变化时生成新的版本，旧版本以增量的形式保存在历史版本文件中
+        old_version = old_template.get("version", 1)
+        changed = ([entry_ref(entry) for entry in config["dirs_and_files"]] != [entry_ref(entry) for entry in old_config.get("dirs_and_files", [])]
+                   or config["args"] != old_config.get("args", []))
+        version = old_version + 1 if changed else old_version
+
+        staged = None
+        if config_file != old_config_file or changed or config["manifest"] != old_config.get("manifest", {}):
+            temp_file = config_temp_path(config_file)
+            try:
+                write_config(temp_file, config["dirs_and_files"], lambda: {"args": config["args"], "manifest": config["manifest"]})
+                blobs = config_blobs(temp_file)
+                add_blob_refs(blobs)
+            except BaseException:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                clear_config_cache(temp_file)
+                raise
+            staged = {
+                "temp_file": temp_file,
+                "blobs": blobs,
+                "history": (old_config, old_version, config, version) if changed else None,
+            }
+
+    template = {
+        "project_dir": project_dir,
+        "location": location_dir,
+        "config_file": config_file,
+        "args": config["args"],
+        "entry_count": len(dirs_and_files),
+        "version": version,
+    }
+    return template, staged
 
-    @param name         项目模板名称
-    @param project_dir  项目模板路径
+
+def _commit_rewrite(name, old_template, template, staged):
+    """
+    @brief  注册表更新成功后替换配置文件，移动并追加历史版本，释放旧配置文件引用的内容
+    """
+    old_history_file = history_file_path(old_template["location"], name)
+    history_file = history_file_path(template["location"], name)
+    if history_file != old_history_file and os.path.exists(old_history_file):
+        shutil.move(old_history_file, history_file)
+    if staged is None:
+        return
+
+    old_config_file = old_template["config_file"]
+    old_blobs = config_blobs(old_config_file)
+    with blob_session():
+        commit_config(staged["temp_file"], template["config_file"])
+        if staged["history"] is not None:
+            add_blob_refs(append_history(history_file, *staged["history"]))
+    if template["config_file"] != old_config_file:
+        os.remove(old_config_file)
+        clear_config_cache(old_config_file)
+    release_blob_refs(old_blobs)
+
+
+def _discard_rewrite(staged):
     """
-    delete_template(name)
-    add_template(name, project_dir, location_dir, ignore_files)
+    @brief  注册表更新失败时删除临时配置文件，并释放其引用的内容
+    """
+    if staged is None:
+        return
+    if os.path.exists(staged["temp_file"]):
+        os.remove(staged["temp_file"])
+    clear_config_cache(staged["temp_file"])
+    release_blob_refs(staged["blobs"])
+
+
+def update_template(name, project_dir, location_dir=DEFAULT_TEMPLATE_DIR, ignore_files=[], max_workers=None, incremental=True,
+                    config_format=None):
+    """
+    @brief      更新项目模板
+    @details    模板中保存了每个文件的 size、mtime_ns、inode 和内容哈希，增量更新时只重新读取和扫描发生变化的文件，
+                其余条目直接复用已保存的内容和参数。模板没有任何变化时不会重写配置文件。
+                文件内容或者参数发生变化时版本号加一，之前的版本可以通过 get_template 的 version 参数获取
+
+    @param name          项目模板名称
+    @param project_dir   项目模板路径
+    @param location_dir  项目模板存放位置
+    @param ignore_files  忽略文件列表
+    @param max_workers   扫描目录时并发读取文件的线程数，None 表示串行读取
+    @param incremental   是否增量更新，False 时重新读取所有文件
+    @param config_format 配置文件格式，json 或者 pack，None 时保持原有格式
+    """
+    project_dir = os.path.abspath(project_dir)
+    location_dir = os.path.abspath(location_dir)
+
+    registry = get_registry()
+    old_template = registry.get(name)
+    if old_template is None:
+        raise ValueError(f"Template does not exist: {name}")
+
+    _check_template(name, project_dir, location_dir)
+
+    # 新的配置先写入临时文件，注册表更新成功后再替换配置文件，模板被并发删除时不会留下配置文件和历史版本
+    template, staged = _rewrite_template(name, old_template, project_dir, location_dir, ignore_files, max_workers, incremental, config_format)
+    if old_template == template and staged is None:
+        return
+    if not registry.update(name, template):
+        _discard_rewrite(staged)
+        raise ValueError(f"Template does not exist: {name}")
+    _commit_rewrite(name, old_template, template, staged)
 
 
-def get_template(name):
+def update_templates(templates, location_dir=DEFAULT_TEMPLATE_DIR, max_workers=None, incremental=True, config_format=None):
+    """
+    @brief      批量更新项目模板
+    @details    多个模板并发扫描，所有发生变化的模板记录一次性写入注册表。
+                某个模板更新失败时，其余模板仍然正常更新，最后抛出第一个错误
+
+    @param templates     模板列表，每项为 {"name", "project_dir", "ignore_files"(可选), "location_dir"(可选)}
+    @param location_dir  未指定 location_dir 的模板的存放位置
+    @param max_workers   同时扫描的模板数量，None 时使用 ThreadPoolExecutor 的默认值
+    @param incremental   是否增量更新，False 时重新读取所有文件
+    @param config_format 配置文件格式，json 或者 pack，None 时保持原有格式
+    @return 发生变化的模板名称列表
+    """
+    registry = get_registry()
+    old_templates = {}
+    for template in templates:
+        old_template = registry.get(template["name"])
+        if old_template is None:
+            raise ValueError(f"Template does not exist: {template['name']}")
+        old_templates[template["name"]] = old_template
+    specs = _batch_specs(templates, location_dir)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_rewrite_template, name, old_templates[name], project_dir, template_location_dir, ignore_files, None,
+                                   incremental, config_format)
+                   for name, project_dir, template_location_dir, ignore_files in specs]
+        records = []
+        staged_records = {}
+        errors = []
+        for spec, future in zip(specs, futures):
+            try:
+                template, staged = future.result()
+            except BaseException as e:
+                errors.append(e)
+                continue
+            if template != old_templates[spec[0]] or staged is not None:
+                records.append((spec[0], template))
+                staged_records[spec[0]] = staged
+
+    # 其他模板更新失败时，成功的模板仍然写入注册表；被并发删除的模板丢弃临时配置
+    missing = []
+    while records:
+        failed = registry.update_many(records)
+        if not failed:
+            break
+        missing.extend(failed)
+        for name in failed:
+            _discard_rewrite(staged_records[name])
+        records = [(name, template) for name, template in records if name not in failed]
+    for name, template in records:
+        _commit_rewrite(name, old_templates[name], template, staged_records[name])
+    if missing:
+        raise ValueError(f"Template does not exist: {', '.join(missing)}")
+    if errors:
+        raise errors[0]
+    return [name for name, template in records if template != old_templates[name]]
+
+
+def get_template(name, version=None):
     """
     @brief  获取项目模板
 
-    @param name 项目模板名称
+    @param name    项目模板名称
+    @param version 模板版本号，None 表示当前版本
     """
-    if not os.path.exists(DATABASE_FILE):
-        save_write_json(DATABASE_FILE, {})
-    database = save_read_json(DATABASE_FILE)
-    if name not in database:
+    template = get_registry().get(name)
+    if template is None:
         raise ValueError(f"Template does not exist: {name}")
     
-    config_file = database[name]["config_file"]
-    project_dir = database[name]["project_dir"]
-    config = save_read_json(config_file)
+    config_file = template["config_file"]
+    project_dir = template["project_dir"]
+    if version is None or version == template.get("version", 1):
+        config = read_config(config_file)
+    else:
+        config = read_history_config(history_file_path(template["location"], name), version)
+        if config is None:
+            raise ValueError(f"Template version does not exist: {name}@{version}")
     
     return project_dir, config
 
 
+def list_template_versions(name):
+    """
+    @brief  列出项目模板的所有版本号
+
+    @param name 项目模板名称
+    @return 从旧到新排列的版本号列表，最后一个为当前版本
+    """
+    template = get_registry().get(name)
+    if template is None:
+        raise ValueError(f"Template does not exist: {name}")
+
+    version = template.get("version", 1)
+    versions = history_versions(history_file_path(template["location"], name))
+    if version not in versions:
+        versions.append(version)
+    return versions
+
+
+class TemplateHandle:
+    """
+    @brief      项目模板的延迟加载句柄
+    @details    名称、项目模板路径、参数和条目数量从注册表中读取，不需要读取模板配置文件；
+                条目和文件内容在第一次访问时才从配置文件中读取。历史版本的句柄在打开时已经还原了条目，
+                文件内容以内容哈希表示，在访问时才读取
+    """
+
+    def __init__(self, name, template, version=None, config=None):
+        """
+        @param name     项目模板名称
+        @param template 注册表中的模板记录
+        @param version  模板版本号，None 表示当前版本
+        @param config   历史版本的模板配置，文件内容可以以内容哈希 blob 表示，当前版本为 None
+        """
+        self.name = name
+        self.project_dir = template["project_dir"]
+        self.location = template["location"]
+        self.config_file = template["config_file"]
+        self.version = template.get("version", 1) if version is None else version
+        self._args = template.get("args", None)
+        self._entry_count = template.get("entry_count", None)
+        self._entries = None
+        self._config = config
+        self._loaded = None
+        if config is not None:
+            self._args = config["args"]
+            self._entry_count = len(config["dirs_and_files"])
+
+    @property
+    def args(self):
+        """
+        @brief  模板参数
+        """
+        if self._args is None:
+            self._args = read_config_args(self.config_file)
+        return self._args
+
+    @property
+    def entry_count(self):
+        """
+        @brief  模板中文件和目录的数量
+        """
+        if self._entry_count is None:
+            self._entry_count = len(self.entries)
+        return self._entry_count
+
+    @property
+    def entries(self):
+        """
+        @brief  模板中的文件和目录，不包含文件内容，content 均为 None
+        """
+        if self._entries is None:
+            if self._config is not None:
+                self._entries = [
+                    dict({key: value for key, value in dir_or_file.items() if key != "blob"}, content=None)
+                    for dir_or_file in self._config["dirs_and_files"]
+                ]
+            else:
+                self._entries = read_config_meta(self.config_file)["dirs_and_files"]
+        return self._entries
+
+    def entry(self, index):
+        """
+        @brief  读取单个条目，包括文件内容
+
+        @param index 条目在 dirs_and_files 中的位置
+        """
+        if self._config is not None:
+            return resolve_config_entry(self._config["dirs_and_files"][index])
+        return read_config_entry(self.config_file, index)
+
+    def refs(self):
+        """
+        @brief  读取模板中的文件和目录，json 格式和历史版本中的文件内容以内容哈希 blob 表示，不读取文件内容，
+                需要时使用 resolve_config_entry 读取单个条目的内容；pack 格式的条目包含 content
+        """
+        if self._config is not None:
+            return self._config["dirs_and_files"]
+        return read_config_refs(self.config_file).get("dirs_and_files", [])
+
+    def load(self):
+        """
+        @brief  读取完整的模板配置，包括所有文件的内容，格式与 get_template 返回的配置相同
+        """
+        if self._loaded is None:
+            if self._config is None:
+                self._loaded = read_config(self.config_file)
+            else:
+                self._loaded = {
+                    "dirs_and_files": [resolve_config_entry(dir_or_file) for dir_or_file in self._config["dirs_and_files"]],
+                    "args": self._config["args"],
+                }
+        return self._loaded
+
+
+def open_template(name, version=None):
+    """
+    @brief  打开项目模板，只读取注册表中的记录，模板内容按需加载
+
+    @param name    项目模板名称
+    @param version 模板版本号，None 表示当前版本
+    @return TemplateHandle
+    """
+    template = get_registry().get(name)
+    if template is None:
+        raise ValueError(f"Template does not exist: {name}")
+    if version is None or version == template.get("version", 1):
+        return TemplateHandle(name, template)
+
+    # 历史版本只还原条目，文件内容在访问时才读取
+    config = read_history_config(history_file_path(template["location"], name), version, resolve=False)
+    if config is None:
+        raise ValueError(f"Template version does not exist: {name}@{version}")
+    return TemplateHandle(name, template, version, config)
+
+
+def list_templates():
+    """
+    @brief  列出所有项目模板，只读取注册表，不读取任何模板配置文件
+
+    @return TemplateHandle 列表
+    """
+    return [TemplateHandle(name, template) for name, template in get_registry().items()]
+
+
 def list_template_names():
     """
     @brief  列出所有项目模板名称
     """
-    if not os.path.exists(DATABASE_FILE):
-        save_write_json(DATABASE_FILE, {})
-    database = save_read_json(DATABASE_FILE)
-    names = list(database.keys())
+    names = get_registry().names()
     return names
 
 
@@ -145,49 +617,41 @@ def generate_template(project_dir, template_dir, rules: dict):
 
     ignore_files = rules.get("ignore_files", [])
     rules = rules.get("rules", [])
-    
-    dirs_and_files = scan_directory(project_dir, ignore_files)
+
+    # 所有规则编译为一个替换函数，每条路径和每个文件的内容只需要扫描一遍
+    replacements = {}
+    for rule in rules:
+        value_name = rule.get("value_name", None)
+        if value_name is None or value_name in replacements:
+            continue
+
+        default_value = rule.get("default_value", None)
+        if default_value is None:
+            replacements[value_name] = f"#{{{value_name}}}"
+        else:
+            replacements[value_name] = f"#{{{value_name}:{default_value}}}"
+    replace = compile_replacements(replacements)
+
+    dirs_and_files = iter_directory(project_dir, ignore_files)
 
     for dir_or_file in dirs_and_files:
         name = dir_or_file["name"]
         type_ = dir_or_file["type"]
         root = dir_or_file["root"]
-        mode = dir_or_file["mode"]
         content = dir_or_file["content"]
 
-        file_path = os.path.join(root, name)
+        file_path = replace(os.path.join(root, name))
 
         if type_ == "file":
-            for rule in rules:
-                value_name = rule.get("value_name", None)
-                if value_name is None:
-                    continue
-
-                default_value = rule.get("default_value", None)
-                if default_value is None:
-                    replace_name = f"#{{{value_name}}}"
-                else:
-                    replace_name = f"#{{{value_name}:{default_value}}}"
-                file_path = file_path.replace(value_name, replace_name)
-                content = content.replace(value_name, replace_name)
-            
+            binary = dir_or_file.get("binary", False)
+            if not binary:
+                content = replace(content)
+
             new_file_path = os.path.join(template_dir, file_path)
-            with open(new_file_path, "w") as f:
+            with open(new_file_path, "wb" if binary else "w") as f:
                 f.write(content)
 
         elif type_ == "dir":
-            for rule in rules:
-                value_name = rule.get("value_name", None)
-                if value_name is None:
-                    continue
-                
-                default_value = rule.get("default_value", None)
-                if default_value is None:
-                    replace_name = f"#{{{value_name}}}"
-                else:
-                    replace_name = f"#{{{value_name}:{default_value}}}"
-                file_path = file_path.replace(value_name, replace_name)
-            
             new_dir_path = os.path.join(template_dir, file_path)
             os.makedirs(new_dir_path, exist_ok=True)
 
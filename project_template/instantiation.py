@@ -1,26 +1,158 @@
+import io
 import os
-from project_template.database import get_template
-from project_template.util import is_directory_empty, format_string
+import json
+import hashlib
+import functools
+import stat
+import time
+import tarfile
+import zipfile
+import posixpath
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+from project_template.constants import CONFIG_CACHE_SIZE, RENDER_MANIFEST_FILE, RENDER_CACHE_SIZE
+from project_template.database import open_template
+from project_template.blobs import blob_path, blob_session
+from project_template.render_cache import render_cache_key, render_path, read_render, write_render
+from project_template.scan import relative_path
+from project_template.storage import file_signature, resolve_config_entry
+from project_template.util import (
+    is_directory_empty, clone_file, save_write_json, save_read_json, scan_arg_spans, compile_spans, render_plan,
+)
 
-def instantiate_project(name, project_dir, args):
+
+def _compile_entry(dir_or_file):
     """
-    @brief  实例化项目
+    @brief      将模板条目编译为渲染计划，路径和文件内容分别编译
+    @details    二进制文件和不包含参数的文本文件不需要渲染：内容已经保存在 BLOB_DIR 中时记录其路径 source，实例化时直接复制文件；
+                否则预先编码为字节 data，实例化时直接写入。文件内容的 sha256 哈希记录在 digest 中，文件内容使用的参数名称记录在
+                content_args 中，用于比较模板更新前后的条目
+    """
+    root = dir_or_file["root"]
+    name = dir_or_file["name"]
+    content = dir_or_file["content"]
 
-    @param name         项目模板名称
-    @param project_dir  项目目录
-    @param args         配置参数
+    spans = dir_or_file.get("spans", None)
+    if spans is None:
+        # 旧的模板配置中没有保存参数位置，编译时扫描一次
+        spans = {
+            "root": [[start, end, arg["name"]] for start, end, arg in scan_arg_spans(root)],
+            "name": [[start, end, arg["name"]] for start, end, arg in scan_arg_spans(name)],
+        }
+        if isinstance(content, str):
+            spans["content"] = [[start, end, arg["name"]] for start, end, arg in scan_arg_spans(content)]
+
+    entry = {
+        "type": dir_or_file["type"],
+        "mode": dir_or_file["mode"],
+        "root": compile_spans(root, spans.get("root", None)),
+        "name": compile_spans(name, spans.get("name", None)),
+        "content": None,
+        "content_args": [],
+        "source": None,
+        "data": None,
+        "digest": None,
+    }
+    if content is None:
+        return entry
+
+    data = content if isinstance(content, bytes) else content.encode("utf-8")
+    entry["digest"] = hashlib.sha256(data).hexdigest()
+    if spans.get("content", None):
+        entry["content"] = compile_spans(content, spans["content"])
+        entry["content_args"] = entry["content"][1]
+        return entry
+
+    source = blob_path(entry["digest"])
+    if os.path.exists(source):
+        entry["source"] = source
+    else:
+        entry["data"] = data
+    return entry
+
+
+def _compile_ref(dir_or_file):
+    """
+    @brief      编译以内容哈希 blob 表示的条目，不读取文件内容
+    @details    只编译路径，digest 直接使用内容哈希，content_args 使用保存的参数位置，与 _compile_entry 的结果计算出相同的
+                _entry_digest。需要渲染或者内容不在 BLOB_DIR 中的文件保留原始条目 ref，写入前使用 _load_ref 读取内容；
+                没有内容哈希或者参数位置的条目直接读取内容后编译
+
+    @param dir_or_file read_config_refs 或者 TemplateHandle.refs 返回的条目
+    """
+    spans = dir_or_file.get("spans", None)
+    if "blob" not in dir_or_file or spans is None:
+        return _compile_entry(resolve_config_entry(dir_or_file))
+
+    content_spans = spans.get("content", None) or []
+    entry = {
+        "type": dir_or_file["type"],
+        "mode": dir_or_file["mode"],
+        "root": compile_spans(dir_or_file["root"], spans.get("root", None)),
+        "name": compile_spans(dir_or_file["name"], spans.get("name", None)),
+        "content": None,
+        "content_args": [name for _, _, name in content_spans],
+        "source": None,
+        "data": None,
+        "digest": dir_or_file["blob"],
+    }
+    source = blob_path(entry["digest"])
+    if not content_spans and os.path.exists(source):
+        entry["source"] = source
+    else:
+        entry["ref"] = dir_or_file
+    return entry
+
+
+def _load_ref(entry):
+    """
+    @brief  读取 _compile_ref 编译的条目的文件内容，返回可以直接写入的条目
+    """
+    if "ref" not in entry:
+        return entry
+    return _compile_entry(resolve_config_entry(entry["ref"]))
+
+
+# 已编译的渲染计划，(配置文件, 文件签名, 版本号) -> (args, entries)，按最近使用顺序排列
+_RENDER_PLANS = OrderedDict()
+_RENDER_PLANS_LOCK = threading.Lock()
+
+
+def get_render_plan(name, version=None):
+    """
+    @brief      获取项目模板的渲染计划
+    @details    每个条目的路径和文件内容被编译为文本片段和参数名称的列表，实例化时每个字符串只需要一次拼接。
+                渲染计划按模板版本缓存在进程内，最多保留 CONFIG_CACHE_SIZE 个，多次实例化同一个模板时直接复用；
+                模板配置文件被改写后重新编译。条目以内容哈希编译，只读取包含参数的文件的内容，
+                不包含参数的文件直接从 BLOB_DIR 复制，不读取、也不重新计算哈希
+
+    @param name    项目模板名称
+    @param version 模板版本号，None 表示当前版本
+    @return (args, entries)，args 为模板参数，entries 为编译后的条目列表
+    """
+    template = open_template(name, version)
+    key = (template.config_file, file_signature(template.config_file), template.version)
+    with _RENDER_PLANS_LOCK:
+        plan = _RENDER_PLANS.get(key, None)
+        if plan is not None:
+            _RENDER_PLANS.move_to_end(key)
+            return plan
+
+    plan = (template.args, [_load_ref(_compile_ref(dir_or_file)) for dir_or_file in template.refs()])
+    if CONFIG_CACHE_SIZE > 0:
+        with _RENDER_PLANS_LOCK:
+            _RENDER_PLANS[key] = plan
+            while len(_RENDER_PLANS) > CONFIG_CACHE_SIZE:
+                _RENDER_PLANS.popitem(last=False)
+    return plan
+
+
+def _resolve_args(expected_args, args):
+    """
+    @brief  根据模板参数和默认值确定实例化使用的参数，缺少必填参数时抛出 ValueError
     """
-    _, configs = get_template(name)
-    
-    if not os.path.exists(project_dir):
-        os.makedirs(project_dir)
-    elif not os.path.isdir(project_dir):
-        raise ValueError(f"Project directory {project_dir} is not a directory")
-    elif not is_directory_empty(project_dir):
-        raise ValueError(f"Project directory {project_dir} is not empty, which may rewrite the existing files.")
-    
-    expected_args = configs.get("args", None)
     final_args = {}
     for arg in expected_args:
         name = arg["name"]
@@ -33,32 +165,519 @@ def instantiate_project(name, project_dir, args):
             final_args[name] = default
         else:
             final_args[name] = args[name]
-    
-    dirs_and_files = configs.get("dirs_and_files", [])
-    for dir_or_file in dirs_and_files:
-        name = dir_or_file["name"]
-        type_ = dir_or_file["type"]
-        root = dir_or_file["root"]
-        mode = dir_or_file["mode"]
-        content = dir_or_file["content"]
-
-        path = os.path.join(project_dir, root, name)
-        path = format_string(path, args)
-        if content is not None:
-            content_lines = content.split("\n")
-            for i in range(len(content_lines)):
-                content_lines[i] = format_string(content_lines[i], args)
-            content = "\n".join(content_lines)
-
-        if type_ == "file":
-            with open(path, "w") as f:
-                f.write(content)
-        elif type_ == "dir":
+    return final_args
+
+
+def _prepare_project_dir(project_dir):
+    """
+    @brief  创建项目目录，目录已存在且不为空时抛出 ValueError
+    """
+    if not os.path.exists(project_dir):
+        os.makedirs(project_dir)
+    elif not os.path.isdir(project_dir):
+        raise ValueError(f"Project directory {project_dir} is not a directory")
+    elif not is_directory_empty(project_dir):
+        raise ValueError(f"Project directory {project_dir} is not empty, which may rewrite the existing files.")
+
+
+def _entry_path(entry, final_args):
+    """
+    @brief  渲染条目相对于项目目录的路径
+    """
+    return os.path.join(render_plan(entry["root"], final_args), render_plan(entry["name"], final_args))
+
+
+def _write_file(path, entry, final_args):
+    """
+    @brief  渲染并写入文件，创建文件后直接通过文件描述符设置权限模式
+    @return 写入内容的 sha256 哈希
+    """
+    if entry["source"] is not None:
+        try:
+            clone_file(entry["source"], path, entry["mode"])
+            return entry["digest"]
+        except FileNotFoundError:
+            # 渲染缓存中的内容可能已经被淘汰，重新渲染
+            if entry["content"] is None:
+                raise
+
+    with open(path, "wb") as f:
+        os.fchmod(f.fileno(), entry["mode"])
+        if entry["data"] is not None:
+            f.write(entry["data"])
+            return entry["digest"]
+        data = render_plan(entry["content"], final_args).encode("utf-8")
+        f.write(data)
+        return hashlib.sha256(data).hexdigest()
+
+
+def _materialize(entries, project_dir, final_args, max_workers):
+    """
+    @brief      并发地生成项目中的目录和文件
+    @details    先按顺序创建所有目录，再由线程池渲染并写入文件，最后从内向外设置目录的权限模式，
+                只读的目录不会影响其中文件的写入
+    @return     每个条目写入内容的 sha256 哈希，目录为 None，顺序与 entries 相同
+    """
+    directories = []
+    files = []
+    for index, entry in enumerate(entries):
+        path = os.path.join(project_dir, _entry_path(entry, final_args))
+        if entry["type"] == "dir":
             os.makedirs(path)
+            directories.append((path, entry["mode"]))
+        elif entry["type"] == "file":
+            files.append((index, path, entry))
         else:
-            raise TypeError(f"Invalid type: {type_}")
-        
+            raise TypeError(f"Invalid type: {entry['type']}")
+
+    hashes = [None] * len(entries)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(index, executor.submit(_write_file, path, entry, final_args)) for index, path, entry in files]
+        for index, future in futures:
+            hashes[index] = future.result()
+
+    for path, mode in reversed(directories):
         os.chmod(path, mode)
+    return hashes
+
+
+def _entry_digest(entry, final_args):
+    """
+    @brief  计算条目的渲染摘要，条目的类型、权限模式、路径、内容以及其使用的参数值都不变时摘要不变
+    """
+    names = set(entry["root"][1]) | set(entry["name"][1]) | set(entry["content_args"])
+    payload = [
+        entry["type"], entry["mode"], entry["root"], entry["name"], entry["digest"],
+        sorted((name, str(final_args.get(name, None))) for name in names),
+    ]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _manifest_key(entry, final_args):
+    """
+    @brief  渲染后条目在渲染清单中的键，为以 / 分隔的相对路径
+    """
+    return relative_path(render_plan(entry["root"], final_args), render_plan(entry["name"], final_args))
+
+
+def _write_render_manifest(project_dir, template_info, final_args, records):
+    """
+    @brief  将渲染清单写入项目根目录
+
+    @param template_info {"template": 模板名称, "version": 模板版本号}
+    @param records       渲染后的相对路径 -> {"type", "digest", "hash"}
+    """
+    manifest = dict(template_info)
+    manifest["args"] = final_args
+    manifest["entries"] = records
+    save_write_json(os.path.join(project_dir, RENDER_MANIFEST_FILE), manifest)
+
+
+def _plan_digest(expected_args, entries):
+    """
+    @brief  计算渲染计划对应的模板内容的哈希，模板的参数、条目的路径、权限模式和内容都不变时哈希不变
+    """
+    payload = [expected_args, [[entry["type"], entry["mode"], entry["root"], entry["name"], entry["digest"]] for entry in entries]]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _cached_entries(expected_args, entries, final_args):
+    """
+    @brief      使用渲染缓存替换需要渲染的文件条目
+    @details    缓存命中时，需要渲染的文件改为从渲染缓存中复制。不包含参数的文件已经直接从 BLOB_DIR 复制，不保存在渲染缓存中
+    @return     (entries, key)，缓存未命中时 key 为缓存键，项目生成之后使用 _save_render 保存渲染结果，否则为 None
+    """
+    rendered = [position for position, entry in enumerate(entries) if entry["content"] is not None]
+    if RENDER_CACHE_SIZE <= 0 or not rendered:
+        return entries, None
+
+    key = render_cache_key(_plan_digest(expected_args, entries), final_args)
+    digests = read_render(key)
+    if digests is None or set(digests) != set(rendered):
+        return entries, key
+
+    entries = list(entries)
+    for position in rendered:
+        entries[position] = dict(entries[position], source=render_path(key, digests[position]), digest=digests[position])
+    return entries, None
+
+
+def _save_render(key, entries, project_dir, final_args, hashes):
+    """
+    @brief  将项目中已经写入的渲染结果复制到渲染缓存，总大小超过 RENDER_CACHE_SIZE 时不保存
+
+    @param hashes 每个条目写入内容的 sha256 哈希，顺序与 entries 相同
+    """
+    outputs = {
+        position: (os.path.join(project_dir, _entry_path(entry, final_args)), hashes[position])
+        for position, entry in enumerate(entries) if entry["content"] is not None
+    }
+    write_render(key, outputs, RENDER_CACHE_SIZE)
+
+
+def _instantiate(expected_args, entries, project_dir, args, max_workers, template_info=None):
+    """
+    @brief  根据渲染计划实例化项目，template_info 不为 None 时写入渲染清单
+    """
+    final_args = _resolve_args(expected_args, args)
+    _prepare_project_dir(project_dir)
+    planned, cache_key = _cached_entries(expected_args, entries, final_args)
+
+    if max_workers is not None:
+        hashes = _materialize(planned, project_dir, final_args, max_workers)
+    else:
+        hashes = []
+        for entry in planned:
+            type_ = entry["type"]
+            mode = entry["mode"]
+            path = os.path.join(project_dir, _entry_path(entry, final_args))
+
+            if type_ == "file":
+                hashes.append(_write_file(path, entry, final_args))
+            elif type_ == "dir":
+                os.makedirs(path)
+                os.chmod(path, mode)
+                hashes.append(None)
+            else:
+                raise TypeError(f"Invalid type: {type_}")
+
+    if cache_key is not None:
+        _save_render(cache_key, entries, project_dir, final_args, hashes)
+
+    if template_info is not None:
+        records = {}
+        for entry, output_hash in zip(entries, hashes):
+            records[_manifest_key(entry, final_args)] = {
+                "type": entry["type"],
+                "digest": _entry_digest(entry, final_args),
+                "hash": output_hash,
+            }
+        _write_render_manifest(project_dir, template_info, final_args, records)
+
+
+def _pinned_plan(name, version, track):
+    """
+    @brief  获取渲染计划，track 为 True 时固定模板版本，渲染清单中记录的版本与渲染计划一致
+    @return (渲染计划, template_info)，track 为 False 时 template_info 为 None
+    """
+    if not track:
+        return get_render_plan(name, version), None
+    version = open_template(name, version).version
+    return get_render_plan(name, version), {"template": name, "version": version}
+
+
+def instantiate_project(name, project_dir, args, version=None, max_workers=None, track=False):
+    """
+    @brief  实例化项目
+
+    @param name         项目模板名称
+    @param project_dir  项目目录
+    @param args         配置参数
+    @param version      模板版本号，None 表示当前版本
+    @param max_workers  并发写入文件的线程数，None 表示按顺序逐个创建
+    @param track        是否在项目根目录写入渲染清单 RENDER_MANIFEST_FILE，模板更新后可以使用 sync_project 同步项目
+    """
+    # 实例化期间持有内容存储的共享锁，渲染计划引用的内容不会被回收
+    with blob_session():
+        (expected_args, entries), template_info = _pinned_plan(name, version, track)
+        _instantiate(expected_args, entries, project_dir, args, max_workers, template_info)
+
+
+def _is_modified(path, record):
+    """
+    @brief  判断项目中的路径是否在实例化之后被修改过，不存在的路径视为未修改
+
+    @param path   文件或目录路径
+    @param record 渲染清单中的记录，None 表示该路径不是由模板生成的
+    """
+    if not os.path.lexists(path):
+        return False
+    if record is None:
+        return True
+    if record["type"] == "dir":
+        return not os.path.isdir(path) or os.path.islink(path)
+    if not os.path.isfile(path) or os.path.islink(path):
+        return True
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest() != record["hash"]
+
+
+def sync_project(project_dir, args=None, version=None, force=False, max_workers=None):
+    """
+    @brief      根据实例化时写入的渲染清单，将项目同步到模板的指定版本
+    @details    只重新渲染摘要发生变化的条目，并删除新版本中已经不存在的条目，未变化的文件不会被读取或者改写，
+                同步的开销与模板的变化量成正比。实例化之后被修改过的文件、以及与项目中已有文件冲突的新条目不会被覆盖，
+                除非 force 为 True；不为空的目录不会被删除。冲突的条目保留原有记录，下次同步时重新处理
+
+    @param project_dir  使用 track=True 实例化的项目目录
+    @param args         覆盖或者补充的配置参数，未提供的参数使用渲染清单中记录的值，其次使用默认值
+    @param version      模板版本号，None 表示当前版本
+    @param force        是否覆盖被修改过的文件
+    @param max_workers  并发写入文件的线程数，None 表示按顺序逐个写入
+    @return {"written": [...], "removed": [...], "conflicts": [...], "unchanged": n}，列表中为以 / 分隔的相对路径
+    """
+    with blob_session():
+        manifest = save_read_json(os.path.join(project_dir, RENDER_MANIFEST_FILE))
+        if not manifest:
+            raise ValueError(f"Project directory {project_dir} has no render manifest {RENDER_MANIFEST_FILE}")
+
+        # 只编译条目的路径，文件内容以内容哈希比较，只有需要写入的条目才读取内容
+        name = manifest["template"]
+        template = open_template(name, version)
+        template_info = {"template": name, "version": template.version}
+        expected_args = template.args
+        entries = [_compile_ref(dir_or_file) for dir_or_file in template.refs()]
+        final_args = _resolve_args(expected_args, {**manifest["args"], **(args or {})})
+
+        old_records = manifest["entries"]
+        records = {}
+        result = {"written": [], "removed": [], "conflicts": [], "unchanged": 0}
+        directories = []
+        files = []
+        for entry in entries:
+            key = _manifest_key(entry, final_args)
+            digest = _entry_digest(entry, final_args)
+            old = old_records.get(key, None)
+            if old is not None and old["digest"] == digest:
+                records[key] = old
+                result["unchanged"] += 1
+                continue
+
+            path = os.path.join(project_dir, _entry_path(entry, final_args))
+            if not force and _is_modified(path, old if old is None or old["type"] == entry["type"] else None):
+                if old is not None:
+                    records[key] = old
+                result["conflicts"].append(key)
+                continue
+
+            record = {"type": entry["type"], "digest": digest, "hash": None}
+            records[key] = record
+            result["written"].append(key)
+            if entry["type"] == "dir":
+                if not os.path.isdir(path) and os.path.lexists(path):
+                    os.remove(path)
+                os.makedirs(path, exist_ok=True)
+                directories.append((path, entry["mode"]))
+            elif entry["type"] == "file":
+                if os.path.isdir(path) and not os.path.islink(path):
+                    raise ValueError(f"Cannot replace directory {path} with a file")
+                if os.path.lexists(path):
+                    # 删除后重新创建，只读文件也可以被替换
+                    os.remove(path)
+                files.append((path, _load_ref(entry), record))
+            else:
+                raise TypeError(f"Invalid type: {entry['type']}")
+
+        def write(path, entry, record):
+            record["hash"] = _write_file(path, entry, final_args)
+
+        if max_workers is None:
+            for path, entry, record in files:
+                write(path, entry, record)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(write, path, entry, record) for path, entry, record in files]
+                for future in futures:
+                    future.result()
+        for path, mode in reversed(directories):
+            os.chmod(path, mode)
+
+        kept = set(records) | set(result["conflicts"])
+        removed_dirs = []
+        for key, old in old_records.items():
+            if key in kept:
+                continue
+            path = os.path.join(project_dir, *key.split("/"))
+            if old["type"] == "dir":
+                removed_dirs.append((key, path))
+            elif not os.path.lexists(path):
+                continue
+            elif force or not _is_modified(path, old):
+                os.remove(path)
+                result["removed"].append(key)
+            else:
+                result["conflicts"].append(key)
+
+        for key, path in reversed(removed_dirs):
+            if not os.path.isdir(path):
+                continue
+            if is_directory_empty(path):
+                os.rmdir(path)
+                result["removed"].append(key)
+            else:
+                result["conflicts"].append(key)
+
+        _write_render_manifest(project_dir, template_info, final_args, records)
+        return result
+
+
+def _run_job(plan, project_dir, args, template_info=None):
+    """
+    @brief  实例化一个项目，返回错误或者 None
+    """
+    try:
+        _instantiate(*plan, project_dir, args, None, template_info)
+    except Exception as e:
+        return e
+    return None
+
+
+# 进程池中每个进程使用的渲染计划，由 _init_worker 设置
+_WORKER_PLAN = None
+
+
+def _init_worker(plan):
+    global _WORKER_PLAN
+    _WORKER_PLAN = plan
+
+
+def _run_worker_job(project_dir, args, template_info):
+    return _run_job(_WORKER_PLAN, project_dir, args, template_info)
+
+
+def instantiate_projects(name, jobs, version=None, max_workers=None, use_processes=False, track=False):
+    """
+    @brief      使用同一个模板批量实例化多个项目
+    @details    模板只读取和编译一次，所有项目共用同一个渲染计划。
+                每个项目单独实例化，一个项目失败不影响其他项目
+
+    @param name          项目模板名称
+    @param jobs          (项目目录, 配置参数) 列表
+    @param version       模板版本号，None 表示当前版本
+    @param max_workers   同时实例化的项目数量，None 表示按顺序逐个实例化
+    @param use_processes 是否使用进程池，False 时使用线程池，渲染计划在每个进程中只传递一次
+    @param track         是否在每个项目中写入渲染清单，参见 instantiate_project
+    @return (项目目录, 错误) 列表，顺序与 jobs 相同，成功时错误为 None，进程池损坏等错误同样记录在对应的项目中
+    """
+    with blob_session():
+        plan, template_info = _pinned_plan(name, version, track)
+        if max_workers is None:
+            return [(project_dir, _run_job(plan, project_dir, args, template_info)) for project_dir, args in jobs]
+
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(plan,))
+            run = _run_worker_job
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            run = functools.partial(_run_job, plan)
+
+        # 进程池损坏、参数无法序列化等错误同样只记录在对应项目的结果中，不影响其他项目
+        results = []
+        with executor:
+            futures = []
+            for project_dir, args in jobs:
+                try:
+                    futures.append(executor.submit(run, project_dir, args, template_info))
+                except Exception as e:
+                    futures.append(e)
+            for (project_dir, _), future in zip(jobs, futures):
+                if isinstance(future, Exception):
+                    results.append((project_dir, future))
+                    continue
+                try:
+                    results.append((project_dir, future.result()))
+                except Exception as e:
+                    results.append((project_dir, e))
+        return results
+
+
+# 支持的压缩包格式及其对应的 tarfile 流式写入模式，zip 使用 zipfile
+ARCHIVE_FORMATS = {
+    "tar": "w|",
+    "gztar": "w|gz",
+    "bztar": "w|bz2",
+    "xztar": "w|xz",
+    "zip": None,
+}
+
+
+def _archive_path(prefix, entry, final_args):
+    """
+    @brief  渲染条目在压缩包中的路径
+    """
+    return posixpath.normpath(posixpath.join(prefix, render_plan(entry["root"], final_args), render_plan(entry["name"], final_args)))
+
+
+def _entry_data(entry, final_args):
+    """
+    @brief  获取文件条目渲染后的字节内容
+    """
+    if entry["source"] is not None:
+        with open(entry["source"], "rb") as f:
+            return f.read()
+    if entry["data"] is not None:
+        return entry["data"]
+    return render_plan(entry["content"], final_args).encode("utf-8")
+
+
+def _write_tar(fileobj, mode, entries, final_args, prefix, mtime):
+    with tarfile.open(fileobj=fileobj, mode=mode) as archive:
+        for entry in entries:
+            info = tarfile.TarInfo(_archive_path(prefix, entry, final_args))
+            info.mode = stat.S_IMODE(entry["mode"])
+            info.mtime = mtime
+            if entry["type"] == "dir":
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            elif entry["type"] == "file" and entry["source"] is not None:
+                info.size = os.path.getsize(entry["source"])
+                with open(entry["source"], "rb") as f:
+                    archive.addfile(info, f)
+            elif entry["type"] == "file":
+                data = _entry_data(entry, final_args)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                raise TypeError(f"Invalid type: {entry['type']}")
+
+
+def _write_zip(fileobj, entries, final_args, prefix, mtime):
+    date_time = time.localtime(mtime)[:6]
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for entry in entries:
+            path = _archive_path(prefix, entry, final_args)
+            if entry["type"] == "dir":
+                info = zipfile.ZipInfo(f"{path}/", date_time)
+                # 高 16 位为 unix 权限模式，0x10 为 MS-DOS 的目录标志
+                info.external_attr = (stat.S_IFDIR | stat.S_IMODE(entry["mode"])) << 16 | 0x10
+                archive.writestr(info, b"")
+            elif entry["type"] == "file":
+                info = zipfile.ZipInfo(path, date_time)
+                info.external_attr = (stat.S_IFREG | stat.S_IMODE(entry["mode"])) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, _entry_data(entry, final_args))
+            else:
+                raise TypeError(f"Invalid type: {entry['type']}")
+
+
+def instantiate_archive(name, fileobj, args, version=None, archive_format="tar", prefix=""):
+    """
+    @brief      将项目直接实例化为 tar 或者 zip 压缩包
+    @details    条目逐个渲染后直接写入压缩包，不需要在磁盘上创建项目目录。
+                压缩包以流的方式写入，fileobj 可以是不支持 seek 的对象，如管道、socket 或者 HTTP 响应，
+                写入完成后 fileobj 不会被关闭
+
+    @param name             项目模板名称
+    @param fileobj          写入压缩包的二进制文件对象
+    @param args             配置参数
+    @param version          模板版本号，None 表示当前版本
+    @param archive_format   压缩包格式，tar、gztar、bztar、xztar 或者 zip
+    @param prefix           压缩包中所有条目的上级目录，空字符串表示放在压缩包根目录
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Invalid archive format: {archive_format}")
+
+    with blob_session():
+        expected_args, entries = get_render_plan(name, version)
+        final_args = _resolve_args(expected_args, args)
+        mtime = int(time.time())
+        if archive_format == "zip":
+            _write_zip(fileobj, entries, final_args, prefix, mtime)
+        else:
+            _write_tar(fileobj, ARCHIVE_FORMATS[archive_format], entries, final_args, prefix, mtime)
 
 
 def main():
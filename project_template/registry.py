@@ -0,0 +1,362 @@
+import os
+import copy
+import json
+import sqlite3
+import contextlib
+import threading
+
+from project_template.constants import DATABASE_FILE, REGISTRY_DB_FILE, REGISTRY_BACKEND
+from project_template.util import file_lock, save_write_json, save_read_json
+from project_template.storage import file_signature
+
+
+__all__ = ["JsonRegistry", "SqliteRegistry", "get_registry"]
+
+
+class JsonRegistry:
+    """
+    @brief      基于 json 文件的模板注册表
+    @details    所有模板记录保存在一个 json 文件中，每次写入都会重写整个文件。
+                解析后的内容缓存在进程内，每次访问时比较文件的 mtime_ns、inode 和 size，
+                文件被其他进程改写后重新读取。写入时先写临时文件再整体替换，读取不需要加锁；
+                添加、更新和删除在 <database_file>.lock 上加锁，并发的读取-修改-写入不会丢失更新
+    """
+
+    def __init__(self, database_file=DATABASE_FILE):
+        """
+        @param database_file json 数据库文件路径
+        """
+        self.database_file = database_file
+        self._lock = threading.Lock()
+        self._signature = None
+        self._database = None
+
+    def _load(self):
+        signature = file_signature(self.database_file)
+        with self._lock:
+            if signature is not None and signature == self._signature:
+                return self._database
+
+        if signature is None:
+            # 数据库文件在第一次添加模板时创建
+            return {}
+
+        database = save_read_json(self.database_file)
+        with self._lock:
+            # 读取期间文件被改写时不缓存，下次访问重新读取
+            if file_signature(self.database_file) == signature:
+                self._signature = signature
+                self._database = database
+        return database
+
+    def _write_lock(self):
+        os.makedirs(os.path.dirname(self.database_file), exist_ok=True)
+        return file_lock(self.database_file)
+
+    def _save(self, database):
+        save_write_json(self.database_file, database)
+        with self._lock:
+            self._signature = file_signature(self.database_file)
+            self._database = database
+        return database
+
+    def get(self, name):
+        """
+        @brief  获取模板记录
+
+        @param name 项目模板名称
+        @return 模板记录，不存在时返回 None
+        """
+        return copy.deepcopy(self._load().get(name, None))
+
+    def names(self):
+        """
+        @brief  列出所有模板名称，按添加顺序排列
+        """
+        return list(self._load().keys())
+
+    def items(self):
+        """
+        @brief  列出所有模板名称及其记录
+        """
+        return copy.deepcopy(list(self._load().items()))
+
+    def add(self, name, record):
+        """
+        @brief  添加模板记录
+
+        @param name   项目模板名称
+        @param record 模板记录
+        @return 是否添加成功，模板已存在时返回 False
+        """
+        with self._write_lock():
+            database = dict(self._load())
+            if name in database:
+                return False
+            database[name] = copy.deepcopy(record)
+            self._save(database)
+            return True
+
+    def update(self, name, record):
+        """
+        @brief  更新模板记录
+
+        @param name   项目模板名称
+        @param record 模板记录
+        @return 是否更新成功，模板不存在时返回 False
+        """
+        with self._write_lock():
+            database = dict(self._load())
+            if name not in database:
+                return False
+            database[name] = copy.deepcopy(record)
+            self._save(database)
+            return True
+
+    def add_many(self, records):
+        """
+        @brief  批量添加模板记录，只写入一次数据库文件
+
+        @param records (项目模板名称, 模板记录) 列表
+        @return 已经存在的模板名称列表，不为空时不添加任何记录
+        """
+        with self._write_lock():
+            database = dict(self._load())
+            existing = [name for name, _ in records if name in database]
+            if existing:
+                return existing
+            for name, record in records:
+                database[name] = copy.deepcopy(record)
+            self._save(database)
+            return []
+
+    def update_many(self, records):
+        """
+        @brief  批量更新模板记录，只写入一次数据库文件
+
+        @param records (项目模板名称, 模板记录) 列表
+        @return 不存在的模板名称列表，不为空时不更新任何记录
+        """
+        with self._write_lock():
+            database = dict(self._load())
+            missing = [name for name, _ in records if name not in database]
+            if missing:
+                return missing
+            for name, record in records:
+                database[name] = copy.deepcopy(record)
+            self._save(database)
+            return []
+
+    def remove(self, name):
+        """
+        @brief  删除模板记录
+
+        @param name 项目模板名称
+        @return 被删除的模板记录，模板不存在时返回 None
+        """
+        with self._write_lock():
+            database = dict(self._load())
+            if name not in database:
+                return None
+            record = database.pop(name)
+            self._save(database)
+            return record
+
+
+class SqliteRegistry:
+    """
+    @brief      基于 sqlite3 的模板注册表
+    @details    使用 WAL 模式，读操作之间以及读写操作之间互不阻塞，写操作在事务中完成，
+                模板名称为主键，查找单个模板不需要读取整个注册表。
+                首次创建数据库时，导入已有 json 数据库中的模板记录
+    """
+
+    def __init__(self, database_file=REGISTRY_DB_FILE, json_database_file=DATABASE_FILE, timeout=30.0):
+        """
+        @param database_file        sqlite 数据库文件路径
+        @param json_database_file   需要导入的 json 数据库文件路径，None 表示不导入
+        @param timeout              等待其他进程释放写锁的秒数
+        """
+        self.database_file = database_file
+        self.json_database_file = json_database_file
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+
+        os.makedirs(os.path.dirname(self.database_file), exist_ok=True)
+        connection = sqlite3.connect(self.database_file, timeout=self.timeout, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with _transaction(connection):
+            created = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'templates'"
+            ).fetchone() is None
+            if created:
+                connection.execute("CREATE TABLE templates (name TEXT PRIMARY KEY, record TEXT NOT NULL)")
+                self._import_json(connection)
+        self._local.connection = connection
+        return connection
+
+    def _import_json(self, connection):
+        if self.json_database_file is None or not os.path.exists(self.json_database_file):
+            return
+        database = save_read_json(self.json_database_file)
+        connection.executemany(
+            "INSERT INTO templates (name, record) VALUES (?, ?)",
+            [(name, json.dumps(record, ensure_ascii=False)) for name, record in database.items()],
+        )
+
+    def get(self, name):
+        """
+        @brief  获取模板记录
+
+        @param name 项目模板名称
+        @return 模板记录，不存在时返回 None
+        """
+        row = self._connect().execute("SELECT record FROM templates WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def names(self):
+        """
+        @brief  列出所有模板名称，按添加顺序排列
+        """
+        rows = self._connect().execute("SELECT name FROM templates ORDER BY rowid").fetchall()
+        return [row[0] for row in rows]
+
+    def items(self):
+        """
+        @brief  列出所有模板名称及其记录
+        """
+        rows = self._connect().execute("SELECT name, record FROM templates ORDER BY rowid").fetchall()
+        return [(name, json.loads(record)) for name, record in rows]
+
+    def add(self, name, record):
+        """
+        @brief  添加模板记录
+
+        @param name   项目模板名称
+        @param record 模板记录
+        @return 是否添加成功，模板已存在时返回 False
+        """
+        connection = self._connect()
+        with _transaction(connection):
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO templates (name, record) VALUES (?, ?)",
+                (name, json.dumps(record, ensure_ascii=False)),
+            )
+            return cursor.rowcount == 1
+
+    def update(self, name, record):
+        """
+        @brief  更新模板记录
+
+        @param name   项目模板名称
+        @param record 模板记录
+        @return 是否更新成功，模板不存在时返回 False
+        """
+        connection = self._connect()
+        with _transaction(connection):
+            cursor = connection.execute(
+                "UPDATE templates SET record = ? WHERE name = ?",
+                (json.dumps(record, ensure_ascii=False), name),
+            )
+            return cursor.rowcount == 1
+
+    def add_many(self, records):
+        """
+        @brief  批量添加模板记录，在一个事务中完成
+
+        @param records (项目模板名称, 模板记录) 列表
+        @return 已经存在的模板名称列表，不为空时不添加任何记录
+        """
+        connection = self._connect()
+        with _transaction(connection):
+            existing = [name for name, _ in records if self._exists(connection, name)]
+            if existing:
+                return existing
+            connection.executemany(
+                "INSERT INTO templates (name, record) VALUES (?, ?)",
+                [(name, json.dumps(record, ensure_ascii=False)) for name, record in records],
+            )
+            return []
+
+    def update_many(self, records):
+        """
+        @brief  批量更新模板记录，在一个事务中完成
+
+        @param records (项目模板名称, 模板记录) 列表
+        @return 不存在的模板名称列表，不为空时不更新任何记录
+        """
+        connection = self._connect()
+        with _transaction(connection):
+            missing = [name for name, _ in records if not self._exists(connection, name)]
+            if missing:
+                return missing
+            connection.executemany(
+                "UPDATE templates SET record = ? WHERE name = ?",
+                [(json.dumps(record, ensure_ascii=False), name) for name, record in records],
+            )
+            return []
+
+    @staticmethod
+    def _exists(connection, name):
+        return connection.execute("SELECT 1 FROM templates WHERE name = ?", (name,)).fetchone() is not None
+
+    def remove(self, name):
+        """
+        @brief  删除模板记录
+
+        @param name 项目模板名称
+        @return 被删除的模板记录，模板不存在时返回 None
+        """
+        connection = self._connect()
+        with _transaction(connection):
+            row = connection.execute("SELECT record FROM templates WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM templates WHERE name = ?", (name,))
+            return json.loads(row[0])
+
+
+@contextlib.contextmanager
+def _transaction(connection):
+    """
+    @brief  在 sqlite 连接上开启一个写事务，正常退出时提交，出现异常时回滚
+
+    @param connection sqlite 连接
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+_REGISTRIES = {}
+
+
+def get_registry(backend=None):
+    """
+    @brief  获取模板注册表
+
+    @param backend 注册表后端，json 或者 sqlite，None 时使用 REGISTRY_BACKEND
+    @return 注册表对象，同一进程中相同后端返回同一个对象
+    """
+    if backend is None:
+        backend = REGISTRY_BACKEND
+    if backend not in _REGISTRIES:
+        if backend == "json":
+            _REGISTRIES[backend] = JsonRegistry()
+        elif backend == "sqlite":
+            _REGISTRIES[backend] = SqliteRegistry()
+        else:
+            raise ValueError(f"Invalid registry backend: {backend}")
+    return _REGISTRIES[backend]
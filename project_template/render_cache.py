@@ -0,0 +1,144 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from project_template.constants import RENDER_CACHE_DIR
+from project_template.util import atomic_write, clone_file, file_lock, save_write_json, save_read_json
+
+
+__all__ = ["render_cache_key", "render_path", "read_render", "write_render", "clear_render_cache"]
+
+
+# 缓存索引文件名称，内容为 {key: {"size": 字节数}}，只在保存缓存项时更新
+RENDER_INDEX_FILE = "index.json"
+
+# 每个缓存项中记录条目序号与内容哈希对应关系的文件名称，其修改时间为缓存项最近使用的时间
+RENDER_META_FILE = "meta.json"
+
+
+def render_cache_key(template_digest, final_args):
+    """
+    @brief  计算渲染缓存的键
+
+    @param template_digest 模板内容的哈希
+    @param final_args      实例化使用的参数，参数值统一转换为字符串后按名称排序
+    @return 缓存键
+    """
+    canonical_args = json.dumps(sorted((name, str(value)) for name, value in final_args.items()), ensure_ascii=False)
+    return hashlib.sha256(f"{template_digest}\n{canonical_args}".encode("utf-8")).hexdigest()
+
+
+def render_path(key, digest, cache_dir=RENDER_CACHE_DIR):
+    """
+    @brief  获取缓存的渲染内容的路径
+
+    @param key       缓存键
+    @param digest    渲染内容的 sha256 哈希
+    @param cache_dir 渲染缓存目录
+    """
+    return os.path.join(cache_dir, key, digest)
+
+
+def read_render(key, cache_dir=RENDER_CACHE_DIR):
+    """
+    @brief      查找缓存项，并将其标记为最近使用
+    @details    只更新缓存项中 RENDER_META_FILE 的修改时间，不需要加锁，也不改写索引文件
+
+    @param key       缓存键
+    @param cache_dir 渲染缓存目录
+    @return 条目序号 -> 渲染内容的 sha256 哈希，缓存不存在时返回 None
+    """
+    meta_file = os.path.join(cache_dir, key, RENDER_META_FILE)
+    meta = save_read_json(meta_file)
+    if not meta:
+        return None
+
+    try:
+        os.utime(meta_file)
+    except FileNotFoundError:
+        # 缓存项刚刚被淘汰
+        return None
+    return {int(position): digest for position, digest in meta.items()}
+
+
+def _last_used(key, cache_dir):
+    """
+    @brief  缓存项最近使用的时间，缓存项不存在时为 0
+    """
+    try:
+        return os.stat(os.path.join(cache_dir, key, RENDER_META_FILE)).st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def write_render(key, outputs, max_size, cache_dir=RENDER_CACHE_DIR):
+    """
+    @brief      将已经写入的渲染结果复制到渲染缓存，并按最近使用时间淘汰缓存，使总大小不超过 max_size
+    @details    先检查文件的总大小，超过 max_size 的渲染结果不会被保存，也不会被读取。文件先复制到临时目录，
+                再整体重命名为缓存项，读取方只会看到完整的缓存项
+
+    @param key       缓存键
+    @param outputs   条目序号 -> (已经写入的文件路径, 文件内容的 sha256 哈希)
+    @param max_size  渲染缓存占用的磁盘空间上限（字节）
+    @param cache_dir 渲染缓存目录
+    @return 是否保存了缓存项
+    """
+    size = sum(os.path.getsize(path) for path, _ in outputs.values())
+    if size > max_size or os.path.exists(os.path.join(cache_dir, key)):
+        return False
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+    try:
+        meta = {}
+        for position, (path, digest) in outputs.items():
+            cached = os.path.join(temp_dir, digest)
+            if not os.path.exists(cached):
+                clone_file(path, cached, 0o644)
+            meta[position] = digest
+        with atomic_write(os.path.join(temp_dir, RENDER_META_FILE)) as f:
+            json.dump(meta, f)
+
+        index_file = os.path.join(cache_dir, RENDER_INDEX_FILE)
+        with file_lock(index_file):
+            try:
+                os.rename(temp_dir, os.path.join(cache_dir, key))
+            except OSError:
+                # 其他进程已经保存了相同的缓存项
+                return False
+            index = save_read_json(index_file)
+            index[key] = {"size": size}
+            total = sum(item["size"] for item in index.values())
+            for evicted in sorted(index, key=lambda item: _last_used(item, cache_dir)):
+                if total <= max_size:
+                    break
+                if evicted == key:
+                    continue
+                shutil.rmtree(os.path.join(cache_dir, evicted), ignore_errors=True)
+                total -= index.pop(evicted)["size"]
+            save_write_json(index_file, index)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+    return True
+
+
+def clear_render_cache(cache_dir=RENDER_CACHE_DIR):
+    """
+    @brief  清空渲染缓存
+
+    @param cache_dir 渲染缓存目录
+    """
+    if not os.path.exists(cache_dir):
+        return
+    index_file = os.path.join(cache_dir, RENDER_INDEX_FILE)
+    with file_lock(index_file):
+        for name in os.listdir(cache_dir):
+            if name in (RENDER_INDEX_FILE, f"{RENDER_INDEX_FILE}.lock"):
+                continue
+            path = os.path.join(cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+        save_write_json(index_file, {})
@@ -1,12 +1,304 @@
 import os
+import mmap
+import codecs
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from project_template.util import scan_args_for_string, whether_ignore_file
+from project_template.constants import MMAP_THRESHOLD
+from project_template.blobs import write_blob
+from project_template.util import scan_arg_spans, compile_ignore_patterns, decode_text, buffer_has_args
 
 
-__all__ = ["scan_directory", "scan_args"]
+__all__ = ["scan_directory", "iter_directory", "scan_args", "iter_scan_args", "reduce_args", "relative_path"]
 
 
-def scan_directory(directory: str, ignore_files: list):
+def relative_path(root: str, name: str):
+    """
+    @brief  获取条目相对于项目根目录的路径，作为条目在 manifest 中的键
+
+    @param root 条目所在目录，相对于项目根目录
+    @param name 条目名称
+    @return 以 / 分隔的相对路径
+    """
+    if root == ".":
+        return name
+    return f"{root.replace(os.sep, '/')}/{name}"
+
+
+def _stat_entry(entry: os.DirEntry, type_: str, previous: tuple = None, mmap_threshold: int = MMAP_THRESHOLD, store_blobs: bool = False):
+    """
+    @brief      获取单个文件或目录的权限模式、内容以及 manifest 记录
+    @details    previous 中记录的 size、mtime_ns、inode 与当前文件一致时，直接复用之前的条目而不读取文件；
+                读取后内容哈希与之前一致时，同样复用之前的条目。
+                不小于 mmap_threshold 的文件使用内存映射读取，直接在映射上计算哈希并用字节正则检查是否包含参数。
+                前缀中包含 NUL 字节或者不是 utf-8 编码的文件作为二进制文件，不完整解码，也不复制字节内容。
+                store_blobs 为 True 时，二进制文件以及不包含参数、不需要转换换行符的文本文件直接从映射写入内容存储，
+                content 为 None；只有包含参数的文件才解码
+
+    @param entry            文件或目录对应的 DirEntry, 复用其缓存的 stat 结果
+    @param type_            类型, file或者dir
+    @param previous         之前扫描得到的 (条目, manifest 记录)，可为 None
+    @param mmap_threshold   使用内存映射读取的最小文件大小
+    @param store_blobs      是否将不包含参数的大文件直接写入内容存储
+    @return (mode, content, record, reused_entry, has_args, digest, binary), 目录的 content 和 record 为 None，
+            二进制文件的 content 为 bytes，未复用时 reused_entry 为 None，has_args 为 False 表示文件内容中确定不包含参数，None 表示未知，
+            digest 为 content 编码后的 sha256 哈希，content 与文件的字节不一致（例如转换了换行符）时为 None，
+            content 为 None 且 digest 不为 None 时内容已经写入内容存储；binary 表示是否为二进制文件
+    """
+    stat = entry.stat()
+    if type_ != "file":
+        return stat.st_mode, None, None, None, None, None, False
+
+    record = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+    }
+    if previous is not None:
+        previous_entry, previous_record = previous
+        if all(previous_record.get(key) == value for key, value in record.items()):
+            return stat.st_mode, previous_entry.get("content", None), dict(previous_record), previous_entry, None, None, previous_entry.get("binary", False)
+
+    def reuse_by_hash():
+        if previous is None or previous_record.get("hash") != record["hash"]:
+            return False
+        if "args" in previous_record:
+            record["args"] = previous_record["args"]
+        return True
+
+    if stat.st_size > 0 and stat.st_size >= mmap_threshold:
+        with open(entry.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            record["hash"] = hashlib.sha256(mapping).hexdigest()
+            if reuse_by_hash():
+                return stat.st_mode, previous_entry.get("content", None), record, previous_entry, None, None, previous_entry.get("binary", False)
+            has_args = buffer_has_args(mapping)
+            binary = _has_binary_prefix(mapping)
+            if not binary and (has_args or not store_blobs):
+                try:
+                    content = decode_text(mapping)
+                except UnicodeDecodeError:
+                    binary = True
+                else:
+                    digest = record["hash"] if mapping.find(b"\r") == -1 else None
+                    return stat.st_mode, content, record, None, (None if has_args else False), digest, False
+            elif not binary:
+                binary = not _is_utf8(mapping)
+
+            # 二进制文件和不包含参数的文本文件直接从映射写入内容存储，使用已经计算的哈希
+            if store_blobs and (binary or mapping.find(b"\r") == -1):
+                write_blob(mapping, digest=record["hash"])
+                return stat.st_mode, None, record, None, False, record["hash"], binary
+            content = bytes(mapping) if binary else decode_text(mapping)
+        return stat.st_mode, content, record, None, False, (record["hash"] if binary else None), binary
+
+    with open(entry.path, "rb") as f:
+        data = f.read()
+    record["hash"] = hashlib.sha256(data).hexdigest()
+    if reuse_by_hash():
+        return stat.st_mode, previous_entry.get("content", None), record, previous_entry, None, None, previous_entry.get("binary", False)
+
+    content = data if _has_binary_prefix(data) else _decode_content(data)
+    binary = isinstance(content, bytes)
+    digest = record["hash"] if binary or b"\r" not in data else None
+    return stat.st_mode, content, record, None, (False if binary else None), digest, binary
+
+
+# 判断二进制文件时检查的前缀长度，前缀中包含 NUL 字节的文件直接作为二进制文件，与 git 的判断方式相同
+_BINARY_PREFIX_SIZE = 8000
+
+
+def _has_binary_prefix(buffer):
+    """
+    @brief  检查内容的前缀中是否包含 NUL 字节，不需要解码，也不需要读取整个文件
+    """
+    return buffer.find(b"\0", 0, _BINARY_PREFIX_SIZE) != -1
+
+
+def _is_utf8(buffer, chunk_size: int = 1 << 20):
+    """
+    @brief  逐块检查内容是否为合法的 utf-8 编码，不生成完整的字符串，内存占用不超过 chunk_size
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with memoryview(buffer) as view:
+        try:
+            for start in range(0, len(view), chunk_size):
+                decoder.decode(view[start:start + chunk_size])
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return False
+    return True
+
+
+def _decode_content(data):
+    """
+    @brief  将文件内容解码为字符串，不是 utf-8 编码的文件作为二进制文件，返回原始字节
+    """
+    try:
+        return decode_text(data)
+    except UnicodeDecodeError:
+        return bytes(data)
+
+
+def _walk_directory(directory: str, whether_ignore, root: str = None):
+    """
+    @brief      遍历目录，按 os.walk 的顺序依次返回未被忽略的文件和目录
+    @details    基于 os.scandir 实现，被忽略的目录在进入之前即被剪枝，其中的文件不会再被遍历和匹配。
+                与 os.walk 一样，不会进入指向目录的符号链接
+
+    @param directory        目录的绝对路径
+    @param whether_ignore   compile_ignore_patterns 编译得到的匹配函数
+    @param root             当前遍历的目录，None 表示从 directory 开始
+    @return 生成器，每次返回 (name, type, relative_root, entry)
+    """
+    if root is None:
+        root = directory
+
+    try:
+        with os.scandir(root) as scandir_it:
+            entries = list(scandir_it)
+    except OSError:
+        return
+
+    files = []
+    dirs = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            dirs.append(entry)
+        else:
+            files.append(entry)
+
+    relative_root = os.path.relpath(root, directory)
+    if relative_root == ".":
+        prefix = ""
+    else:
+        prefix = relative_root.replace(os.sep, "/") + "/"
+
+    for entry in files:
+        if whether_ignore(prefix + entry.name, False):
+            continue
+        yield entry.name, "file", relative_root, entry
+
+    sub_dirs = []
+    for entry in dirs:
+        if whether_ignore(prefix + entry.name, True):
+            continue
+        yield entry.name, "dir", relative_root, entry
+        sub_dirs.append(entry)
+
+    for entry in sub_dirs:
+        if entry.is_symlink():
+            continue
+        yield from _walk_directory(directory, whether_ignore, entry.path)
+
+
+def iter_directory(directory: str, ignore_files: list = None, max_workers: int = None, manifest: dict = None, previous: dict = None,
+                   mmap_threshold: int = MMAP_THRESHOLD, store_blobs: bool = False):
+    """
+    @brief      逐个扫描目录中的文件和目录
+    @details    返回条目的格式和顺序与 scan_directory 相同，但每次只生成一个条目，
+                内存占用只取决于单个文件的大小。并发读取时最多同时持有 2 * max_workers 个未消费的结果。
+                指定 manifest 时，每个文件的 size、mtime_ns、inode 和内容哈希以相对路径为键写入 manifest；
+                指定 previous 时，未发生变化的文件直接复用之前的条目，不再读取；
+                之前的条目以内容哈希 blob 表示时，复用的条目同样只包含 blob，content 为 None。
+                store_blobs 为 True 时，文件内容与文件的字节一致的条目同时记录扫描时计算的内容哈希 blob，
+                write_config 写入内容存储时不再重新计算哈希；不小于 mmap_threshold 且不包含参数的文件直接从内存映射写入内容存储，
+                条目只包含 blob，content 为 None，因此需要在 blob_session 中消费生成器
+
+    @param directory    目录路径
+    @param ignore_files 忽略的文件列表，采用 gitignore 语义，参考 compile_ignore_patterns
+    @param max_workers  并发读取文件的线程数，None 或者 1 表示串行读取
+    @param manifest     用于收集文件 manifest 记录的字典，可为 None
+    @param previous     相对路径到之前扫描得到的 (条目, manifest 记录) 的映射，可为 None
+    @param mmap_threshold 使用内存映射读取的最小文件大小
+    @param store_blobs  条目是否将写入内容存储
+    @return 生成器，依次返回目录中的文件和目录
+    """
+    if not os.path.exists(directory):
+        raise ValueError(f"Directory does not exist: {directory}")
+    if not os.path.isdir(directory):
+        raise ValueError(f"Not a directory: {directory}")
+
+    if ignore_files is None:
+        ignore_files = []
+    if previous is None:
+        previous = {}
+
+    directory = os.path.abspath(directory)
+    whether_ignore = compile_ignore_patterns(ignore_files)
+    return _iter_entries(_walk_directory(directory, whether_ignore), max_workers, manifest, previous, mmap_threshold, store_blobs)
+
+
+def _iter_entries(pending, max_workers: int, manifest: dict, previous: dict, mmap_threshold: int, store_blobs: bool = False):
+    """
+    @brief  读取 pending 中每一项的权限模式和内容，按原顺序生成条目
+
+    @param pending      (name, type, relative_root, entry) 迭代器
+    @param max_workers  并发读取文件的线程数
+    @param manifest     用于收集文件 manifest 记录的字典，可为 None
+    @param previous     相对路径到之前扫描得到的 (条目, manifest 记录) 的映射
+    @param mmap_threshold 使用内存映射读取的最小文件大小
+    @param store_blobs  条目是否将写入内容存储，参考 iter_directory
+    @return 生成器，依次返回条目
+    """
+    def read(item):
+        name, type_, relative_root, entry = item
+        return _stat_entry(entry, type_, previous.get(relative_path(relative_root, name)), mmap_threshold, store_blobs)
+
+    def to_entry(item, result):
+        name, type_, relative_root, _ = item
+        mode, content, record, reused_entry, has_args, digest, binary = result
+        dir_or_file = {
+            "name": name,
+            "type": type_,
+            "root": relative_root,
+            "mode": mode,
+            "content": content,
+        }
+        if binary:
+            # 二进制文件不解码，也不扫描其中的参数
+            dir_or_file["binary"] = True
+        if reused_entry is not None and content is None and "blob" in reused_entry:
+            # 复用之前保存的内容哈希，不读取内容
+            dir_or_file["blob"] = reused_entry["blob"]
+        elif digest is not None and (store_blobs or content is None):
+            # 内容已经直接写入内容存储，或者与文件的字节一致，写入内容存储时直接使用扫描时计算的哈希
+            dir_or_file["blob"] = digest
+        if reused_entry is not None and "arguments" in reused_entry and "spans" in reused_entry:
+            dir_or_file["arguments"] = list(reused_entry["arguments"])
+            dir_or_file["spans"] = reused_entry["spans"]
+        elif has_args is False:
+            # 文件内容中确定不包含参数，只需扫描 root 和 name
+            entry_args = _scan_entry_args(dir_or_file, content_spans=[])
+            if record is not None:
+                record["args"] = _record_args(entry_args)
+        if manifest is not None and record is not None:
+            manifest[relative_path(relative_root, name)] = record
+        return dir_or_file
+
+    if max_workers is None or max_workers <= 1:
+        for item in pending:
+            yield to_entry(item, read(item))
+        return
+
+    # 使用有界的 future 队列，按提交顺序取回结果，保证输出顺序与串行扫描一致
+    window = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in pending:
+            window.append((item, executor.submit(read, item)))
+            if len(window) >= 2 * max_workers:
+                item, future = window.popleft()
+                yield to_entry(item, future.result())
+        while window:
+            item, future = window.popleft()
+            yield to_entry(item, future.result())
+
+
+def scan_directory(directory: str, ignore_files: list = None, max_workers: int = None):
     """
     @brief      扫描目录
     @details    扫描目录中的所有文件和目录，并返回，格式如下
@@ -19,6 +311,14 @@ def scan_directory(directory: str, ignore_files: list):
             "mode":     "file_mode",    # 文件的权限模式
             "content":  "file_content", # 文件的内容
         },
+        {
+            "name":     "image.png",    # 不是 utf-8 编码的文件作为二进制文件
+            "type":     "file",
+            "root":     "file_path",
+            "mode":     "file_mode",
+            "content":  b"...",         # 二进制文件的内容为原始字节，不解码
+            "binary":   True,           # 只有二进制文件包含该字段
+        },
         {
             "name":     "dir_name",     # 目录名, basename   
             "type":     "dir",          # 目录类型, directory
@@ -28,68 +328,15 @@ def scan_directory(directory: str, ignore_files: list):
         },
     ]
     ```
+    指定 max_workers 时，使用线程池并发执行 stat 和文件读取，返回结果及其顺序与串行扫描完全一致
+    需要逐个处理条目以控制内存占用时，使用 iter_directory
 
-    @param directory 目录路径
-    @param ignore_files 忽略的文件列表
+    @param directory    目录路径
+    @param ignore_files 忽略的文件列表，采用 gitignore 语义，参考 compile_ignore_patterns
+    @param max_workers  并发读取文件的线程数，None 或者 1 表示串行读取
     @return 目录中的所有文件和目录
     """
-    if not os.path.exists(directory):
-        raise ValueError(f"Directory does not exist: {directory}")
-    if not os.path.isdir(directory):
-        raise ValueError(f"Not a directory: {directory}")
-
-    directory = os.path.abspath(directory)
-    dirs_and_files = []
-
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            name = file
-            type_ = "file"
-            relative_root = os.path.relpath(root, directory)
-            path = os.path.join(root, file)
-
-            to_continue = False
-            for ignore_file in ignore_files:
-                if whether_ignore_file(path, ignore_file):
-                    to_continue = True
-                    break
-            if to_continue:
-                continue
-
-            file_mode = os.stat(path).st_mode
-            with open(path, "r") as f:
-                content = f.read()
-            dirs_and_files.append({
-                "name": name,
-                "type": type_,
-                "root": relative_root,
-                "mode": file_mode,
-                "content": content,
-            })
-        for dir in dirs:
-            name = dir
-            type_ = "dir"
-            relative_root = os.path.relpath(root, directory)
-            path = os.path.join(root, dir)
-
-            to_continue = False
-            for ignore_file in ignore_files:
-                if whether_ignore_file(path, ignore_file):
-                    to_continue = True
-                    break
-            if to_continue:
-                continue
-
-            dir_mode = os.stat(path).st_mode
-            dirs_and_files.append({
-                "name": name,
-                "type": type_,
-                "root": relative_root,
-                "mode": dir_mode,
-                "content": None,
-            })
-
-    return dirs_and_files
+    return list(iter_directory(directory, ignore_files, max_workers))
 
 
 def print_dirs_and_files(dirs_and_files: list):
@@ -192,6 +439,128 @@ def filter_args(args: list):
     return args
 
 
+def _scan_entry_args(directory_or_file: dict, content_spans: list = None):
+    """
+    @brief      扫描单个文件或目录中的参数
+    @details    将参数名称列表写入条目的 arguments 字段，并将参数在 root、name、content 中的位置写入 spans 字段，
+                格式为 {"root": [[start, end, name], ...], "name": [...], "content": [...]}，不包含参数的字段省略，
+                实例化时根据 spans 直接拼接，不需要再次进行正则匹配
+
+    @param  directory_or_file 文件或目录条目
+    @param  content_spans     已知的文件内容中的参数位置，None 表示需要扫描文件内容
+    @return 参数列表，包含参数名称、默认值、参数类型以及参数所在位置
+    """
+    name = directory_or_file.get("name", None)
+    root = directory_or_file.get("root", None)
+    content = directory_or_file.get("content", None)
+
+    root_spans = scan_arg_spans(root)
+    name_spans = scan_arg_spans(name)
+    if content_spans is None:
+        content_spans = []
+        if isinstance(content, str):
+            content_spans = scan_arg_spans(content)
+    name_args = [arg for _, _, arg in name_spans]
+    content_args = [arg for _, _, arg in content_spans]
+
+    dir_or_file_args = []
+    for arg in name_args + content_args:
+        arg_name = arg["name"]
+        dir_or_file_args.append(arg_name)
+    directory_or_file["arguments"] = dir_or_file_args
+
+    spans = {}
+    for key, key_spans in (("root", root_spans), ("name", name_spans), ("content", content_spans)):
+        if len(key_spans) > 0:
+            spans[key] = [[start, end, arg["name"]] for start, end, arg in key_spans]
+    directory_or_file["spans"] = spans
+
+    args = []
+    for arg in name_args:
+        arg_name = arg["name"]
+        arg_default_value = arg["default_value"]
+        arg_type = "file_name"
+
+        arg = {
+            "name": arg_name,
+            "default_value": arg_default_value,
+            "type": arg_type,
+            "root": root,
+        }
+        args.append(arg)
+    for arg in content_args:
+        arg_name = arg["name"]
+        arg_default_value = arg["default_value"]
+        arg_type = "file_content"
+
+        arg = {
+            "name": arg_name,
+            "default_value": arg_default_value,
+            "type": arg_type,
+            "root": root,
+        }
+        args.append(arg)
+    return args
+
+
+def _record_args(entry_args: list):
+    """
+    @brief  将条目的参数转换为 manifest 记录中保存的形式，去掉与条目重复的 root 字段
+
+    @param  entry_args _scan_entry_args 返回的参数列表
+    @return manifest 记录中的参数列表
+    """
+    return [
+        {
+            "name": arg["name"],
+            "default_value": arg["default_value"],
+            "type": arg["type"],
+        }
+        for arg in entry_args
+    ]
+
+
+def iter_scan_args(directories_and_files, args: list, manifest: dict = None):
+    """
+    @brief      逐个扫描条目中的参数
+    @details    为每个条目写入 arguments 字段后立即返回该条目，扫描到的参数追加到 args 中，
+                全部条目消费完后，使用 reduce_args(args) 得到最终的参数列表。
+                指定 manifest 时，文件的参数同时记录在其 manifest 记录的 args 字段中，
+                已有 args 记录且条目已包含 arguments 和 spans 的文件不再重复扫描
+
+    @param  directories_and_files 文件和目录条目的迭代器
+    @param  args                  用于收集参数的列表
+    @param  manifest              iter_directory 收集的 manifest，可为 None
+    @return 生成器，依次返回写入 arguments 后的条目
+    """
+    for directory_or_file in directories_and_files:
+        record = None
+        if manifest is not None and directory_or_file["type"] == "file":
+            record = manifest.get(relative_path(directory_or_file["root"], directory_or_file["name"]))
+
+        if record is not None and "args" in record and "arguments" in directory_or_file and "spans" in directory_or_file:
+            root = directory_or_file["root"]
+            args.extend(dict(arg, root=root) for arg in record["args"])
+        else:
+            entry_args = _scan_entry_args(directory_or_file)
+            args.extend(entry_args)
+            if record is not None:
+                record["args"] = _record_args(entry_args)
+        yield directory_or_file
+
+
+def reduce_args(args: list):
+    """
+    @brief  检查参数冲突并过滤重复参数
+
+    @param  args 所有条目中扫描到的参数
+    @return 过滤后的参数列表
+    @throw  RuntimeError 参数名称冲突
+    """
+    check_args(args)
+    return filter_args(args)
+
+
 def scan_args(directories_and_files: list):
     """
     @brief      扫描目录中的参数
@@ -201,54 +570,9 @@ def scan_args(directories_and_files: list):
     @return 所有参数
     """
     args = []
-    for directory_or_file in directories_and_files:
-        dir_or_file_args = []
-        name = directory_or_file.get("name", None)
-        root = directory_or_file.get("root", None)
-        content = directory_or_file.get("content", None)
-
-        name_args = scan_args_for_string(name)
-        content_args = []
-        if content is not None:
-            content_lines = content.split("\n")
-            for line in content_lines:
-                line_args = scan_args_for_string(line)
-                content_args.extend(line_args)
-
-        dir_or_file_args = []
-        for arg in name_args + content_args:
-            arg_name = arg["name"]
-            dir_or_file_args.append(arg_name)
-        directory_or_file["arguments"] = dir_or_file_args
-
-        for arg in name_args:
-            arg_name = arg["name"]
-            arg_default_value = arg["default_value"]
-            arg_type = "file_name"
-
-            arg = {
-                "name": arg_name,
-                "default_value": arg_default_value,
-                "type": arg_type,
-                "root": root,
-            }
-            args.append(arg)
-        for arg in content_args:
-            arg_name = arg["name"]
-            arg_default_value = arg["default_value"]
-            arg_type = "file_content"
-
-            arg = {
-                "name": arg_name,
-                "default_value": arg_default_value,
-                "type": arg_type,
-                "root": root,
-            }
-            args.append(arg)
-
-    check_args(args)
-    args = filter_args(args)
-    return args
+    for _ in iter_scan_args(directories_and_files, args):
+        pass
+    return reduce_args(args)
 
 
 def main():
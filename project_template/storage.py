@@ -0,0 +1,509 @@
+import os
+import copy
+import json
+import shutil
+import hashlib
+import zipfile
+import threading
+from collections import OrderedDict
+
+from project_template.constants import CONFIG_FORMAT, CONFIG_CACHE_SIZE
+from project_template.scan import relative_path
+from project_template.blobs import write_blob, read_blob, open_blob
+from project_template.util import atomic_write, file_lock, save_write_json, save_write_json_stream, save_read_json
+
+
+__all__ = [
+    "config_file_path", "config_temp_path", "commit_config", "config_format_of", "write_config", "read_config", "read_config_meta", "read_config_args", "read_config_entry",
+    "read_config_refs", "resolve_config_entry", "entry_ref", "config_blobs", "file_signature", "clear_config_cache",
+    "history_file_path", "append_history", "read_history_config", "history_versions", "history_blobs",
+]
+
+
+# 模板配置文件格式对应的扩展名
+CONFIG_EXTENSIONS = {
+    "json": ".json",
+    "pack": ".zip",
+}
+
+# 打包格式中保存元数据的成员名称
+PACK_META_MEMBER = "meta.json"
+
+# 打包格式版本
+PACK_VERSION = 1
+
+# 模板历史版本文件的后缀
+HISTORY_SUFFIX = ".history.json"
+
+# 已解析的模板配置，config_file -> (文件签名, 配置)，按最近使用顺序排列
+_CONFIG_CACHE = OrderedDict()
+_CONFIG_CACHE_LOCK = threading.Lock()
+
+
+def config_file_path(location_dir, name, config_format=None):
+    """
+    @brief  获取模板配置文件路径
+
+    @param location_dir  项目模板存放位置
+    @param name          项目模板名称
+    @param config_format 配置文件格式，json 或者 pack，None 时使用 CONFIG_FORMAT
+    @return 配置文件路径
+    """
+    if config_format is None:
+        config_format = CONFIG_FORMAT
+    if config_format not in CONFIG_EXTENSIONS:
+        raise ValueError(f"Invalid config format: {config_format}")
+    return os.path.join(location_dir, f"{name}{CONFIG_EXTENSIONS[config_format]}")
+
+
+def config_temp_path(config_file):
+    """
+    @brief  获取与配置文件位于同一目录、格式相同的唯一临时路径，配置写入临时路径后再通过 commit_config 替换配置文件
+
+    @param config_file 配置文件路径
+    @return 临时配置文件路径
+    """
+    directory, base_name = os.path.split(config_file)
+    name, extension = os.path.splitext(base_name)
+    return os.path.join(directory, f".{name}.{os.urandom(6).hex()}{extension}")
+
+
+def commit_config(temp_file, config_file):
+    """
+    @brief  使用临时配置文件原子地替换配置文件
+
+    @param temp_file   config_temp_path 返回的临时配置文件路径
+    @param config_file 配置文件路径
+    """
+    os.replace(temp_file, config_file)
+    clear_config_cache(temp_file)
+    clear_config_cache(config_file)
+
+
+def config_format_of(config_file):
+    """
+    @brief  根据扩展名获取配置文件格式
+
+    @param config_file 配置文件路径
+    @return json 或者 pack
+    """
+    if _is_pack(config_file):
+        return "pack"
+    return "json"
+
+
+def _is_pack(config_file):
+    return config_file.endswith(CONFIG_EXTENSIONS["pack"])
+
+
+def file_signature(file_path):
+    """
+    @brief      获取文件签名，用于判断文件是否被其他进程改写
+    @details    签名由 mtime_ns、inode 和 size 组成，任意一项变化都认为文件已被改写
+
+    @param file_path 文件路径
+    @return (mtime_ns, inode, size)，文件不存在时返回 None
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+
+def clear_config_cache(config_file=None):
+    """
+    @brief  清除进程内缓存的模板配置
+
+    @param config_file 配置文件路径，None 表示清除所有缓存
+    """
+    with _CONFIG_CACHE_LOCK:
+        if config_file is None:
+            _CONFIG_CACHE.clear()
+        else:
+            _CONFIG_CACHE.pop(config_file, None)
+
+
+def _get_cached_config(config_file):
+    signature = file_signature(config_file)
+    with _CONFIG_CACHE_LOCK:
+        cached = _CONFIG_CACHE.get(config_file, None)
+        if cached is None:
+            return signature, None
+        if cached[0] != signature:
+            del _CONFIG_CACHE[config_file]
+            return signature, None
+        _CONFIG_CACHE.move_to_end(config_file)
+        return signature, cached[1]
+
+
+def _put_cached_config(config_file, signature, config):
+    if CONFIG_CACHE_SIZE <= 0 or signature is None:
+        return
+    with _CONFIG_CACHE_LOCK:
+        _CONFIG_CACHE[config_file] = (signature, config)
+        _CONFIG_CACHE.move_to_end(config_file)
+        while len(_CONFIG_CACHE) > CONFIG_CACHE_SIZE:
+            _CONFIG_CACHE.popitem(last=False)
+
+
+def _store_blobs(dirs_and_files):
+    """
+    @brief  将文件内容保存到内容存储中，条目中的 content 替换为内容哈希 blob，已经以内容哈希表示的条目直接写入，
+            同时包含 content 和 blob 的条目使用已有的哈希，不再重新计算
+    """
+    for dir_or_file in dirs_and_files:
+        if dir_or_file.get("content", None) is None:
+            if "blob" in dir_or_file:
+                dir_or_file = {key: value for key, value in dir_or_file.items() if key != "content"}
+            yield dir_or_file
+            continue
+
+        entry = {}
+        for key, value in dir_or_file.items():
+            if key == "content":
+                entry["blob"] = write_blob(value if isinstance(value, bytes) else value.encode("utf-8"), digest=dir_or_file.get("blob", None))
+            elif key != "blob":
+                entry[key] = value
+        yield entry
+
+
+def write_config(config_file, dirs_and_files, tail=None):
+    """
+    @brief      流式写入模板配置文件
+    @details    json 格式的内容为 {"dirs_and_files": [...], **tail()}，文件内容保存在 BLOB_DIR 中，
+                条目中只保存内容哈希 blob，多个模板中相同的文件只保存一份，引用计数由调用方通过 config_blobs 维护。
+                pack 格式为 zip 文件，每个文件的内容单独压缩保存为 entries/<index>，
+                其余信息（条目的名称、权限模式、参数等以及 tail() 返回的字段）保存在 meta.json 中，
+                读取时可以只解压 meta.json 或者单个条目
+
+    @param config_file    配置文件路径，根据扩展名确定格式
+    @param dirs_and_files 文件和目录条目的迭代器，文件内容可以是 content，也可以是已经保存的内容哈希 blob
+    @param tail           返回其余字段的函数，在所有条目写入后调用，可为 None
+    @return 写入的条目数量
+    """
+    clear_config_cache(config_file)
+    if not _is_pack(config_file):
+        return save_write_json_stream(config_file, "dirs_and_files", _store_blobs(dirs_and_files), tail)
+
+    with atomic_write(config_file, "wb") as f:
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as pack:
+            entries = []
+            for index, dir_or_file in enumerate(dirs_and_files):
+                entry = {key: value for key, value in dir_or_file.items() if key not in ("content", "blob")}
+                content = dir_or_file.get("content", None)
+                if content is None and "blob" in dir_or_file:
+                    # 已经保存在内容存储中的文件流式写入，不整体读入内存
+                    member = f"entries/{index}"
+                    with open_blob(dir_or_file["blob"]) as source, pack.open(member, "w", force_zip64=True) as target:
+                        shutil.copyfileobj(source, target)
+                    entry["payload"] = member
+                elif content is not None:
+                    member = f"entries/{index}"
+                    pack.writestr(member, content if isinstance(content, bytes) else content.encode("utf-8"))
+                    entry["payload"] = member
+                entries.append(entry)
+
+            meta = {
+                "version": PACK_VERSION,
+                "dirs_and_files": entries,
+            }
+            if tail is not None:
+                meta.update(tail())
+            pack.writestr(PACK_META_MEMBER, json.dumps(meta, ensure_ascii=False))
+    return len(entries)
+
+
+def _read_pack_meta(pack):
+    meta = json.loads(pack.read(PACK_META_MEMBER))
+    if meta.pop("version", None) != PACK_VERSION:
+        raise ValueError(f"Unsupported template pack: {pack.filename}")
+    return meta
+
+
+def _read_raw_config(config_file):
+    """
+    @brief  读取配置文件中保存的原始信息，文件内容仍然以内容哈希或者 zip 成员名称表示
+    """
+    if not _is_pack(config_file):
+        return save_read_json(config_file)
+    with zipfile.ZipFile(config_file, "r") as pack:
+        return _read_pack_meta(pack)
+
+
+def _resolve_entry(entry, pack=None):
+    """
+    @brief  将条目中的内容哈希或者 zip 成员名称替换为文件内容，二进制文件的内容为 bytes
+    """
+    digest = entry.pop("blob", None)
+    member = entry.pop("payload", None)
+    if digest is not None:
+        data = read_blob(digest)
+    elif member is not None:
+        data = pack.read(member)
+    else:
+        entry.setdefault("content", None)
+        return entry
+
+    # 二进制文件保持原始字节，不解码
+    entry["content"] = data if entry.get("binary", False) else data.decode("utf-8")
+    return entry
+
+
+def _strip_entry(entry):
+    entry.pop("blob", None)
+    entry.pop("payload", None)
+    entry["content"] = None
+    return entry
+
+
+def read_config(config_file):
+    """
+    @brief      读取完整的模板配置，包括所有文件的内容
+    @details    解析后的配置缓存在进程内，最多保留 CONFIG_CACHE_SIZE 个，超出时淘汰最久未使用的配置。
+                每次读取时比较配置文件的签名，文件被其他进程改写后重新解析。
+                返回的是缓存的副本，调用方修改返回的配置不会影响之后的读取
+
+    @param config_file 配置文件路径
+    @return 模板配置，格式与 json 配置文件相同
+    """
+    signature, config = _get_cached_config(config_file)
+    if config is not None:
+        return copy.deepcopy(config)
+
+    if not _is_pack(config_file):
+        config = save_read_json(config_file)
+        for entry in config.get("dirs_and_files", []):
+            _resolve_entry(entry)
+    else:
+        with zipfile.ZipFile(config_file, "r") as pack:
+            config = _read_pack_meta(pack)
+            for entry in config["dirs_and_files"]:
+                _resolve_entry(entry, pack)
+
+    # 读取期间文件被改写时不缓存，下次读取重新解析
+    if file_signature(config_file) == signature:
+        _put_cached_config(config_file, signature, copy.deepcopy(config))
+    return config
+
+
+def read_config_refs(config_file):
+    """
+    @brief      读取模板配置，json 格式中的文件内容保持为内容哈希 blob，不读取 BLOB_DIR 中的内容
+    @details    json 格式直接解析配置文件，不使用、也不填充 read_config 的缓存，返回的条目总是以内容哈希表示。
+                pack 格式的内容保存在配置文件中，条目包含完整的 content。需要时使用 resolve_config_entry 读取单个条目的内容
+
+    @param config_file 配置文件路径
+    @return 模板配置
+    """
+    if _is_pack(config_file):
+        return read_config(config_file)
+    return save_read_json(config_file)
+
+
+def resolve_config_entry(entry):
+    """
+    @brief  读取以内容哈希表示的条目的内容
+
+    @param entry read_config_refs 返回的条目
+    @return 包含 content 的新条目
+    """
+    if "blob" not in entry:
+        return dict({"content": None}, **entry)
+    return _resolve_entry(dict(entry))
+
+
+def entry_ref(entry):
+    """
+    @brief  将条目转换为以内容哈希表示的形式，用于比较条目而不需要比较文件内容
+
+    @param entry 包含 content 或者内容哈希 blob 的条目，同时包含两者时直接使用 blob
+    @return 不包含 content 的新条目，文件内容以 sha256 哈希 blob 表示，与 json 配置文件中保存的条目相同
+    """
+    ref = {key: value for key, value in entry.items() if key != "content"}
+    content = entry.get("content", None)
+    if content is not None and "blob" not in entry:
+        ref["blob"] = hashlib.sha256(content if isinstance(content, bytes) else content.encode("utf-8")).hexdigest()
+    return ref
+
+
+def read_config_meta(config_file):
+    """
+    @brief  读取模板配置中除文件内容以外的信息，不需要读取文件内容
+
+    @param config_file 配置文件路径
+    @return 模板配置，所有条目的 content 均为 None
+    """
+    _, config = _get_cached_config(config_file)
+    if config is not None:
+        meta = copy.deepcopy({key: value for key, value in config.items() if key != "dirs_and_files"})
+        meta["dirs_and_files"] = [
+            copy.deepcopy({key: value for key, value in entry.items() if key != "content"}) for entry in config.get("dirs_and_files", [])
+        ]
+        for entry in meta["dirs_and_files"]:
+            entry["content"] = None
+        return meta
+
+    config = _read_raw_config(config_file)
+    for entry in config.get("dirs_and_files", []):
+        _strip_entry(entry)
+    return config
+
+
+def read_config_args(config_file):
+    """
+    @brief  读取模板参数，不需要读取文件内容
+
+    @param config_file 配置文件路径
+    @return 参数列表
+    """
+    _, config = _get_cached_config(config_file)
+    if config is None:
+        return _read_raw_config(config_file).get("args", [])
+    return copy.deepcopy(config.get("args", []))
+
+
+def read_config_entry(config_file, index):
+    """
+    @brief  读取单个条目，只需要读取该条目的内容
+
+    @param config_file 配置文件路径
+    @param index       条目在 dirs_and_files 中的位置
+    @return 条目，包括文件的内容
+    """
+    _, config = _get_cached_config(config_file)
+    if config is not None:
+        return copy.deepcopy(config["dirs_and_files"][index])
+
+    if not _is_pack(config_file):
+        return _resolve_entry(save_read_json(config_file)["dirs_and_files"][index])
+    with zipfile.ZipFile(config_file, "r") as pack:
+        return _resolve_entry(_read_pack_meta(pack)["dirs_and_files"][index], pack)
+
+
+def config_blobs(config_file):
+    """
+    @brief  列出配置文件引用的内容哈希
+
+    @param config_file 配置文件路径
+    @return 内容哈希列表，每个引用的条目对应一项，pack 格式返回空列表
+    """
+    if _is_pack(config_file):
+        return []
+    return [entry["blob"] for entry in save_read_json(config_file).get("dirs_and_files", []) if "blob" in entry]
+
+
+def history_file_path(location_dir, name):
+    """
+    @brief  获取模板历史版本文件路径
+
+    @param location_dir  项目模板存放位置
+    @param name          项目模板名称
+    @return 历史版本文件路径
+    """
+    return os.path.join(location_dir, f"{name}{HISTORY_SUFFIX}")
+
+
+def _entry_key(entry):
+    return relative_path(entry["root"], entry["name"])
+
+
+def _record_blobs(record):
+    entries = record.get("dirs_and_files", record.get("changed", []))
+    return [entry["blob"] for entry in entries if "blob" in entry]
+
+
+def append_history(history_file, old_config, old_version, new_config, new_version):
+    """
+    @brief      在历史版本文件中记录模板的新版本
+    @details    历史版本文件的内容为 {"versions": [record, ...]}。第一个记录是完整的快照，
+                包含所有条目 dirs_and_files；之后的每个记录只保存相对上一个版本发生变化的条目 changed、
+                被删除条目的路径 removed，以及条目顺序变化时的完整路径列表 order。
+                文件内容都以内容哈希保存在 BLOB_DIR 中，历史版本之间相同的文件只保存一份。
+                历史版本文件不存在，或者最后一个版本不是 old_version 时，先写入 old_config 的完整快照。
+                读取和写入历史版本文件的过程在 <history_file>.lock 上加锁，并发的更新不会丢失版本
+
+    @param history_file 历史版本文件路径
+    @param old_config   更新前的模板配置
+    @param old_version  更新前的版本号
+    @param new_config   更新后的模板配置
+    @param new_version  更新后的版本号
+    @return 新增记录引用的内容哈希列表，由调用方添加引用
+    """
+    with file_lock(history_file):
+        history = save_read_json(history_file)
+        versions = history.setdefault("versions", [])
+        records = []
+        if len(versions) == 0 or versions[-1]["version"] != old_version:
+            records.append({
+                "version": old_version,
+                "args": old_config.get("args", []),
+                "dirs_and_files": list(_store_blobs(old_config["dirs_and_files"])),
+            })
+
+        # 按内容哈希比较条目，条目可以包含 content，也可以是已经保存的内容哈希 blob
+        old_entries = {_entry_key(entry): entry_ref(entry) for entry in old_config["dirs_and_files"]}
+        new_keys = [_entry_key(entry) for entry in new_config["dirs_and_files"]]
+        changed = [entry for entry in new_config["dirs_and_files"] if old_entries.get(_entry_key(entry), None) != entry_ref(entry)]
+        record = {
+            "version": new_version,
+            "args": new_config.get("args", []),
+            "changed": list(_store_blobs(changed)),
+            "removed": sorted(set(old_entries) - set(new_keys)),
+        }
+        if new_keys != list(old_entries):
+            record["order"] = new_keys
+        records.append(record)
+
+        versions.extend(records)
+        save_write_json(history_file, history)
+        return [digest for record in records for digest in _record_blobs(record)]
+
+
+def history_versions(history_file):
+    """
+    @brief  列出历史版本文件中记录的所有版本号
+
+    @param history_file 历史版本文件路径
+    @return 版本号列表，文件不存在时返回空列表
+    """
+    return [record["version"] for record in save_read_json(history_file).get("versions", [])]
+
+
+def read_history_config(history_file, version, resolve=True):
+    """
+    @brief  从历史版本文件中还原指定版本的模板配置
+
+    @param history_file 历史版本文件路径
+    @param version      版本号
+    @param resolve      是否读取文件内容，False 时条目中的文件内容保持为内容哈希 blob，参考 read_config_refs
+    @return 模板配置，包括 dirs_and_files 和 args，版本不存在时返回 None
+    """
+    entries = {}
+    for record in save_read_json(history_file).get("versions", []):
+        if "dirs_and_files" in record:
+            entries = {_entry_key(entry): entry for entry in record["dirs_and_files"]}
+        else:
+            for key in record["removed"]:
+                entries.pop(key, None)
+            for entry in record["changed"]:
+                entries[_entry_key(entry)] = entry
+            if "order" in record:
+                entries = {key: entries[key] for key in record["order"]}
+
+        if record["version"] == version:
+            return {
+                "dirs_and_files": [_resolve_entry(dict(entry)) if resolve else entry for entry in entries.values()],
+                "args": record["args"],
+            }
+    return None
+
+
+def history_blobs(history_file):
+    """
+    @brief  列出历史版本文件引用的内容哈希
+
+    @param history_file 历史版本文件路径
+    @return 内容哈希列表
+    """
+    return [digest for record in save_read_json(history_file).get("versions", []) for digest in _record_blobs(record)]
@@ -2,47 +2,214 @@ import os
 import re
 import json
 import fcntl
-import fnmatch
+import shutil
+import contextlib
 
 from project_template.constants import ARG_REGEX
 
 
 __all__ = [
-    "save_write_json", "save_read_json", "is_directory_empty", "scan_args_for_string", "format_string"
+    "atomic_write", "file_lock", "clone_file", "save_write_json", "save_write_json_stream", "save_read_json", "decode_text", "buffer_has_args", "is_directory_empty", "scan_args_for_string", "scan_arg_spans", "format_string", "compile_spans", "render_plan",
+    "compile_ignore_patterns", "compile_replacements",
 ]
 
 
-def save_write_json(file_path, content):
+# 新建文件的权限模式，创建时由系统按照 umask 过滤，与直接 open 创建文件时一致
+_DEFAULT_FILE_MODE = 0o666
+
+
+def _create_temp_file(file_path):
     """
-    @brief  将json内容写入文件，并确保写入操作是原子的
+    @brief  在目标文件所在目录中创建唯一的临时文件
+    @return (文件描述符, 临时文件路径)
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    while True:
+        temp_path = os.path.join(directory, f".{os.path.basename(file_path)}.{os.urandom(6).hex()}.tmp")
+        try:
+            return os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, _DEFAULT_FILE_MODE), temp_path
+        except FileExistsError:
+            continue
+
+
+@contextlib.contextmanager
+def atomic_write(file_path, mode="w", sync=True):
+    """
+    @brief      原子地写入文件
+    @details    内容先写入同一目录下的临时文件，fsync 后通过 os.replace 替换目标文件。
+                读取方只会看到旧文件或者完整的新文件，不需要加锁；写入失败时删除临时文件，目标文件保持不变
 
     @param file_path    文件路径
-    @param content      要写入的内容
+    @param mode         打开临时文件的模式，w 或者 wb
+    @param sync         是否 fsync 文件和目录，False 时只保证读取方看到完整的文件，由调用方负责持久化
+    @return 临时文件对象
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = _create_temp_file(file_path)
+    try:
+        with os.fdopen(fd, mode) as f:
+            try:
+                # 替换已有文件时保持其权限模式
+                os.fchmod(f.fileno(), os.stat(file_path).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if not sync:
+        return
+
+    # 确保目录项的修改也写入磁盘
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextlib.contextmanager
+def file_lock(file_path, shared=False):
     """
-    with open(file_path, "w") as f:
-        fcntl.flock(f, fcntl.LOCK_EX)
+    @brief      对文件的读取-修改-写入过程加锁
+    @details    锁加在单独的 <file_path>.lock 文件上，文件本身通过 atomic_write 替换，
+                因此只有写入方之间互斥，读取方不受影响
+
+    @param file_path 被保护的文件路径
+    @param shared    是否加共享锁，共享锁之间互不阻塞，只与排他锁互斥
+    """
+    with open(f"{file_path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
         try:
-            json.dump(content, f, indent=4, ensure_ascii=False)
+            yield
         finally:
             fcntl.flock(f, fcntl.LOCK_UN)
 
 
+# Linux 上克隆文件内容（reflink）的 ioctl 请求号
+_FICLONE = 0x40049409
+
+
+def clone_file(source, destination, mode):
+    """
+    @brief      复制文件内容，内容不经过 python 解释器
+    @details    依次尝试 reflink（FICLONE）、os.copy_file_range 和 os.sendfile，文件系统或者平台不支持时回退到下一种方式，
+                最后回退到 shutil.copyfileobj。不使用硬链接，目标文件的权限模式和后续修改不会影响源文件
+
+    @param source      源文件路径
+    @param destination 目标文件路径
+    @param mode        目标文件的权限模式
+    """
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        os.fchmod(dst.fileno(), mode)
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        try:
+            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+        remaining = os.fstat(src_fd).st_size
+        for copy in [getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)]:
+            if copy is None:
+                continue
+            try:
+                while remaining > 0:
+                    if copy is os.sendfile:
+                        copied = os.sendfile(dst_fd, src_fd, None, remaining)
+                    else:
+                        copied = copy(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError:
+                continue
+            if remaining == 0:
+                return
+            # 复制提前结束（例如源文件被截断或者文件系统只完成了部分复制），从当前位置继续复制剩余的内容
+            break
+        shutil.copyfileobj(src, dst)
+
+
+def save_write_json(file_path, content):
+    """
+    @brief  将json内容写入文件，并确保写入操作是原子的
+
+    @param file_path    文件路径
+    @param content      要写入的内容
+    """
+    with atomic_write(file_path) as f:
+        json.dump(content, f, indent=4, ensure_ascii=False)
+
+
+def save_write_json_stream(file_path, key, items, tail=None):
+    """
+    @brief      将一个可迭代对象以 json 列表的形式流式写入文件
+    @details    写入的内容为 {key: [item, ...], **tail()}，每个 item 序列化后立即写入，
+                文件中的内容无需同时驻留在内存中。tail 在 items 全部写入后调用，
+                用于写入只有在遍历结束后才能确定的字段。写入是原子的，失败时原有文件保持不变
+
+    @param file_path    文件路径
+    @param key          列表对应的键
+    @param items        要写入的条目迭代器
+    @param tail         返回其余字段的函数，可为 None
+    @return 写入的条目数量
+    """
+    with atomic_write(file_path) as f:
+        f.write("{\n")
+        f.write(f"    {json.dumps(key)}: [")
+        separator = "\n"
+        count = 0
+        for item in items:
+            item_string = json.dumps(item, indent=4, ensure_ascii=False)
+            f.write(separator)
+            f.write(item_string.replace("\n", "\n        ").join(["        ", ""]))
+            separator = ",\n"
+            count += 1
+        f.write("\n    ]" if count > 0 else "]")
+
+        rest = tail() if tail is not None else {}
+        for rest_key, rest_value in rest.items():
+            value_string = json.dumps(rest_value, indent=4, ensure_ascii=False)
+            f.write(f",\n    {json.dumps(rest_key)}: ")
+            f.write(value_string.replace("\n", "\n    "))
+        f.write("\n}")
+    return count
+
+
 def save_read_json(file_path):
     """
-    @brief  从文件中读取json内容
+    @brief  从文件中读取json内容，文件总是被整体替换，读取时不需要加锁
 
     @param file_path 文件路径
     @return 文件中的json内容
     """
-    if not os.path.exists(file_path):
+    try:
+        with open(file_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
         return {}
 
-    with open(file_path, "r") as f:
-        fcntl.flock(f, fcntl.LOCK_SH)
-        try:
-            return json.load(f)
-        finally:
-            fcntl.flock(f, fcntl.LOCK_UN)
+
+def decode_text(data):
+    """
+    @brief  将文件的字节内容解码为字符串，与文本模式读取的结果一致
+    @detail 使用 utf-8 解码，并将 \r\n 和 \r 转换为 \n。data 可以是 bytes 或者 mmap 等支持缓冲区协议的对象，
+            解码时不会额外复制一份字节内容
+
+    @param  data 文件的字节内容
+    @return 解码后的字符串
+    """
+    content = str(data, "utf-8")
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content
 
 
 def is_directory_empty(directory):
@@ -56,6 +223,46 @@ def is_directory_empty(directory):
 
 
 
+# 预编译的参数正则表达式，避免每次匹配时查找 re 模块的缓存
+_ARG_PATTERN = re.compile(ARG_REGEX)
+
+
+def _parse_arg(arg_string: str):
+    """
+    @brief  解析 #{name:default_value} 形式的参数
+
+    @param  arg_string 匹配到的参数字符串
+    @return 包含参数名称和默认值的字典
+    """
+    arg_name = arg_string[2:-1]
+    if ":" in arg_name:
+        arg_name, default_value = arg_name.split(":")
+    else:
+        default_value = None
+    return {
+        "name": arg_name,
+        "default_value": default_value,
+    }
+
+
+# ARG_REGEX 的字节版本，用于在不解码的情况下检查文件中是否包含参数。
+# 非 ASCII 字节可以出现在参数名称和空白的位置，使其匹配结果是 ARG_REGEX 在 utf-8 编码下的超集
+_ARG_BYTES_PATTERN = re.compile(rb"\#\{(?:\w|[\x80-\xff])+(?:\:(?:\s|[\x80-\xff])*[\x07-z]+)?\}")
+
+
+def buffer_has_args(buffer):
+    """
+    @brief  检查字节内容中是否可能包含参数
+    @detail 直接在 bytes 或者 mmap 上匹配，不需要解码。返回 False 时内容中一定不包含参数
+
+    @param  buffer 字节内容
+    @return 是否可能包含参数
+    """
+    if buffer.find(b"#{") == -1:
+        return False
+    return _ARG_BYTES_PATTERN.search(buffer) is not None
+
+
 def scan_args_for_string(string: str):
     """
     @brief  扫描字符串中的参数
@@ -64,22 +271,75 @@ def scan_args_for_string(string: str):
     @param  string 要扫描的字符串
     @return 包含参数名称和默认值的列表
     """
-    matches = re.finditer(ARG_REGEX, string)
-    args = []
+    if "#{" not in string:
+        return []
+    return [_parse_arg(match_.group()) for match_ in _ARG_PATTERN.finditer(string)]
 
-    for match_ in matches:
-        start, end = match_.span()
-        arg_name = match_.group()[2:-1]
-        if ":" in arg_name:
-            arg_name, default_value = arg_name.split(":")
-        else:
-            default_value = None
-        
-        args.append({
-            "name": arg_name,
-            "default_value": default_value,
-        })
-    return args
+
+def scan_arg_spans(text: str):
+    """
+    @brief  扫描多行文本中的参数及其位置
+    @detail 结果与逐行扫描相同，但只对整个文本匹配一次。
+            不包含 #{ 的文本直接跳过；匹配结果跨越多行时，回退到逐行扫描以保持结果一致
+
+    @param  text 要扫描的文本
+    @return (start, end, arg) 列表，start 和 end 为参数在文本中的位置，arg 为包含参数名称和默认值的字典
+    """
+    if "#{" not in text:
+        return []
+
+    matches = list(_ARG_PATTERN.finditer(text))
+    if any("\n" in match_.group() for match_ in matches):
+        spans = []
+        offset = 0
+        for line in text.split("\n"):
+            for match_ in _ARG_PATTERN.finditer(line):
+                start, end = match_.span()
+                spans.append((offset + start, offset + end, _parse_arg(match_.group())))
+            offset += len(line) + 1
+        return spans
+    return [(match_.start(), match_.end(), _parse_arg(match_.group())) for match_ in matches]
+
+
+def compile_spans(string: str, spans: list):
+    """
+    @brief  将字符串编译为渲染计划
+    @detail 渲染计划由参数之间的文本片段和参数名称组成，同一个计划可以使用不同的参数多次渲染
+
+    @param  string 要编译的字符串
+    @param  spans  [start, end, name] 列表，由 scan_arg_spans 得到
+    @return (literals, names)，len(literals) == len(names) + 1
+    """
+    if not spans:
+        return (string,), ()
+
+    literals = []
+    names = []
+    start = 0
+    for span_start, span_end, arg_name in spans:
+        literals.append(string[start:span_start])
+        names.append(arg_name)
+        start = span_end
+    literals.append(string[start:])
+    return tuple(literals), tuple(names)
+
+
+def render_plan(plan, args: dict):
+    """
+    @brief  使用参数渲染 compile_spans 得到的渲染计划，只进行一次字符串拼接
+
+    @param  plan 渲染计划
+    @param  args 参数列表
+    @return 渲染后的字符串
+    """
+    literals, names = plan
+    if not names:
+        return literals[0]
+
+    parts = [None] * (len(literals) + len(names))
+    parts[0::2] = literals
+    parts[1::2] = [str(args[arg_name]) for arg_name in names]
+    return "".join(parts)
 
 
 def format_string(string: str, args: dict):
@@ -91,57 +351,151 @@ def format_string(string: str, args: dict):
     @param  args 参数列表
     @return 格式化后的字符串
     """
-    replace_intervals = []
-    matches = re.finditer(ARG_REGEX, string)
-    for match_ in matches:
-        start, end = match_.span()
+    if "#{" not in string:
+        return string
+
+    parts = []
+    start = 0
+    for match_ in _ARG_PATTERN.finditer(string):
         arg_name = match_.group()[2:-1]
         if ":" in arg_name:
             arg_name, _ = arg_name.split(":")
 
-        value = args[arg_name]
-        value = str(value)
-
-        replace_intervals.append((start, end, value))
-    
-    if len(replace_intervals) == 0:
+        parts.append(string[start:match_.start()])
+        parts.append(str(args[arg_name]))
+        start = match_.end()
+    if start == 0:
         return string
-    
-    start = 0
-    end = replace_intervals[0][0]
-    final_string = string[start:end]
 
-    for i in range(len(replace_intervals) - 1):
-        start, end, value = replace_intervals[i]
-        final_string += value
+    parts.append(string[start:])
+    return "".join(parts)
 
-        start = end
-        end = replace_intervals[i+1][0]
-        final_string += string[start:end]
 
-    start, end, value = replace_intervals[-1]
-    final_string += value
-    final_string += string[end:]
+def _translate_ignore_glob(pattern: str):
+    """
+    @brief  将 gitignore 风格的 glob 转换为正则表达式
+    @detail * 和 ? 不匹配路径分隔符，** 匹配任意层级的目录，支持 [...] 字符类以及反斜杠转义
 
-    return final_string
+    @param  pattern 去除了否定符号、首尾斜杠的模式
+    @return 对应的正则表达式字符串
+    """
+    regex = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == n and (i == 0 or pattern[i - 1] == "/"):
+            regex.append(".*")
+            i += 2
+        elif c == "*":
+            while i < n and pattern[i] == "*":
+                i += 1
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = pattern.find("]", i + 2 if pattern.startswith("[!", i) or pattern.startswith("[^", i) else i + 1)
+            if j == -1:
+                regex.append(re.escape(c))
+                i += 1
+                continue
+            body = pattern[i + 1:j]
+            if body[:1] in ("!", "^"):
+                body = "^" + body[1:]
+            body = body.replace("[", "\\[")
+            regex.append(f"(?!/)[{body}]")
+            i = j + 1
+        elif c == "\\" and i + 1 < n:
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(c))
+            i += 1
+    return "".join(regex)
 
 
-def whether_ignore_file(file_path: str, ignore_pattern: str):
+def compile_ignore_patterns(ignore_patterns: list):
     """
-    @brief  判断文件是否需要忽略
-    @detail 判断文件是否需要忽略，使用 fnmatch 进行匹配
+    @brief  将忽略模式列表编译为一个匹配函数
+    @detail 所有模式只编译一次，合并为一个正则表达式，匹配一条路径的代价与模式数量无关。
+            模式采用 gitignore 语义：
+            - 空行和以 # 开头的行被忽略
+            - 以 ! 开头表示否定，重新包含之前被忽略的路径，后出现的模式优先
+            - 以 / 结尾只匹配目录
+            - 以 / 开头或者中间包含 / 时相对于项目根目录锚定，否则匹配任意层级下的同名文件或目录
+            - * 和 ? 不匹配 /，** 匹配任意层级的目录
 
-    @param  file_path 文件路径
-    @param  ignore_pattern 忽略模式
-    @return 是否需要忽略
+    @param  ignore_patterns 忽略模式列表
+    @return 匹配函数 whether_ignore(relative_path, is_dir)，relative_path 为相对于项目根目录、以 / 分隔的路径
     """
-    full_pattern = "*/" + ignore_pattern
-    if ignore_pattern.endswith("/"):
-        full_pattern += "*"
-    to_ignore1 = fnmatch.fnmatch(file_path, full_pattern)
-    
-    full_pattern = "*/" + ignore_pattern
-    full_pattern = full_pattern.rstrip("/")
-    to_ignore2 = fnmatch.fnmatch(file_path, full_pattern)
+    alternatives = []
+    negations = []
+    for pattern in ignore_patterns:
+        pattern = pattern.strip()
+        if pattern == "" or pattern.startswith("#"):
+            continue
+
+        negation = pattern.startswith("!")
+        if negation:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if pattern == "":
+            continue
+
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        regex = _translate_ignore_glob(pattern)
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        regex += "/" if dir_only else "/?"
+
+        alternatives.append(regex)
+        negations.append(negation)
+
+    if len(alternatives) == 0:
+        return lambda relative_path, is_dir=False: False
+
+    # 逆序排列各模式，第一个完整匹配的分支即为最后一个生效的模式
+    groups = [f"({regex})" for regex in reversed(alternatives)]
+    combined = re.compile("|".join(groups), re.DOTALL)
+    negations = list(reversed(negations))
+
+    def whether_ignore(relative_path: str, is_dir: bool = False):
+        subject = relative_path + "/" if is_dir else relative_path
+        match_ = combined.fullmatch(subject)
+        if match_ is None:
+            return False
+        return not negations[match_.lastindex - 1]
+
+    return whether_ignore
+
+
+def compile_replacements(replacements: dict):
+    """
+    @brief  将多个 原字符串 -> 替换字符串 的规则编译为一个替换函数
+    @detail 所有原字符串合并为一个正则表达式，按长度从长到短排列，每个字符串只需要扫描一遍，
+            代价与规则数量无关。同一位置有多个原字符串匹配时使用最长的一个，替换后的内容不会被再次替换，
+            结果与规则的顺序无关。空字符串被忽略
+
+    @param  replacements 原字符串 -> 替换字符串
+    @return 替换函数 replace(string)
+    """
+    replacements = {old: new for old, new in replacements.items() if old != ""}
+    if len(replacements) == 0:
+        return lambda string: string
+
+    pattern = re.compile("|".join(re.escape(old) for old in sorted(replacements, key=len, reverse=True)))
+
+    def replace(string: str):
+        return pattern.sub(lambda match_: replacements[match_.group(0)], string)
 
-    return to_ignore1 or to_ignore2
+    return replace
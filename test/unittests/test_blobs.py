@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+
+
+sys.dont_write_bytecode = True
+
+MODULE_DIR = os.environ.get('MODULE_DIR', None)
+if MODULE_DIR is not None:
+    if MODULE_DIR not in sys.path:
+        sys.path = [MODULE_DIR] + sys.path
+else:
+    raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
+
+
+import shutil
+from unittest import mock
+from project_template.util import save_write_json, save_read_json
+from project_template.blobs import blob_path, write_blob, read_blob, blob_session, add_blob_refs, release_blob_refs
+
+
+class TestBlobs(unittest.TestCase):
+    def setUp(self):
+        self.blob_dir = "/tmp/test_blobs"
+
+    def tearDown(self):
+        if os.path.exists(self.blob_dir):
+            shutil.rmtree(self.blob_dir)
+
+    def test_write_read_blob(self):
+        digest = write_blob(b"hello", self.blob_dir)
+        self.assertEqual(write_blob(b"hello", self.blob_dir), digest)
+        self.assertEqual(read_blob(digest, self.blob_dir), b"hello")
+        self.assertTrue(blob_path(digest, self.blob_dir).startswith(os.path.join(self.blob_dir, digest[:2])))
+        self.assertRaises(ValueError, read_blob, "0" * 64, self.blob_dir)
+
+    def test_blob_refs(self):
+        with blob_session(self.blob_dir):
+            shared = write_blob(b"LICENSE", self.blob_dir)
+            single = write_blob(b"README", self.blob_dir)
+            add_blob_refs([shared, single], self.blob_dir)
+            add_blob_refs([shared], self.blob_dir)
+
+        self.assertListEqual(release_blob_refs([shared, single], self.blob_dir), [single])
+        self.assertTrue(os.path.exists(blob_path(shared, self.blob_dir)))
+        self.assertFalse(os.path.exists(blob_path(single, self.blob_dir)))
+        self.assertListEqual(release_blob_refs([shared], self.blob_dir), [shared])
+
+
+    def test_write_blob_with_digest(self):
+        digest = write_blob(b"hello", self.blob_dir)
+        with mock.patch("hashlib.sha256", side_effect=AssertionError("hashed")):
+            self.assertEqual(write_blob(b"hello", self.blob_dir, digest), digest)
+
+    def test_blob_refs_log(self):
+        with blob_session(self.blob_dir):
+            digests = [write_blob(f"blob {index}".encode("utf-8"), self.blob_dir) for index in range(20)]
+            # 旧格式的引用计数文件
+            save_write_json(os.path.join(self.blob_dir, "refs.json"), {digests[0]: 1})
+
+        with mock.patch("project_template.blobs.BLOB_REFS_LOG_SIZE", 0):
+            for digest in digests:
+                with blob_session(self.blob_dir):
+                    add_blob_refs([digest], self.blob_dir)
+            # 写入时中断的不完整行被跳过，不影响之后追加的记录
+            refs = save_read_json(os.path.join(self.blob_dir, "refs.json"))
+            with open(os.path.join(self.blob_dir, refs["log"]), "a") as f:
+                f.write('[1, ["')
+            self.assertListEqual(release_blob_refs(digests[1:], self.blob_dir), digests[1:])
+            self.assertListEqual(release_blob_refs([digests[0]], self.blob_dir), [])
+            self.assertListEqual(release_blob_refs([digests[0]], self.blob_dir), [digests[0]])
+        logs = [name for name in os.listdir(self.blob_dir) if name.endswith(".log")]
+        self.assertEqual(len(logs), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
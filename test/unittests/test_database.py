@@ -1,6 +1,10 @@
 import os
 import sys
+import shutil
+import hashlib
 import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 
 sys.dont_write_bytecode = True
@@ -12,8 +16,11 @@ if MODULE_DIR is not None:
 else:
     raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
 
-from project_template.database import add_template, delete_template, update_template, get_template, list_template_names
+import project_template.database
+from project_template.database import add_template, add_templates, update_templates, delete_template, update_template, get_template, list_template_names, open_template, list_templates, list_template_versions
 from project_template.util import save_read_json
+from project_template.blobs import blob_path
+from project_template.storage import config_blobs, history_file_path, clear_config_cache
 from project_template.constants import DATABASE_FILE, DEFAULT_TEMPLATE_DIR
 
 
@@ -76,6 +83,102 @@ class TestAddTemplate(unittest.TestCase):
         except Exception as e:
             self.fail(f"delete_template failed: {e}")
 
+    def test_add_templates(self):
+        names = ["test_batch_template_a", "test_batch_template_b"]
+        project_dirs = [f"/tmp/{name}" for name in names]
+        for project_dir in project_dirs:
+            os.makedirs(project_dir)
+            with open(os.path.join(project_dir, "README.md"), "w") as f:
+                f.write("# #{project}\n")
+            with open(os.path.join(project_dir, "build.log"), "w") as f:
+                f.write("log\n")
+        templates = [{"name": name, "project_dir": project_dir, "ignore_files": ["*.log"]} for name, project_dir in zip(names, project_dirs)]
+
+        try:
+            self.assertRaises(ValueError, add_templates, templates + templates[:1])
+            self.assertListEqual(add_templates(templates, max_workers=2), names)
+            for name in names:
+                _, config = get_template(name)
+                self.assertListEqual([dir_or_file["name"] for dir_or_file in config["dirs_and_files"]], ["README.md"])
+                self.assertEqual(open_template(name).version, 1)
+
+            # 任意一个模板已经存在时不添加任何模板
+            self.assertRaises(ValueError, add_templates, [{"name": "test_batch_template_c", "project_dir": project_dirs[0]}] + templates)
+            self.assertNotIn("test_batch_template_c", list_template_names())
+
+            with open(os.path.join(project_dirs[1], "README.md"), "w") as f:
+                f.write("# #{project} by #{author}\n")
+            self.assertListEqual(update_templates(templates), names[1:])
+            self.assertEqual(open_template(names[0]).version, 1)
+            self.assertEqual(open_template(names[1]).version, 2)
+        finally:
+            for name, project_dir in zip(names, project_dirs):
+                shutil.rmtree(project_dir)
+                if name in list_template_names():
+                    delete_template(name)
+
+    def test_add_template_concurrently(self):
+        name = "test_race_template"
+        location_dir = "/tmp/test_race_location"
+        project_dirs = [f"/tmp/test_race_template_{index}" for index in range(8)]
+        for index, project_dir in enumerate(project_dirs):
+            os.makedirs(project_dir)
+            with open(os.path.join(project_dir, "README.md"), "w") as f:
+                f.write(f"{index} #{{project}}\n")
+
+        def add(project_dir):
+            try:
+                add_template(name, project_dir, location_dir, config_format="json")
+                return project_dir
+            except ValueError:
+                return None
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(project_dirs)) as executor:
+                winners = [project_dir for project_dir in executor.map(add, project_dirs) if project_dir is not None]
+            # 只有一个模板添加成功，失败的一方不会覆盖其配置，也不会删除其引用的内容
+            self.assertEqual(len(winners), 1)
+            project_dir, config = get_template(name)
+            self.assertEqual(project_dir, winners[0])
+            self.assertEqual(config["dirs_and_files"][0]["content"], f"{project_dirs.index(winners[0])} #{{project}}\n")
+            self.assertListEqual([path for path in os.listdir(location_dir) if not path.endswith(".lock")], [f"{name}.json"])
+        finally:
+            for project_dir in project_dirs:
+                shutil.rmtree(project_dir)
+            if name in list_template_names():
+                delete_template(name)
+            shutil.rmtree(location_dir, ignore_errors=True)
+
+    def test_add_templates_concurrently(self):
+        name = "test_batch_race_template"
+        location_dir = "/tmp/test_batch_race_location"
+        project_dirs = [f"/tmp/test_batch_race_template_{index}" for index in range(8)]
+        for index, project_dir in enumerate(project_dirs):
+            os.makedirs(project_dir)
+            with open(os.path.join(project_dir, "README.md"), "w") as f:
+                f.write(f"{index} #{{project}}\n")
+
+        def add(project_dir):
+            try:
+                add_templates([{"name": name, "project_dir": project_dir}], location_dir, config_format="json")
+                return project_dir
+            except ValueError:
+                return None
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(project_dirs)) as executor:
+                winners = [project_dir for project_dir in executor.map(add, project_dirs) if project_dir is not None]
+            self.assertEqual(len(winners), 1)
+            _, config = get_template(name)
+            self.assertEqual(config["dirs_and_files"][0]["content"], f"{project_dirs.index(winners[0])} #{{project}}\n")
+            self.assertListEqual([path for path in os.listdir(location_dir) if not path.endswith(".lock")], [f"{name}.json"])
+        finally:
+            for project_dir in project_dirs:
+                shutil.rmtree(project_dir)
+            if name in list_template_names():
+                delete_template(name)
+            shutil.rmtree(location_dir, ignore_errors=True)
+
 
 class TestDeleteTemplate(unittest.TestCase):
     def test_delete_template(self):
@@ -94,6 +197,33 @@ class TestDeleteTemplate(unittest.TestCase):
         location_dir = f"{DEFAULT_TEMPLATE_DIR}/{name}.json"
         self.assertFalse(os.path.exists(location_dir))
 
+    def test_delete_template_blobs(self):
+        names = ["test_blob_template_a", "test_blob_template_b"]
+        project_dir = "/tmp/test_blob_template"
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "LICENSE"), "w") as f:
+            f.write(f"{project_dir} #{{author}}\n")
+
+        try:
+            for name in names:
+                add_template(name, project_dir, config_format="json")
+            blobs = [config_blobs(save_read_json(DATABASE_FILE)[name]["config_file"]) for name in names]
+            self.assertEqual(len(blobs[0]), 1)
+            self.assertListEqual(blobs[0], blobs[1])
+            path = blob_path(blobs[0][0])
+
+            # 仍然被其他模板引用的内容不会被删除
+            _, config = delete_template(names[0])
+            self.assertEqual(config["dirs_and_files"][0]["content"], f"{project_dir} #{{author}}\n")
+            self.assertTrue(os.path.exists(path))
+            delete_template(names[1])
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(project_dir)
+            for name in names:
+                if name in list_template_names():
+                    delete_template(name)
+
 
 class TestUpdateTemplate(unittest.TestCase):
     def test_update_template(self):
@@ -123,6 +253,143 @@ class TestUpdateTemplate(unittest.TestCase):
 
         delete_template(name)
 
+    def test_update_template_incremental(self):
+        name = "test_incremental_template"
+        project_dir = "/tmp/test_incremental_template"
+        os.makedirs(os.path.join(project_dir, "src"))
+        with open(os.path.join(project_dir, "src", "main.py"), "w") as f:
+            f.write("print('#{greeting:hello}')\n")
+        with open(os.path.join(project_dir, "README.md"), "w") as f:
+            f.write("# #{project}\n")
+
+        try:
+            add_template(name, project_dir, config_format="json")
+            config_file = save_read_json(DATABASE_FILE)[name]["config_file"]
+            config = save_read_json(config_file)
+            self.assertIn("manifest", config)
+            self.assertListEqual(sorted(config["manifest"].keys()), ["README.md", "src/main.py"])
+
+            # 增量更新只读取内容哈希，不读取已保存的文件内容
+            clear_config_cache()
+            with mock.patch("project_template.storage.read_blob", side_effect=AssertionError("blob read")):
+                mtime_ns = os.stat(config_file).st_mtime_ns
+                update_template(name, project_dir)
+                self.assertEqual(os.stat(config_file).st_mtime_ns, mtime_ns)
+
+                with open(os.path.join(project_dir, "README.md"), "w") as f:
+                    f.write("# #{project} by #{author}\n")
+                update_template(name, project_dir)
+
+            _, config = get_template(name)
+            contents = {dir_or_file["name"]: dir_or_file["content"] for dir_or_file in config["dirs_and_files"]}
+            self.assertEqual(contents["README.md"], "# #{project} by #{author}\n")
+            self.assertEqual(contents["main.py"], "print('#{greeting:hello}')\n")
+            args_keys = [arg["name"] for arg in config["args"]]
+            self.assertListEqual(sorted(args_keys), ["author", "greeting", "project"])
+        finally:
+            shutil.rmtree(project_dir)
+            if name in list_template_names():
+                delete_template(name)
+
+    def test_blob_digests(self):
+        name = "test_blob_digest_template"
+        project_dir = "/tmp/test_blob_digest_template"
+        os.makedirs(project_dir)
+        files = {"unix.txt": b"line\nline\n", "windows.txt": b"line\r\nline\r\n", "image.png": b"\x89PNG\r\n\xff\x00"}
+        for file_name, data in files.items():
+            with open(os.path.join(project_dir, file_name), "wb") as f:
+                f.write(data)
+
+        try:
+            add_template(name, project_dir, config_format="json")
+            config = save_read_json(save_read_json(DATABASE_FILE)[name]["config_file"])
+            # 内容存储中的内容与其哈希一致，转换了换行符的文件使用转换后内容的哈希
+            for dir_or_file in config["dirs_and_files"]:
+                with open(blob_path(dir_or_file["blob"]), "rb") as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), dir_or_file["blob"])
+        finally:
+            shutil.rmtree(project_dir)
+            if name in list_template_names():
+                delete_template(name)
+
+    def test_update_template_deleted_concurrently(self):
+        name = "test_update_deleted_template"
+        project_dir = "/tmp/test_update_deleted_template"
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "README.md"), "w") as f:
+            f.write(f"{project_dir} #{{project}}\n")
+
+        rewrite_template = project_template.database._rewrite_template
+        def rewrite_and_delete(*args, **kwargs):
+            result = rewrite_template(*args, **kwargs)
+            delete_template(name)
+            return result
+
+        try:
+            add_template(name, project_dir, config_format="json")
+            with open(os.path.join(project_dir, "README.md"), "w") as f:
+                f.write(f"{project_dir} #{{project}} v2\n")
+            with mock.patch("project_template.database._rewrite_template", side_effect=rewrite_and_delete):
+                self.assertRaises(ValueError, update_template, name, project_dir)
+
+            # 模板被并发删除时不留下配置文件、历史版本和内容引用
+            self.assertNotIn(name, list_template_names())
+            self.assertListEqual([path for path in os.listdir(DEFAULT_TEMPLATE_DIR) if name in path], [])
+            self.assertFalse(os.path.exists(history_file_path(DEFAULT_TEMPLATE_DIR, name)))
+            digest = hashlib.sha256(f"{project_dir} #{{project}} v2\n".encode("utf-8")).hexdigest()
+            self.assertFalse(os.path.exists(blob_path(digest)))
+        finally:
+            shutil.rmtree(project_dir)
+            if name in list_template_names():
+                delete_template(name)
+
+    def test_update_template_versions(self):
+        name = "test_versioned_template"
+        project_dir = "/tmp/test_versioned_template"
+        for config_format in ["json", "pack"]:
+            os.makedirs(os.path.join(project_dir, "src"))
+            with open(os.path.join(project_dir, "src", "main.py"), "w") as f:
+                f.write("print('#{greeting:hello}')\n")
+            with open(os.path.join(project_dir, "README.md"), "w") as f:
+                f.write("# #{project}\n")
+
+            try:
+                add_template(name, project_dir, config_format=config_format)
+                _, config_v1 = get_template(name)
+
+                with open(os.path.join(project_dir, "README.md"), "w") as f:
+                    f.write("# #{project} by #{author}\n")
+                update_template(name, project_dir)
+                _, config_v2 = get_template(name)
+
+                os.remove(os.path.join(project_dir, "src", "main.py"))
+                with open(os.path.join(project_dir, "LICENSE"), "w") as f:
+                    f.write("MIT\n")
+                update_template(name, project_dir)
+                # 没有变化时不生成新版本
+                update_template(name, project_dir)
+                _, config_v3 = get_template(name)
+
+                self.assertListEqual(list_template_versions(name), [1, 2, 3])
+                for version, config in [(1, config_v1), (2, config_v2), (3, config_v3)]:
+                    _, config_from_history = get_template(name, version)
+                    self.assertListEqual(config_from_history["dirs_and_files"], config["dirs_and_files"])
+                    self.assertListEqual(config_from_history["args"], config["args"])
+                    self.assertEqual(open_template(name, version).version, version)
+                self.assertRaises(ValueError, get_template, name, 4)
+
+                # 版本 2 只保存了发生变化的 README.md
+                history = save_read_json(history_file_path(DEFAULT_TEMPLATE_DIR, name))
+                self.assertListEqual([entry["name"] for entry in history["versions"][1]["changed"]], ["README.md"])
+                self.assertListEqual(history["versions"][2]["removed"], ["src/main.py"])
+
+                delete_template(name)
+                self.assertFalse(os.path.exists(history_file_path(DEFAULT_TEMPLATE_DIR, name)))
+            finally:
+                shutil.rmtree(project_dir)
+                if name in list_template_names():
+                    delete_template(name)
+
 
 class TestGetTemplate(unittest.TestCase):
     def test_get_template(self):
@@ -143,6 +410,30 @@ class TestGetTemplate(unittest.TestCase):
         delete_template(name)
 
 
+class TestOpenTemplate(unittest.TestCase):
+    def test_open_template(self):
+        name = "test_open_template"
+        project_dir = os.path.join(MODULE_DIR, "examples", "dl_model")
+        self.assertRaises(ValueError, open_template, name)
+
+        for config_format in ["json", "pack"]:
+            add_template(name, project_dir, config_format=config_format)
+            try:
+                _, config = get_template(name)
+                template = open_template(name)
+                self.assertEqual(template.project_dir, project_dir)
+                self.assertListEqual(template.args, config["args"])
+                self.assertEqual(template.entry_count, len(config["dirs_and_files"]))
+                for index, dir_or_file in enumerate(config["dirs_and_files"]):
+                    self.assertIsNone(template.entries[index]["content"])
+                    self.assertEqual(template.entries[index]["name"], dir_or_file["name"])
+                    self.assertDictEqual(template.entry(index), dir_or_file)
+                self.assertDictEqual(template.load(), config)
+                self.assertIn(name, [template.name for template in list_templates()])
+            finally:
+                delete_template(name)
+
+
 class TestListTemplateNames(unittest.TestCase):
     def test_list_template_names(self):
         name = "test_template"
@@ -13,9 +13,19 @@ else:
     raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
 
 
+import io
 import shutil
-from project_template.database import add_template, delete_template
-from project_template.instantiation import instantiate_project
+import hashlib
+import tarfile
+import zipfile
+from unittest import mock
+from project_template import instantiation, storage
+from project_template.database import add_template, update_template, delete_template, list_template_names
+from project_template.util import render_plan
+from project_template.instantiation import instantiate_project, instantiate_projects, instantiate_archive, get_render_plan, sync_project
+from project_template.constants import RENDER_MANIFEST_FILE, RENDER_CACHE_DIR
+from project_template.render_cache import clear_render_cache
+from project_template.storage import clear_config_cache
 
 
 class TestInstantiation(unittest.TestCase):
@@ -107,6 +117,327 @@ class TestInstantiation(unittest.TestCase):
 
         shutil.rmtree(project_dir)
 
+    def test_render_plan_cache(self):
+        name = "test_render_plan_template"
+        project_dir = "/tmp/test_render_plan_template"
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "#{module}.py"), "w") as f:
+            f.write("print('#{greeting:hello}, #{module}')\n")
+
+        try:
+            add_template(name, project_dir)
+            plan = get_render_plan(name)
+            self.assertIs(get_render_plan(name), plan)
+
+            for module in ["a", "b"]:
+                output_dir = f"/tmp/test_render_plan_{module}"
+                instantiate_project(name, output_dir, {"module": module})
+                with open(os.path.join(output_dir, f"{module}.py"), "r") as f:
+                    self.assertEqual(f.read(), f"print('hello, {module}')\n")
+                shutil.rmtree(output_dir)
+        finally:
+            shutil.rmtree(project_dir)
+            delete_template(name)
+
+    def test_instantiate_project_parallel(self):
+        name = "test_parallel_template"
+        project_dir = "/tmp/test_parallel_template"
+        os.makedirs(os.path.join(project_dir, "#{module}"))
+        for index in range(16):
+            with open(os.path.join(project_dir, "#{module}", f"file_{index}.py"), "w") as f:
+                f.write(f"# #{{module}} {index}\n")
+        os.chmod(os.path.join(project_dir, "#{module}", "file_0.py"), 0o751)
+        os.chmod(os.path.join(project_dir, "#{module}"), 0o555)
+
+        output_dir = "/tmp/test_parallel_output"
+        try:
+            add_template(name, project_dir)
+            instantiate_project(name, output_dir, {"module": "core"}, max_workers=4)
+            self.assertEqual(os.stat(os.path.join(output_dir, "core")).st_mode & 0o7777, 0o555)
+            self.assertEqual(os.stat(os.path.join(output_dir, "core", "file_0.py")).st_mode & 0o7777, 0o751)
+            for index in range(16):
+                with open(os.path.join(output_dir, "core", f"file_{index}.py"), "r") as f:
+                    self.assertEqual(f.read(), f"# core {index}\n")
+        finally:
+            for directory in [project_dir, output_dir]:
+                if os.path.exists(os.path.join(directory, "#{module}")):
+                    os.chmod(os.path.join(directory, "#{module}"), 0o755)
+                if os.path.exists(os.path.join(directory, "core")):
+                    os.chmod(os.path.join(directory, "core"), 0o755)
+                if os.path.exists(directory):
+                    shutil.rmtree(directory)
+            delete_template(name)
+
+    def test_instantiate_archive(self):
+        name = "test_archive_template"
+        project_dir = "/tmp/test_archive_template"
+        os.makedirs(os.path.join(project_dir, "#{module}"))
+        with open(os.path.join(project_dir, "#{module}", "run.sh"), "w") as f:
+            f.write("echo #{module}\n")
+        os.chmod(os.path.join(project_dir, "#{module}", "run.sh"), 0o755)
+
+        class Stream:
+            # 只支持 write 的输出流，模拟管道或者 HTTP 响应
+            def __init__(self):
+                self.buffer = io.BytesIO()
+
+            def write(self, data):
+                return self.buffer.write(data)
+
+            def flush(self):
+                pass
+
+        try:
+            add_template(name, project_dir)
+            for archive_format in ["tar", "gztar", "zip"]:
+                stream = Stream()
+                instantiate_archive(name, stream, {"module": "core"}, archive_format=archive_format, prefix="project")
+                stream.buffer.seek(0)
+                if archive_format == "zip":
+                    with zipfile.ZipFile(stream.buffer) as archive:
+                        self.assertListEqual(archive.namelist(), ["project/core/", "project/core/run.sh"])
+                        self.assertEqual(archive.read("project/core/run.sh"), b"echo core\n")
+                        self.assertEqual((archive.getinfo("project/core/run.sh").external_attr >> 16) & 0o7777, 0o755)
+                else:
+                    with tarfile.open(fileobj=stream.buffer) as archive:
+                        self.assertListEqual(archive.getnames(), ["project/core", "project/core/run.sh"])
+                        self.assertEqual(archive.extractfile("project/core/run.sh").read(), b"echo core\n")
+                        self.assertEqual(archive.getmember("project/core/run.sh").mode, 0o755)
+                        self.assertTrue(archive.getmember("project/core").isdir())
+            self.assertRaises(ValueError, instantiate_archive, name, Stream(), {}, archive_format="zip")
+        finally:
+            shutil.rmtree(project_dir)
+            delete_template(name)
+
+    def test_instantiate_projects(self):
+        name = "test_batch_instantiation_template"
+        project_dir = "/tmp/test_batch_instantiation_template"
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "#{service}.py"), "w") as f:
+            f.write("ENV = '#{env_name:dev}'\n")
+
+        output_dirs = [f"/tmp/test_batch_instantiation_{index}" for index in range(4)]
+        try:
+            add_template(name, project_dir)
+            for max_workers, use_processes in [(None, False), (2, False), (2, True)]:
+                jobs = [(output_dir, {"service": f"s{index}", "env_name": "prod"}) for index, output_dir in enumerate(output_dirs)]
+                # 缺少参数的项目失败，不影响其他项目
+                jobs[1] = (output_dirs[1], {})
+                results = instantiate_projects(name, jobs, max_workers=max_workers, use_processes=use_processes)
+
+                self.assertListEqual([project_dir for project_dir, _ in results], output_dirs)
+                self.assertIsInstance(results[1][1], ValueError)
+                for index in [0, 2, 3]:
+                    self.assertIsNone(results[index][1])
+                    with open(os.path.join(output_dirs[index], f"s{index}.py"), "r") as f:
+                        self.assertEqual(f.read(), "ENV = 'prod'\n")
+
+                for output_dir in output_dirs:
+                    if os.path.exists(output_dir):
+                        shutil.rmtree(output_dir)
+
+            # 无法传递给进程池的参数只影响对应的项目
+            jobs = [(output_dir, {"service": f"s{index}"}) for index, output_dir in enumerate(output_dirs)]
+            jobs[2] = (output_dirs[2], {"service": lambda: "s2"})
+            results = instantiate_projects(name, jobs, max_workers=2, use_processes=True)
+            self.assertIsInstance(results[2][1], Exception)
+            for index in [0, 1, 3]:
+                self.assertIsNone(results[index][1])
+        finally:
+            shutil.rmtree(project_dir)
+            for output_dir in output_dirs:
+                if os.path.exists(output_dir):
+                    shutil.rmtree(output_dir)
+            delete_template(name)
+
+    def test_clone_placeholder_free_files(self):
+        name = "test_clone_template"
+        project_dir = "/tmp/test_clone_template"
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "poetry.lock"), "w") as f:
+            f.write(f"{project_dir} lock\n" * 100)
+        os.chmod(os.path.join(project_dir, "poetry.lock"), 0o640)
+        with open(os.path.join(project_dir, "main.py"), "w") as f:
+            f.write("print('#{greeting:hello}')\n")
+
+        output_dir = "/tmp/test_clone_output"
+        try:
+            add_template(name, project_dir, config_format="json")
+            # 只读取包含参数的文件的内容，不包含参数的文件不读取也不重新计算哈希
+            clear_config_cache()
+            with mock.patch("project_template.storage.read_blob", wraps=storage.read_blob) as read_blob:
+                _, entries = get_render_plan(name)
+                instantiation._RENDER_PLANS.clear()
+                instantiate_project(name, output_dir, {})
+            main_digest = hashlib.sha256("print('#{greeting:hello}')\n".encode("utf-8")).hexdigest()
+            self.assertListEqual([call.args[0] for call in read_blob.call_args_list], [main_digest] * 2)
+
+            entries = {render_plan(entry["name"], {}): entry for entry in entries}
+            self.assertIsNotNone(entries["poetry.lock"]["source"])
+            self.assertIsNone(entries["main.py"]["source"])
+
+            with open(os.path.join(output_dir, "poetry.lock"), "r") as f:
+                self.assertEqual(f.read(), f"{project_dir} lock\n" * 100)
+            stat = os.stat(os.path.join(output_dir, "poetry.lock"))
+            self.assertEqual(stat.st_mode & 0o7777, 0o640)
+            # 不使用硬链接，修改生成的文件不会影响模板内容
+            self.assertNotEqual(stat.st_ino, os.stat(entries["poetry.lock"]["source"]).st_ino)
+        finally:
+            shutil.rmtree(project_dir)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            delete_template(name)
+
+    def test_instantiate_binary_files(self):
+        name = "test_binary_template"
+        project_dir = "/tmp/test_binary_template"
+        os.makedirs(project_dir)
+        data = bytes(range(256)) + b"\r\n#{module}"
+        with open(os.path.join(project_dir, "#{module}.bin"), "wb") as f:
+            f.write(data)
+
+        output_dir = "/tmp/test_binary_output"
+        try:
+            for config_format in ["json", "pack"]:
+                add_template(name, project_dir, config_format=config_format)
+                instantiate_project(name, output_dir, {"module": "weights"})
+                with open(os.path.join(output_dir, "weights.bin"), "rb") as f:
+                    self.assertEqual(f.read(), data)
+                shutil.rmtree(output_dir)
+                delete_template(name)
+        finally:
+            shutil.rmtree(project_dir)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            if name in list_template_names():
+                delete_template(name)
+
+    def test_sync_project(self):
+        name = "test_sync_template"
+        project_dir = "/tmp/test_sync_template"
+        os.makedirs(os.path.join(project_dir, "docs"))
+        files = {
+            "#{module}.py": "NAME = '#{module}'\n",
+            "README.md": "readme\n",
+            "setup.cfg": "[metadata]\n",
+            "docs/index.md": "docs\n",
+        }
+        for file_name, content in files.items():
+            with open(os.path.join(project_dir, file_name), "w") as f:
+                f.write(content)
+
+        output_dir = "/tmp/test_sync_output"
+        try:
+            add_template(name, project_dir)
+            instantiate_project(name, output_dir, {"module": "app"}, track=True)
+            self.assertTrue(os.path.exists(os.path.join(output_dir, RENDER_MANIFEST_FILE)))
+            with open(os.path.join(output_dir, "setup.cfg"), "a") as f:
+                f.write("local = 1\n")
+            unchanged_inode = os.stat(os.path.join(output_dir, "app.py")).st_ino
+
+            with open(os.path.join(project_dir, "README.md"), "w") as f:
+                f.write("new readme\n")
+            with open(os.path.join(project_dir, "setup.cfg"), "w") as f:
+                f.write("[options]\n")
+            with open(os.path.join(project_dir, "LICENSE"), "w") as f:
+                f.write("MIT\n")
+            shutil.rmtree(os.path.join(project_dir, "docs"))
+            update_template(name, project_dir)
+
+            # 同步只比较内容哈希，不包含参数且已经保存在内容存储中的文件直接复制，不需要读取内容
+            clear_config_cache()
+            with mock.patch("project_template.storage.read_blob", side_effect=AssertionError("blob read")):
+                result = sync_project(output_dir)
+            self.assertListEqual(sorted(result["written"]), ["LICENSE", "README.md"])
+            self.assertListEqual(sorted(result["removed"]), ["docs", "docs/index.md"])
+            # 实例化之后被修改过的文件不会被覆盖
+            self.assertListEqual(result["conflicts"], ["setup.cfg"])
+            self.assertEqual(result["unchanged"], 1)
+            self.assertEqual(os.stat(os.path.join(output_dir, "app.py")).st_ino, unchanged_inode)
+            with open(os.path.join(output_dir, "README.md"), "r") as f:
+                self.assertEqual(f.read(), "new readme\n")
+            with open(os.path.join(output_dir, "setup.cfg"), "r") as f:
+                self.assertEqual(f.read(), "[metadata]\nlocal = 1\n")
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "docs")))
+
+            # 同步到旧版本，参数变化时重命名的条目重新渲染，冲突时保留的记录与旧版本一致，不需要重新渲染
+            # 历史版本只读取需要重新渲染的条目
+            clear_config_cache()
+            with mock.patch("project_template.storage.read_blob", wraps=storage.read_blob) as read_blob:
+                result = sync_project(output_dir, {"module": "core"}, version=1)
+            self.assertEqual(read_blob.call_count, 1)
+            self.assertListEqual(sorted(result["written"]), ["README.md", "core.py", "docs", "docs/index.md"])
+            self.assertListEqual(sorted(result["removed"]), ["LICENSE", "app.py"])
+            self.assertListEqual(result["conflicts"], [])
+            self.assertEqual(result["unchanged"], 1)
+            with open(os.path.join(output_dir, "core.py"), "r") as f:
+                self.assertEqual(f.read(), "NAME = 'core'\n")
+
+            # force 为 True 时覆盖被修改过的文件
+            with open(os.path.join(output_dir, "README.md"), "w") as f:
+                f.write("local readme\n")
+            result = sync_project(output_dir)
+            self.assertListEqual(sorted(result["conflicts"]), ["README.md", "setup.cfg"])
+            result = sync_project(output_dir, force=True)
+            self.assertListEqual(sorted(result["written"]), ["README.md", "setup.cfg"])
+            with open(os.path.join(output_dir, "README.md"), "r") as f:
+                self.assertEqual(f.read(), "new readme\n")
+            with open(os.path.join(output_dir, "setup.cfg"), "r") as f:
+                self.assertEqual(f.read(), "[options]\n")
+
+            result = sync_project(output_dir)
+            self.assertEqual(result, {"written": [], "removed": [], "conflicts": [], "unchanged": 4})
+
+            with self.assertRaises(ValueError):
+                sync_project(project_dir)
+        finally:
+            shutil.rmtree(project_dir)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            delete_template(name)
+
+    def test_render_cache(self):
+        name = "test_render_cache_template"
+        project_dir = "/tmp/test_render_cache_template"
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "#{module}.py"), "w") as f:
+            f.write("NAME = '#{module}'\n")
+        with open(os.path.join(project_dir, "README.md"), "w") as f:
+            f.write("readme\n")
+
+        output_dirs = [f"/tmp/test_render_cache_{index}" for index in range(3)]
+        cache_size = instantiation.RENDER_CACHE_SIZE
+        instantiation.RENDER_CACHE_SIZE = 1 << 20
+        try:
+            add_template(name, project_dir)
+            # 未命中时按 max_workers 正常生成项目，再将渲染结果复制到渲染缓存
+            instantiate_project(name, output_dirs[0], {"module": "app"}, max_workers=2)
+            cached = [path for path in os.listdir(RENDER_CACHE_DIR) if not path.startswith("index.json")]
+            self.assertEqual(len(cached), 1)
+
+            # 相同的参数直接从渲染缓存中复制
+            instantiate_project(name, output_dirs[1], {"module": "app"}, track=True)
+            self.assertEqual(len([path for path in os.listdir(RENDER_CACHE_DIR) if not path.startswith("index.json")]), 1)
+            # 缓存被清空时重新渲染
+            clear_render_cache()
+            instantiate_project(name, output_dirs[2], {"module": "app"})
+            for output_dir in output_dirs:
+                with open(os.path.join(output_dir, "app.py"), "r") as f:
+                    self.assertEqual(f.read(), "NAME = 'app'\n")
+                with open(os.path.join(output_dir, "README.md"), "r") as f:
+                    self.assertEqual(f.read(), "readme\n")
+
+            # 使用渲染缓存生成的项目同样可以同步
+            self.assertEqual(sync_project(output_dirs[1])["unchanged"], 2)
+        finally:
+            instantiation.RENDER_CACHE_SIZE = cache_size
+            clear_render_cache()
+            shutil.rmtree(project_dir)
+            for output_dir in output_dirs:
+                if os.path.exists(output_dir):
+                    shutil.rmtree(output_dir)
+            delete_template(name)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
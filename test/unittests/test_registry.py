@@ -0,0 +1,100 @@
+import os
+import sys
+import unittest
+
+
+sys.dont_write_bytecode = True
+
+MODULE_DIR = os.environ.get('MODULE_DIR', None)
+if MODULE_DIR is not None:
+    if MODULE_DIR not in sys.path:
+        sys.path = [MODULE_DIR] + sys.path
+else:
+    raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
+
+
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from project_template.registry import JsonRegistry, SqliteRegistry
+from project_template.util import save_write_json
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry_dir = "/tmp/test_registry"
+        os.makedirs(self.registry_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.registry_dir)
+
+    def check_registry(self, registry):
+        record = {"project_dir": "/tmp/a", "location": "/tmp", "config_file": "/tmp/a.json"}
+        self.assertIsNone(registry.get("a"))
+        self.assertTrue(registry.add("a", record))
+        self.assertFalse(registry.add("a", record))
+        self.assertTrue(registry.add("b", record))
+        self.assertDictEqual(registry.get("a"), record)
+        self.assertListEqual(registry.names(), ["a", "b"])
+
+        updated = dict(record, project_dir="/tmp/c")
+        self.assertTrue(registry.update("a", updated))
+        self.assertFalse(registry.update("c", updated))
+        self.assertListEqual(registry.items(), [("a", updated), ("b", record)])
+
+        self.assertDictEqual(registry.remove("a"), updated)
+        self.assertIsNone(registry.remove("a"))
+        self.assertListEqual(registry.names(), ["b"])
+
+        self.assertListEqual(registry.add_many([("c", record), ("b", record)]), ["b"])
+        self.assertListEqual(registry.names(), ["b"])
+        self.assertListEqual(registry.add_many([("c", record), ("d", record)]), [])
+        self.assertListEqual(registry.update_many([("c", updated), ("e", updated)]), ["e"])
+        self.assertListEqual(registry.update_many([("c", updated), ("d", updated)]), [])
+        self.assertListEqual(registry.items(), [("b", record), ("c", updated), ("d", updated)])
+
+    def test_json_registry(self):
+        self.check_registry(JsonRegistry(os.path.join(self.registry_dir, "templates.json")))
+
+    def test_json_registry_invalidation(self):
+        database_file = os.path.join(self.registry_dir, "templates.json")
+        record = {"project_dir": "/tmp/a", "location": "/tmp", "config_file": "/tmp/a.json"}
+        registry = JsonRegistry(database_file)
+        other = JsonRegistry(database_file)
+        self.assertTrue(registry.add("a", record))
+        self.assertListEqual(other.names(), ["a"])
+
+        # 另一个实例改写文件后，缓存失效
+        self.assertTrue(other.add("bb", record))
+        self.assertListEqual(registry.names(), ["a", "bb"])
+
+        # 修改返回的记录不影响缓存
+        registry.get("a")["project_dir"] = "/tmp/b"
+        self.assertDictEqual(registry.get("a"), record)
+
+    def test_json_registry_concurrent_add(self):
+        database_file = os.path.join(self.registry_dir, "templates.json")
+        record = {"project_dir": "/tmp/a", "location": "/tmp", "config_file": "/tmp/a.json"}
+
+        # 每个线程使用独立的注册表对象，模拟多个进程同时添加模板
+        def add(index):
+            return JsonRegistry(database_file).add(f"t{index}", record)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertTrue(all(executor.map(add, range(32))))
+        self.assertListEqual(sorted(JsonRegistry(database_file).names()), sorted(f"t{index}" for index in range(32)))
+
+    def test_sqlite_registry(self):
+        self.check_registry(SqliteRegistry(os.path.join(self.registry_dir, "templates.db"), None))
+
+    def test_sqlite_registry_import_json(self):
+        json_file = os.path.join(self.registry_dir, "templates.json")
+        record = {"project_dir": "/tmp/a", "location": "/tmp", "config_file": "/tmp/a.json"}
+        save_write_json(json_file, {"a": record})
+
+        registry = SqliteRegistry(os.path.join(self.registry_dir, "templates.db"), json_file)
+        self.assertListEqual(registry.names(), ["a"])
+        self.assertDictEqual(registry.get("a"), record)
+
+
+if __name__ == "__main__":
+    unittest.main()
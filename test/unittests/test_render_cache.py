@@ -0,0 +1,83 @@
+import os
+import sys
+import unittest
+
+
+sys.dont_write_bytecode = True
+
+MODULE_DIR = os.environ.get('MODULE_DIR', None)
+if MODULE_DIR is not None:
+    if MODULE_DIR not in sys.path:
+        sys.path = [MODULE_DIR] + sys.path
+else:
+    raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
+
+
+import shutil
+import hashlib
+from project_template.render_cache import render_cache_key, render_path, read_render, write_render, clear_render_cache
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = "/tmp/test_render_cache"
+        self.output_dir = "/tmp/test_render_cache_output"
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        for path in (self.cache_dir, self.output_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def _outputs(self, **files):
+        outputs = {}
+        for position, (file_name, data) in enumerate(sorted(files.items())):
+            path = os.path.join(self.output_dir, file_name)
+            with open(path, "wb") as f:
+                f.write(data)
+            outputs[position] = (path, hashlib.sha256(data).hexdigest())
+        return outputs
+
+    def test_render_cache_key(self):
+        key = render_cache_key("digest", {"a": "1", "b": 2})
+        self.assertEqual(render_cache_key("digest", {"b": "2", "a": "1"}), key)
+        self.assertNotEqual(render_cache_key("digest", {"a": "1", "b": "3"}), key)
+        self.assertNotEqual(render_cache_key("other", {"a": "1", "b": "2"}), key)
+
+    def test_read_write_render(self):
+        self.assertIsNone(read_render("key", self.cache_dir))
+        outputs = self._outputs(a=b"hello", b=b"world")
+        self.assertTrue(write_render("key", outputs, 1024, self.cache_dir))
+        digests = read_render("key", self.cache_dir)
+        self.assertEqual(digests, {position: digest for position, (_, digest) in outputs.items()})
+        with open(render_path("key", digests[1], self.cache_dir), "rb") as f:
+            self.assertEqual(f.read(), b"world")
+
+        # 命中缓存时不改写索引文件
+        index_file = os.path.join(self.cache_dir, "index.json")
+        index_stat = os.stat(index_file)
+        read_render("key", self.cache_dir)
+        self.assertEqual(os.stat(index_file).st_ino, index_stat.st_ino)
+
+        clear_render_cache(self.cache_dir)
+        self.assertIsNone(read_render("key", self.cache_dir))
+
+    def test_evict_least_recently_used(self):
+        write_render("first", self._outputs(a=b"a" * 40), 100, self.cache_dir)
+        write_render("second", self._outputs(b=b"b" * 40), 100, self.cache_dir)
+        os.utime(os.path.join(self.cache_dir, "first", "meta.json"), (1, 1))
+        os.utime(os.path.join(self.cache_dir, "second", "meta.json"), (2, 2))
+        read_render("first", self.cache_dir)
+        write_render("third", self._outputs(c=b"c" * 40), 100, self.cache_dir)
+
+        self.assertIsNotNone(read_render("first", self.cache_dir))
+        self.assertIsNone(read_render("second", self.cache_dir))
+        self.assertIsNotNone(read_render("third", self.cache_dir))
+
+        # 超过上限的渲染结果不保存
+        self.assertFalse(write_render("large", self._outputs(d=b"d" * 200), 100, self.cache_dir))
+        self.assertIsNone(read_render("large", self.cache_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,8 +13,11 @@ else:
     raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
 
 
-
-from project_template.scan import scan_directory, scan_args
+import shutil
+from unittest import mock
+from project_template.util import decode_text
+from project_template.blobs import blob_session, read_blob, write_blob
+from project_template.scan import scan_directory, scan_args, iter_directory, iter_scan_args, reduce_args
 
 
 class TestScan(unittest.TestCase):
@@ -36,6 +39,35 @@ class TestScan(unittest.TestCase):
                 self.assertTrue(os.path.exists(path))
                 self.assertTrue(os.path.isdir(path))
 
+    def test_scan_directory_parallel(self):
+        project_dir = f"{MODULE_DIR}/examples/dl_model"
+        serial = scan_directory(project_dir)
+        parallel = scan_directory(project_dir, max_workers=4)
+        self.assertListEqual(serial, parallel)
+
+    def test_iter_directory(self):
+        project_dir = f"{MODULE_DIR}/examples/dl_model"
+        dirs_and_files = scan_directory(project_dir)
+        self.assertListEqual(list(iter_directory(project_dir)), dirs_and_files)
+        self.assertListEqual(list(iter_directory(project_dir, max_workers=2)), dirs_and_files)
+
+    def test_scan_directory_prune_ignored(self):
+        project_dir = "/tmp/test_scan_prune"
+        os.makedirs(os.path.join(project_dir, ".git", "objects"))
+        os.makedirs(os.path.join(project_dir, "src"))
+        with open(os.path.join(project_dir, ".git", "objects", "object"), "w") as f:
+            f.write("object")
+        with open(os.path.join(project_dir, "src", "main.py"), "w") as f:
+            f.write("print('hello')")
+
+        try:
+            dirs_and_files = scan_directory(project_dir, [".git/"])
+        finally:
+            shutil.rmtree(project_dir)
+
+        paths = sorted(os.path.join(item["root"], item["name"]) for item in dirs_and_files)
+        self.assertListEqual(paths, ["./src", "src/main.py"])
+
 
 class TestScanArgs(unittest.TestCase):
     def test_scan_args(self):
@@ -63,6 +95,92 @@ class TestScanArgs(unittest.TestCase):
         ]
         self.assertListEqual(args, gt)
 
+    def test_iter_scan_args(self):
+        project_dir = f"{MODULE_DIR}/examples/dl_model"
+        dirs_and_files = scan_directory(project_dir)
+        args = scan_args(dirs_and_files)
+
+        raw_args = []
+        streamed = list(iter_scan_args(iter_directory(project_dir), raw_args))
+        self.assertListEqual(streamed, dirs_and_files)
+        self.assertListEqual(reduce_args(raw_args), args)
+
+    def test_iter_scan_args_mmap(self):
+        project_dir = f"{MODULE_DIR}/examples/dl_model"
+        raw_args = []
+        manifest = {}
+        dirs_and_files = list(iter_scan_args(iter_directory(project_dir, manifest=manifest), raw_args, manifest))
+
+        mapped_raw_args = []
+        mapped_manifest = {}
+        mapped = iter_directory(project_dir, manifest=mapped_manifest, mmap_threshold=1)
+        mapped = list(iter_scan_args(mapped, mapped_raw_args, mapped_manifest))
+        self.assertListEqual(mapped, dirs_and_files)
+        self.assertDictEqual(mapped_manifest, manifest)
+        self.assertListEqual(reduce_args(mapped_raw_args), reduce_args(raw_args))
+
+    def test_scan_binary_files(self):
+        project_dir = "/tmp/test_scan_binary"
+        os.makedirs(project_dir)
+        data = b"\x89PNG\r\n#{not_an_arg}\xff\x00"
+        with open(os.path.join(project_dir, "#{name}.png"), "wb") as f:
+            f.write(data)
+
+        try:
+            for mmap_threshold in [1 << 20, 1]:
+                raw_args = []
+                dirs_and_files = list(iter_scan_args(iter_directory(project_dir, mmap_threshold=mmap_threshold), raw_args))
+                self.assertEqual(len(dirs_and_files), 1)
+                self.assertEqual(dirs_and_files[0]["content"], data)
+                self.assertTrue(dirs_and_files[0]["binary"])
+                # 只扫描文件名中的参数
+                self.assertListEqual(dirs_and_files[0]["arguments"], ["name"])
+                self.assertNotIn("content", dirs_and_files[0]["spans"])
+                self.assertListEqual([arg["name"] for arg in reduce_args(raw_args)], ["name"])
+        finally:
+            shutil.rmtree(project_dir)
+
+
+    def test_store_large_files(self):
+        project_dir = "/tmp/test_scan_store_blobs"
+        os.makedirs(project_dir)
+        files = {
+            "plain.txt": "plain text without placeholders\n" * 100,
+            "args.txt": "hello #{name}\n" * 100,
+            "crlf.txt": "windows\r\nline\r\n" * 100,
+        }
+        for file_name, content in files.items():
+            with open(os.path.join(project_dir, file_name), "w", newline="") as f:
+                f.write(content)
+        binary = b"\x89PNG\x00" + b"#{not_an_arg}\xff" * 100
+        with open(os.path.join(project_dir, "image.png"), "wb") as f:
+            f.write(binary)
+
+        try:
+            raw_args = []
+            with blob_session(), mock.patch("project_template.scan.decode_text", wraps=decode_text) as decode, \
+                    mock.patch("project_template.scan.write_blob", wraps=write_blob) as store:
+                dirs_and_files = list(iter_scan_args(iter_directory(project_dir, mmap_threshold=1, store_blobs=True), raw_args))
+            entries = {dir_or_file["name"]: dir_or_file for dir_or_file in dirs_and_files}
+            # 不包含参数的文件直接写入内容存储，不解码
+            self.assertEqual(decode.call_count, 2)
+            self.assertIsNone(entries["plain.txt"]["content"])
+            self.assertEqual(read_blob(entries["plain.txt"]["blob"]), files["plain.txt"].encode("utf-8"))
+            self.assertFalse(entries["plain.txt"].get("binary", False))
+            self.assertEqual(entries["args.txt"]["content"], files["args.txt"])
+            self.assertListEqual(entries["args.txt"]["arguments"], ["name"] * 100)
+            # 需要转换换行符的文件仍然解码
+            self.assertEqual(entries["crlf.txt"]["content"], files["crlf.txt"].replace("\r\n", "\n"))
+            self.assertNotIn("blob", entries["crlf.txt"])
+            # 二进制文件根据前缀判断，不解码，直接使用扫描时计算的哈希写入内容存储
+            self.assertIsNone(entries["image.png"]["content"])
+            self.assertTrue(entries["image.png"]["binary"])
+            self.assertEqual(read_blob(entries["image.png"]["blob"]), binary)
+            self.assertEqual(store.call_count, 2)
+            self.assertTrue(all(call.kwargs.get("digest", None) is not None for call in store.call_args_list))
+        finally:
+            shutil.rmtree(project_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import unittest
+
+
+sys.dont_write_bytecode = True
+
+MODULE_DIR = os.environ.get('MODULE_DIR', None)
+if MODULE_DIR is not None:
+    if MODULE_DIR not in sys.path:
+        sys.path = [MODULE_DIR] + sys.path
+else:
+    raise ValueError("TEMPLATE_PROJECT_DIR environment variable not set!")
+
+
+import shutil
+from unittest import mock
+from project_template.util import save_write_json
+from project_template.scan import scan_directory, scan_args
+from concurrent.futures import ThreadPoolExecutor
+from project_template.storage import config_file_path, write_config, read_config, read_config_args, read_config_entry, clear_config_cache
+from project_template.storage import history_file_path, append_history, history_versions
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.location_dir = "/tmp/test_storage"
+        os.makedirs(self.location_dir)
+
+        project_dir = f"{MODULE_DIR}/examples/dl_model"
+        dirs_and_files = scan_directory(project_dir)
+        args = scan_args(dirs_and_files)
+        self.config = {
+            "dirs_and_files": dirs_and_files,
+            "args": args,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.location_dir)
+
+    def check_config_format(self, config_format):
+        config_file = config_file_path(self.location_dir, "test_template", config_format)
+        write_config(config_file, iter(self.config["dirs_and_files"]), lambda: {"args": self.config["args"]})
+
+        self.assertDictEqual(read_config(config_file), self.config)
+        clear_config_cache()
+        self.assertListEqual(read_config_args(config_file), self.config["args"])
+        for index, dir_or_file in enumerate(self.config["dirs_and_files"]):
+            self.assertDictEqual(read_config_entry(config_file, index), dir_or_file)
+
+    def test_json_config(self):
+        self.check_config_format("json")
+
+    def test_pack_config(self):
+        self.check_config_format("pack")
+        self.assertTrue(config_file_path(self.location_dir, "test_template", "pack").endswith(".zip"))
+
+    def test_config_cache(self):
+        config_file = config_file_path(self.location_dir, "test_template", "json")
+        write_config(config_file, iter(self.config["dirs_and_files"]), lambda: {"args": self.config["args"]})
+        config = read_config(config_file)
+        with mock.patch("project_template.storage.read_blob", side_effect=AssertionError("blob read")):
+            self.assertDictEqual(read_config(config_file), config)
+
+        # 返回的是缓存的副本，修改后不影响之后的读取
+        config["args"].append({"name": "extra", "default_value": None})
+        config["dirs_and_files"][0]["name"] = "modified"
+        read_config_entry(config_file, 0)["name"] = "modified"
+        read_config_args(config_file).clear()
+        self.assertDictEqual(read_config(config_file), self.config)
+
+        # 配置文件被其他进程改写后重新解析
+        save_write_json(config_file, {"dirs_and_files": [], "args": []})
+        self.assertDictEqual(read_config(config_file), {"dirs_and_files": [], "args": []})
+
+    def test_append_history_concurrently(self):
+        history_file = history_file_path(self.location_dir, "test_template")
+
+        def append(version):
+            new_config = dict(self.config, args=[{"name": f"arg_{version}", "default_value": None}])
+            append_history(history_file, self.config, 1, new_config, version)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(append, range(2, 18)))
+        # 每次追加都写入旧版本的快照和新版本，并发追加时不会丢失版本
+        versions = history_versions(history_file)
+        self.assertEqual(len(versions), 32)
+        self.assertListEqual(sorted(version for version in versions if version != 1), list(range(2, 18)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,7 +14,8 @@ else:
 
 
 import shutil
-from project_template.util import save_write_json, save_read_json, is_directory_empty, scan_args_for_string, format_string
+from unittest import mock
+from project_template.util import buffer_has_args, clone_file, save_write_json, save_write_json_stream, save_read_json, is_directory_empty, scan_args_for_string, scan_arg_spans, format_string, compile_spans, render_plan, compile_ignore_patterns, compile_replacements
 
 
 class TestUtil(unittest.TestCase):
@@ -25,6 +26,55 @@ class TestUtil(unittest.TestCase):
         self.assertTrue(os.path.exists(json_path))
         self.assertDictEqual(json_result, save_read_json(json_path))
 
+    def test_save_write_json_stream(self):
+        json_path = "/tmp/test.json"
+        items = [{"name": "a", "content": "x\ny"}, {"name": "b", "content": None}]
+        save_write_json_stream(json_path, "items", iter(items), lambda: {"args": [{"name": "c"}]})
+        self.assertDictEqual(save_read_json(json_path), {"items": items, "args": [{"name": "c"}]})
+
+        save_write_json_stream(json_path, "items", iter([]))
+        self.assertDictEqual(save_read_json(json_path), {"items": []})
+
+    def test_save_write_json_stream_failure(self):
+        json_path = "/tmp/test.json"
+        save_write_json(json_path, {"items": []})
+
+        def items():
+            yield {"name": "a"}
+            raise RuntimeError("interrupted")
+
+        # 写入失败时原有文件保持不变，也不会留下临时文件
+        self.assertRaises(RuntimeError, save_write_json_stream, json_path, "items", items())
+        self.assertDictEqual(save_read_json(json_path), {"items": []})
+        self.assertListEqual([name for name in os.listdir("/tmp") if name.startswith(".test.json.")], [])
+
+    def test_clone_file(self):
+        source = "/tmp/test_clone_source"
+        destination = "/tmp/test_clone_destination"
+        with open(source, "wb") as f:
+            f.write(b"\x00\xff" * 4096)
+        try:
+            clone_file(source, destination, 0o600)
+            with open(destination, "rb") as f:
+                self.assertEqual(f.read(), b"\x00\xff" * 4096)
+            self.assertEqual(os.stat(destination).st_mode & 0o7777, 0o600)
+
+            # 复制提前结束时从当前位置继续复制，不会得到被截断的文件
+            real_copy_file_range = os.copy_file_range
+            calls = []
+            def short_copy(src, dst, count):
+                calls.append(count)
+                return real_copy_file_range(src, dst, 1000) if len(calls) == 1 else 0
+            with mock.patch("fcntl.ioctl", side_effect=OSError), mock.patch("os.copy_file_range", short_copy):
+                clone_file(source, destination, 0o600)
+            self.assertEqual(len(calls), 2)
+            with open(destination, "rb") as f:
+                self.assertEqual(f.read(), b"\x00\xff" * 4096)
+        finally:
+            for path in [source, destination]:
+                if os.path.exists(path):
+                    os.remove(path)
+
     def test_save_read_json(self):
         json_result = {"test": "test"}
         json_path = "/tmp/test.json"
@@ -43,8 +93,44 @@ class TestUtil(unittest.TestCase):
         args = scan_args_for_string(string)
         self.assertListEqual(args, [{"name": "a", "default_value": "1"}, {"name": "b", "default_value": "2"}, {"name": "c", "default_value": None}])
 
+    def test_buffer_has_args(self):
+        self.assertTrue(buffer_has_args(b"#{a:1}, #{b}"))
+        self.assertTrue(buffer_has_args("#{模型}".encode()))
+        self.assertFalse(buffer_has_args(b"plain text"))
+        self.assertFalse(buffer_has_args(b"#{ not an arg }"))
+
+    def test_render_plan(self):
+        string = "#{a:1}, #{b:2}\n#{c}!"
+        spans = [[start, end, arg["name"]] for start, end, arg in scan_arg_spans(string)]
+        plan = compile_spans(string, spans)
+        self.assertTupleEqual(plan, (("", ", ", "\n", "!"), ("a", "b", "c")))
+        self.assertEqual(render_plan(plan, {"a": "1", "b": "2", "c": "3"}), "1, 2\n3!")
+        self.assertEqual(render_plan(plan, {"a": 4, "b": 5, "c": 6}), "4, 5\n6!")
+        self.assertEqual(render_plan(compile_spans("plain", []), {}), "plain")
+
     def test_format_string(self):
         string = "#{a:1}, #{b:2}, #{c}"
         args = {"a": "1", "b": "2", "c": "3"}
         formatted_string = format_string(string, args)
-        self.assertEqual(formatted_string, "1, 2, 3")
\ No newline at end of file
+        self.assertEqual(formatted_string, "1, 2, 3")
+        self.assertEqual(format_string("plain #{", args), "plain #{")
+
+    def test_compile_ignore_patterns(self):
+        whether_ignore = compile_ignore_patterns([".git/", "*.pyc", "!keep.pyc", "/build", "docs/**/*.md"])
+        self.assertTrue(whether_ignore(".git", True))
+        self.assertTrue(whether_ignore("src/.git", True))
+        self.assertFalse(whether_ignore(".git", False))
+        self.assertTrue(whether_ignore("src/a.pyc"))
+        self.assertFalse(whether_ignore("src/keep.pyc"))
+        self.assertTrue(whether_ignore("build", True))
+        self.assertFalse(whether_ignore("src/build", True))
+        self.assertTrue(whether_ignore("docs/a/b/c.md"))
+        self.assertFalse(whether_ignore("src/docs/c.md"))
+        self.assertFalse(compile_ignore_patterns([])("a.pyc"))
+
+    def test_compile_replacements(self):
+        replace = compile_replacements({"model": "#{model}", "MODEL": "#{MODEL}", "mod": "#{mod}", "": "x"})
+        # 最长匹配优先，替换后的内容不会被再次替换
+        self.assertEqual(replace("model mod MODEL modelmod"), "#{model} #{mod} #{MODEL} #{model}#{mod}")
+        self.assertEqual(replace("nothing"), "nothing")
+        self.assertEqual(compile_replacements({})("model"), "model")